@@ -30,51 +30,78 @@ logger = logging.getLogger(__name__)
 
 
 class MailLoaderSignals(QObject):
-    mail_loaded = pyqtSignal(str, str, str, str)
+    mail_loaded = pyqtSignal(str, str, str, str, str)
+    mailbox_overview_loaded = pyqtSignal(dict)
     finished = pyqtSignal()
 
 
 class MailLoader(QRunnable):
-    def __init__(self, mail_receiver: mail.Receiver, selection: str, unread_only: bool, maximum_mail_amount: int
-                 ) -> None:
+    def __init__(self, mail_receiver_pool: mail.ReceiverPool, selection: str, unread_only: bool,
+                 maximum_mail_amount: int) -> None:
         super().__init__()
 
         self.signals = MailLoaderSignals()
 
-        self._mail_receiver = mail_receiver
+        self._mail_receiver_pool = mail_receiver_pool
         self._selection = selection
         self._unread_only = unread_only
         self._maximum_mail_amount = maximum_mail_amount
 
     def run(self) -> None:
-        if self._unread_only:
-            selection, mail_ids = self._mail_receiver.get_ids_of_unread_mails(
-                selection=self._selection,
-                max_amount=self._maximum_mail_amount
-            )
-        else:
-            selection, mail_ids = self._mail_receiver.get_ids_of_mails(
-                selection=self._selection,
-                max_amount=self._maximum_mail_amount
-            )
+        # a connection of its own, so that displaying mails does not have to wait for the loader
+        with self._mail_receiver_pool.receiver() as mail_receiver:
+            # the counts of all mailboxes in one go; they also tell whether the cache of the selection is up-to-date
+            mailbox_overview = mail_receiver.mailbox_overview()
+            self.signals.mailbox_overview_loaded.emit(mailbox_overview)
+
+            # mails are identified by their uids; only headers that are not in the local cache yet are downloaded
+            # the previews come with the headers, so mails can be triaged without downloading them
+            for mail_uid, subject, from_sender, date, preview in mail_receiver.cached_minimal_mail_data(
+                    selection=self._selection,
+                    unread_only=self._unread_only,
+                    max_amount=self._maximum_mail_amount,
+                    mailbox_status=mailbox_overview.get(self._selection),
+                    preview=True
+            ):
+                self.signals.mail_loaded.emit(
+                    self._selection,
+                    mail_uid,
+                    subject,
+                    from_sender,
+                    preview
+                )
 
-        # if there are no mails to display
-        if not mail_ids:
-            self.signals.finished.emit()
-            return
+        self.signals.finished.emit()
 
-        # there are unread mails, add the new widgets
-        for mail_id in mail_ids:
-            subject, from_sender = self._mail_receiver.minimal_mail_data_by_id(
-                selection=self._selection, mail_id=mail_id
-            )
 
-            self.signals.mail_loaded.emit(
-                self._selection,
-                mail_id,
-                subject,
-                from_sender
-            )
+class MailSearcher(QRunnable):
+    def __init__(self, mail_receiver_pool: mail.ReceiverPool, prompt: str, unread_only: bool) -> None:
+        super().__init__()
+
+        # the signals of the loader fit, search results are mails as well
+        self.signals = MailLoaderSignals()
+
+        self._mail_receiver_pool = mail_receiver_pool
+        self._prompt = prompt
+        self._unread_only = unread_only
+
+    def run(self) -> None:
+        # the server searches the headers and bodies of the mails in all mailboxes, several of them at the same time
+        search_results = self._mail_receiver_pool.search(text=self._prompt, unread=True if self._unread_only else None)
+
+        selections = list(dict.fromkeys(selection for selection, mail_uid in search_results))
+        mail_uids_by_selection = {
+            selection: [mail_uid for result_selection, mail_uid in search_results if result_selection == selection]
+            for selection in selections
+        }
+
+        for selection, mails in zip(selections, self._mail_receiver_pool.map(
+                lambda mail_receiver, selection: list(mail_receiver.minimal_mail_data_by_ids(
+                    selection, mail_uids_by_selection[selection], by_uid=True, preview=True)),
+                selections
+        )):
+            for mail_uid, subject, from_sender, date, preview in mails:
+                self.signals.mail_loaded.emit(selection, str(mail_uid), subject, from_sender, preview)
 
         self.signals.finished.emit()
 
@@ -94,8 +121,9 @@ class MailsTab(QScrollArea):
         self._iserv_username = iserv_username
         self._iserv_password = iserv_password
 
-        # this is not too expensive, so it can be executed by the Main Thread without the window freezing
-        self._mail_receiver = mail.Receiver(self._iserv_username, self._iserv_password)
+        # connections are established when they are needed
+        # the first one is not too expensive, so it can be established by the Main Thread without the window freezing
+        self._mail_receiver_pool = mail.ReceiverPool(self._iserv_username, self._iserv_password)
         self._mail_transmitter = None
 
         # if we do not keep a reference to our windows, they will be closed immediately
@@ -107,9 +135,11 @@ class MailsTab(QScrollArea):
         # actual layout
         # ----------
 
+        # the items show the number of unread mails, the names of the mailboxes are their data
         self.mail_selection_combo_box = QComboBox()
-        self.mail_selection_combo_box.addItems(
-            [element[2] for element in self._mail_receiver.get_available_mailboxes()])
+        with self._mail_receiver_pool.receiver() as mail_receiver:
+            for element in mail_receiver.get_available_mailboxes():
+                self.mail_selection_combo_box.addItem(element[2], element[2])
         self.mail_selection_combo_box.setSizePolicy(QSizePolicy.Policy.Fixed, QSizePolicy.Policy.Fixed)
 
         self.unread_only_check_box = QCheckBox('Unread only')
@@ -158,6 +188,10 @@ class MailsTab(QScrollArea):
         self.filter_mails_entry.textChanged.connect(self.filter_mails)
         self.filter_mails_entry.setSizePolicy(QSizePolicy.Policy.MinimumExpanding, QSizePolicy.Policy.Maximum)
 
+        self.search_mails_button = QPushButton('Search server')
+        self.search_mails_button.clicked.connect(self.search_mails)
+        self.search_mails_button.setSizePolicy(QSizePolicy.Policy.Fixed, QSizePolicy.Policy.Fixed)
+
         # self.execute_filter_mails_button = QPushButton('Apply Filter')
         # self.execute_filter_mails_button.clicked.connect(self.filter_mails)
         # self.execute_filter_mails_button.setSizePolicy(QSizePolicy.Policy.Fixed, QSizePolicy.Policy.Fixed)
@@ -166,6 +200,7 @@ class MailsTab(QScrollArea):
         self.filter_mails_layout.setAlignment(Qt.AlignmentFlag.AlignHCenter)
         self.filter_mails_layout.addWidget(self.filter_mails_header)
         self.filter_mails_layout.addWidget(self.filter_mails_entry)
+        self.filter_mails_layout.addWidget(self.search_mails_button)
         # self.filter_mails_layout.addWidget(self.execute_filter_mails_button)
 
         self.filter_mails_widget = QWidget()
@@ -204,7 +239,7 @@ class MailsTab(QScrollArea):
 
     def display_mail(self, selection: str, mail_id: int | str) -> None:
         if not self.display_mail_window:
-            self.display_mail_window = DisplayMailWindow(self._mail_receiver)
+            self.display_mail_window = DisplayMailWindow(self._mail_receiver_pool)
 
         self.display_mail_window.display_mail(selection, mail_id)
         self.display_mail_window.show()
@@ -218,8 +253,10 @@ class MailsTab(QScrollArea):
             self.load_mails_button.setText('Reload mails')
             self.load_mails_button.setEnabled(True)
 
-    @pyqtSlot(str, str, str, str)
-    def append_loaded_mail_to_layout(self, selection: str, mail_id: int | str, subject: str, from_sender: str) -> None:
+    @pyqtSlot(str, str, str, str, str)
+    def append_loaded_mail_to_layout(
+            self, selection: str, mail_id: int | str, subject: str, from_sender: str, preview: str = ''
+    ) -> None:
         # widget with vertical layout containing labels with mail specific data
         mail_subject_label = QLabel(subject)
         mail_subject_label.setStyleSheet('QLabel { font-weight: bold }')
@@ -231,6 +268,15 @@ class MailsTab(QScrollArea):
         mail_data_layout.addWidget(mail_subject_label)
         mail_data_layout.addWidget(mail_from_user_label)
 
+        if preview:
+            # the beginning of the text; plain text, so nothing in it is interpreted as html
+            mail_preview_label = QLabel(preview)
+            mail_preview_label.setTextFormat(Qt.TextFormat.PlainText)
+            mail_preview_label.setWordWrap(True)
+            mail_preview_label.setStyleSheet('QLabel { color: grey; font-style: italic }')
+
+            mail_data_layout.addWidget(mail_preview_label)
+
         mail_data_widget = QWidget()
         mail_data_widget.setLayout(mail_data_layout)
 
@@ -262,6 +308,19 @@ class MailsTab(QScrollArea):
 
         self.mails_tab_mails_layout.addWidget(mail_main_widget)
 
+    @pyqtSlot(dict)
+    def update_mailbox_counts(self, mailbox_overview: dict) -> None:
+        for i in range(self.mail_selection_combo_box.count()):
+            mailbox_name = self.mail_selection_combo_box.itemData(i)
+
+            if (mailbox_status := mailbox_overview.get(mailbox_name)) is None:
+                continue
+
+            self.mail_selection_combo_box.setItemText(
+                i, f'{mailbox_name} ({mailbox_status["unseen"]}/{mailbox_status["messages"]})'
+                if mailbox_status.get('unseen') else mailbox_name
+            )
+
     def load_mails(self) -> None:
         self.toggle_load_mails_button_loading_state()  # load mails button
         self.filter_mails_widget.setEnabled(False)
@@ -269,17 +328,16 @@ class MailsTab(QScrollArea):
 
         # load data
         mail_loader = MailLoader(
-            self._mail_receiver,
-            self.mail_selection_combo_box.currentText(),
+            self._mail_receiver_pool,
+            self.mail_selection_combo_box.currentData(),
             self.unread_only_check_box.isChecked(),
             self.max_amount_spin_box.value() if self.max_amount_check_box.isChecked() else None
         )
+        # mails can be displayed while the others are still being loaded, the loader uses a connection of its own
         mail_loader.signals.mail_loaded.connect(self.append_loaded_mail_to_layout)
-        # pressing a display mail button would crash the receiver
-        mail_loader.signals.mail_loaded.connect(lambda: self.mails_tab_mails_widget.setEnabled(False))
+        mail_loader.signals.mailbox_overview_loaded.connect(self.update_mailbox_counts)
 
         mail_loader.signals.finished.connect(self.toggle_load_mails_button_loading_state)  # load mails button
-        mail_loader.signals.finished.connect(lambda: self.mails_tab_mails_widget.setEnabled(True))
         mail_loader.signals.finished.connect(lambda: self.filter_mails_widget.setEnabled(True))
 
         QThreadPool.globalInstance().start(mail_loader)
@@ -319,6 +377,26 @@ class MailsTab(QScrollArea):
                 # show
                 child.show()
 
+    def search_mails(self) -> None:
+        """replaces the loaded mails with the mails of all mailboxes that contain the prompt (searched by the server)"""
+        prompt = self.filter_mails_entry.text()
+        if not prompt:
+            return
+
+        self.load_mails_button.setEnabled(False)
+        self.search_mails_button.setText('Searching...')
+        self.search_mails_button.setEnabled(False)
+        util.clear_layout(self.mails_tab_mails_layout)
+
+        mail_searcher = MailSearcher(self._mail_receiver_pool, prompt, self.unread_only_check_box.isChecked())
+        mail_searcher.signals.mail_loaded.connect(self.append_loaded_mail_to_layout)
+
+        mail_searcher.signals.finished.connect(lambda: self.load_mails_button.setEnabled(True))
+        mail_searcher.signals.finished.connect(lambda: self.search_mails_button.setText('Search server'))
+        mail_searcher.signals.finished.connect(lambda: self.search_mails_button.setEnabled(True))
+
+        QThreadPool.globalInstance().start(mail_searcher)
+
     def shutdown(self) -> None:
         # close sub-windows
         if self.display_mail_window:
@@ -331,8 +409,8 @@ class MailsTab(QScrollArea):
             self.compose_mail_window.close()
 
         # log out and close connections
-        if self._mail_receiver:
-            self._mail_receiver.shutdown()
+        if self._mail_receiver_pool:
+            self._mail_receiver_pool.shutdown()
         if self._mail_transmitter:
             self._mail_transmitter.shutdown()
 
@@ -28,14 +28,14 @@ logger = logging.getLogger(__name__)
 
 
 class DisplayMailWindow(QScrollArea):
-    def __init__(self, mail_receiver: mail.Receiver) -> None:
+    def __init__(self, mail_receiver_pool: mail.ReceiverPool) -> None:
         super().__init__()
 
         # ----------
         # IServ
         # ----------
 
-        self._mail_receiver = mail_receiver
+        self._mail_receiver_pool = mail_receiver_pool
 
         self.current_mail_id = None
 
@@ -76,9 +76,18 @@ class DisplayMailWindow(QScrollArea):
 
     def download_mail_attachments(self, selection: str, mail_id: int | str) -> None:
         if save_path := QFileDialog.getExistingDirectory(self, 'Select Directory', '/'):
-            self._mail_receiver.download_mail_attachments_by_id(
-                selection=selection, mail_id=mail_id, to_location=save_path
-            )
+            with self._mail_receiver_pool.receiver() as mail_receiver:
+                mail_receiver.download_mail_attachments_by_id(
+                    selection=selection, mail_id=mail_id, to_location=save_path, by_uid=True
+                )
+
+    def mark_mail_as_read(self, selection: str, mail_id: int | str) -> None:
+        with self._mail_receiver_pool.receiver() as mail_receiver:
+            mail_receiver.mark_as_read_by_id(selection=selection, mail_id=mail_id, by_uid=True)
+
+    def mark_mail_as_unread(self, selection: str, mail_id: int | str) -> None:
+        with self._mail_receiver_pool.receiver() as mail_receiver:
+            mail_receiver.mark_as_unread_by_id(selection=selection, mail_id=mail_id, by_uid=True)
 
     def display_mail(self, selection: str, mail_id: int | str) -> None:
         if self.current_mail_id == mail_id:
@@ -87,8 +96,9 @@ class DisplayMailWindow(QScrollArea):
         util.clear_layout(self.main_layout)
 
         # get mail data
-        date, subject, from_sender, to_receiver, body, attachment_data = self._mail_receiver.fetch_mail_content_by_id(
-            selection=selection, mail_id=str(mail_id))
+        with self._mail_receiver_pool.receiver() as mail_receiver:
+            date, subject, from_sender, to_receiver, body, attachment_data = mail_receiver.fetch_mail_content_by_id(
+                selection=selection, mail_id=str(mail_id), by_uid=True)
 
         self.setWindowTitle(subject)
 
@@ -199,13 +209,13 @@ class DisplayMailWindow(QScrollArea):
         mark_as_read_button = QPushButton(f'Mark as read')
         mark_as_read_button.setSizePolicy(QSizePolicy.Policy.MinimumExpanding, QSizePolicy.Policy.Fixed)
         mark_as_read_button.clicked.connect(
-            lambda state: self._mail_receiver.mark_as_read_by_id(selection=selection, mail_id=mail_id)
+            lambda state: self.mark_mail_as_read(selection=selection, mail_id=mail_id)
         )
 
         mark_as_unread_button = QPushButton(f'Mark as unread')
         mark_as_unread_button.setSizePolicy(QSizePolicy.Policy.MinimumExpanding, QSizePolicy.Policy.Fixed)
         mark_as_unread_button.clicked.connect(
-            lambda state: self._mail_receiver.mark_as_unread_by_id(selection=selection, mail_id=mail_id)
+            lambda state: self.mark_mail_as_unread(selection=selection, mail_id=mail_id)
         )
 
         mark_as_read_unread_layout = QHBoxLayout()
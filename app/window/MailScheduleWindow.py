@@ -8,6 +8,8 @@ from PyQt6.QtWidgets import (
 
 from app.QtExt.QSeparationLine import QHSeparationLine
 
+from mail.ScheduleStore import ScheduleStore, InvalidScheduledMail, ScheduleChanged
+
 
 # ----------
 # logging
@@ -26,6 +28,14 @@ class MailScheduleWindow(QScrollArea):
     def __init__(self) -> None:
         super().__init__()
 
+        # shared with the mail scheduler service, which picks up changes on its own
+        self._schedule_store = ScheduleStore()
+        self._schedule_store.migrate_legacy()
+
+        # what the editor has been loaded with, changes of others in the meantime are not overwritten
+        self._loaded_mails = []
+        self._loaded_data_version = None
+
         # ----------
         # window settings
         # ----------
@@ -98,18 +108,37 @@ class MailScheduleWindow(QScrollArea):
         self.load_mail_schedule()
 
     def load_mail_schedule(self) -> None:
-        with open('./data/mail/schedule/schedule.txt', 'r', encoding='utf-8') as mail_schedule_file:
-            self.mail_schedule_input.setText(mail_schedule_file.read())
-            mail_schedule_file.close()
+        # the data version first: if the schedule is changed in between, saving is refused instead of overwriting it
+        self._loaded_data_version = self._schedule_store.data_version()
+        self._loaded_mails = self._schedule_store.scheduled_mails()
+
+        self.mail_schedule_input.setPlainText('\n'.join(
+            ScheduleStore.format_line(scheduled_mail) for scheduled_mail in self._loaded_mails))
+        self.save_mail_schedule_button.setText('Save mail schedule')
 
     def save_mail_schedule(self) -> None:
-        with open('./data/mail/schedule/schedule.txt', 'w', encoding='utf-8') as mail_schedule_file:
-            mail_schedule_file.write(self.mail_schedule_input.toPlainText())
-            mail_schedule_file.close()
+        # the schedule is changed in one transaction, the scheduler never sees half of it
+        try:
+            self._schedule_store.save_edited(
+                self.mail_schedule_input.toPlainText().split('\n'), self._loaded_mails, self._loaded_data_version)
+        except InvalidScheduledMail as error:
+            # nothing has been changed
+            logger.error(f'The mail schedule has not been saved. {error}')
+            self.save_mail_schedule_button.setText(f'Not saved - {error}')
+            return
+        except ScheduleChanged:
+            # e.g. the scheduler service has sent and rescheduled a mail
+            logger.error('The mail schedule has not been saved, it has been changed in the meantime.')
+            self.save_mail_schedule_button.setText(
+                'Not saved - the schedule has been changed in the meantime, reload it and apply your changes again')
+            return
+
+        # the ids of added mails
+        self.load_mail_schedule()
 
     def shutdown(self) -> None:
-        # log out and close connections
-        pass
+        # close the schedule store
+        self._schedule_store.close()
 
     def close(self) -> None:
         # log out and close connections
@@ -4,8 +4,10 @@ import argparse
 
 from plyer import notification
 from os import startfile
+from time import sleep
 
 from auth import authenticate
+from integration.discord import Webhook
 import mail
 import scraper
 import webdriver
@@ -90,16 +92,20 @@ def mail_command_function(arguments: argparse.Namespace) -> str:
     if arguments.action == 'unread':
         my_receiver = mail.Receiver(*authenticate())
 
-        # get the ids of all the unread mails in the inbox
-        selection, mail_ids = my_receiver.get_ids_of_unread_mails()
+        # the headers of the unread mails in the inbox; only the ones that are not cached yet are downloaded
+        unread_mails = list(my_receiver.cached_minimal_mail_data(unread_only=True))
 
-        if not mail_ids:
+        if not unread_mails:
             # job is done if there are no unseen mails
+            my_receiver.shutdown()
+            del my_receiver
+
             return f'\nThere are no unread mails in your inbox.'
 
         # inform the user about unread mails
-        number_of_unread_mails_info_string = f'There {"is" if len(mail_ids) == 1 else "are"} {len(mail_ids)} unread ' \
-                                             f'{"mail" if len(mail_ids) == 1 else "mails"} in your inbox!'
+        number_of_unread_mails_info_string = f'There {"is" if len(unread_mails) == 1 else "are"} ' \
+                                             f'{len(unread_mails)} unread ' \
+                                             f'{"mail" if len(unread_mails) == 1 else "mails"} in your inbox!'
         print(number_of_unread_mails_info_string)
         notification.notify(title='IServ Mails',
                             message=number_of_unread_mails_info_string,
@@ -108,10 +114,16 @@ def mail_command_function(arguments: argparse.Namespace) -> str:
                             timeout=3,)
 
         i = 1
-        for mail_id in mail_ids:
+        for mail_uid, subject, from_sender, date in unread_mails:
+            if arguments.headers_only:
+                print(f'\n({i}) {date} | {from_sender} | {subject}')
+
+                i += 1
+                continue
+
             date, subject, from_sender, to_receiver, body, attachment_data = my_receiver.fetch_mail_content_by_id(
-                selection, mail_id)
-            # "extract_text_by_mail_id()" is a generator
+                'INBOX', mail_uid, by_uid=True)
+            # mails are downloaded one at a time
             # it is not a good idea to download all the unread mails at once and load the into memory
 
             # log unread mails because I do not want to save them anywhere
@@ -141,15 +153,109 @@ Attachments:
 
         return ''
 
+    # ----------
+    # wait for the server to push changes of the inbox
+    # ----------
+
+    if arguments.action == 'watch':
+        my_watcher = mail.Watcher(*authenticate())
+        my_watcher.add_callback(mail.desktop_notification_callback)
+        my_watcher.add_callback(
+            lambda event, selection, mails: print(f'\n{event} ({selection}): {mails}'))
+
+        if arguments.webhook:
+            my_watcher.add_callback(mail.discord_webhook_callback(
+                Webhook(arguments.webhook, username='IScrA')))
+
+        print('Waiting for changes of your inbox. Press Ctrl+C to stop.')
+
+        my_watcher.start()
+        try:
+            while my_watcher.is_running():
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+        my_watcher.shutdown()
+        del my_watcher
+
+        return ''
+
+    # ----------
+    # keep a local copy of all mailboxes
+    # ----------
+
+    if arguments.action == 'mirror':
+        my_mirror = mail.Mirror(*authenticate(), compress_attachments=arguments.compress)
+
+        # only mails that have not been mirrored before are downloaded
+        new_mails = my_mirror.mirror()
+
+        my_mirror.shutdown()
+        del my_mirror
+
+        return '\n'.join(
+            f'{selection}: {number_of_new_mails} new' for selection, number_of_new_mails in new_mails.items())
+
+    # ----------
+    # send a templated mail to everyone in a csv file
+    # ----------
+
+    if arguments.action == 'merge':
+        if not (arguments.template and arguments.subject and arguments.csv):
+            return 'A mail merge needs a template, a subject and a csv file (--template, --subject, --csv).'
+
+        my_dispatcher = mail.Dispatcher(*authenticate())
+        my_mail_merge = mail.MailMerge(my_dispatcher, arguments.subject, arguments.template,
+                                       formatted_template=arguments.html, attachments=arguments.attachment)
+
+        report = my_mail_merge.send(arguments.csv)
+
+        my_dispatcher.shutdown()
+        del my_dispatcher
+
+        if arguments.report:
+            my_mail_merge.write_report(report, arguments.report)
+
+        lines = []
+        for entry in report:
+            line = f'{entry["to_user"]}: {entry["status"]}'
+            if entry['error']:
+                line += f' ({entry["error"]})'
+            elif not entry['appended']:
+                line += ' (not appended to INBOX/Sent)'
+
+            lines.append(line)
+
+        return '\n'.join(lines)
+
 
 mail_command = subparsers.add_parser('mail', help='tools for the IServ mail module')
 mail_command.set_defaults(function=mail_command_function)
 
 mail_command_arguments = mail_command.add_argument_group('arguments')
-mail_command_arguments.add_argument('action', choices=['unread'], help='action to be performed by the client')
-
-# mail_command_options = mail_command.add_argument_group('options')
-# mail_command_options.add_argument('-o', '--option', type=int, default=0)
+mail_command_arguments.add_argument('action', choices=['unread', 'watch', 'mirror', 'merge'],
+                                    help='action to be performed by the client')
+
+mail_command_options = mail_command.add_argument_group('options')
+mail_command_options.add_argument('--headers-only', action='store_true',
+                                  help='print only the headers of the mails, do not download them (unread)')
+mail_command_options.add_argument('-w', '--webhook', type=str, default=None,
+                                  help='url of a discord webhook to post new mails to (watch)')
+mail_command_options.add_argument('-z', '--compress', action='store_true',
+                                  help='store the attachments of mirrored mails compressed (mirror)')
+mail_command_options.add_argument('-t', '--template', type=str, default=None,
+                                  help='name of the mail template, e.g. name.txt (merge)')
+mail_command_options.add_argument('-s', '--subject', type=str, default=None,
+                                  help='subject of the mails, may contain substitutions like $first_name (merge)')
+mail_command_options.add_argument('--csv', type=str, default=None,
+                                  help='csv file with a to_user column and one column per substitution (merge)')
+mail_command_options.add_argument('--html', action='store_true',
+                                  help='the template is an html template (merge)')
+mail_command_options.add_argument('-a', '--attachment', action='append', default=[],
+                                  help='file to attach to every mail, may be given several times (merge)')
+mail_command_options.add_argument('-r', '--report', type=str, default=None,
+                                  help='csv file to write the result of every mail to (merge)')
 
 
 # ----------
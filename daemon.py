@@ -0,0 +1,217 @@
+import logging
+from configparser import ConfigParser
+
+import sys
+import asyncio
+import signal
+import imaplib
+
+from mail import ScheduleManager, AsyncReceiver, discord_webhook_callback
+from mail.connection import reconnect_delay
+from integration.discord import Webhook
+from scraper import Scraper
+import auth
+
+
+# ----------
+# logger
+# ----------
+
+
+# systemd passes everything written to stdout on to the journal
+logging.basicConfig(level=logging.INFO, format='%(name)s [%(levelname)8.8s] %(filename)20.20s | %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# daemon
+# ----------
+
+
+class Daemon:
+    """runs the mail scheduler, the mail watcher and the exercise watcher in one long-running process
+
+    the mail watcher idles on the event loop itself (mail.AsyncReceiver); the mail scheduler and the scraper are
+    blocking, so they run in threads of their own, supervised by the event loop
+
+    every part logs in once and keeps its connections, they are not shared between the parts; notifications are
+    posted to a discord webhook (if configured in the daemon section) and logged, one after the other, without
+    holding up the part they stem from
+    """
+    def __init__(self, iserv_username: str, iserv_password: str) -> None:
+        self._iserv_username = iserv_username
+        self._iserv_password = iserv_password
+
+        self._exercise_interval = config.getfloat('daemon', 'exercise_interval', fallback=15 * 60)
+        self._watch_mailbox = config.get('daemon', 'watch_mailbox', fallback='INBOX')
+
+        webhook_url = config.get('daemon', 'webhook', fallback='')
+        self._webhook = Webhook(webhook_url, username='IScrA') if webhook_url else None
+
+        self._loop = None
+        self._stopping = None
+        self._notifications = None
+
+        self._schedule_manager = None
+        self._scraper = None
+
+    def stop(self) -> None:
+        """makes run return after all parts have finished what they are doing (e.g. on SIGTERM)"""
+        logger.info('Stopping.')
+        self._stopping.set()
+
+    # ----------
+    # notifications
+    # ----------
+
+    def notify(self, title: str, message: str) -> None:
+        """queues a notification; may be called from any thread"""
+        self._loop.call_soon_threadsafe(self._notifications.put_nowait, (title, message))
+
+    async def _post_notifications(self) -> None:
+        while True:
+            title, message = await self._notifications.get()
+            logger.info(f'{title}: {message}')
+
+            if self._webhook is not None:
+                try:
+                    await asyncio.to_thread(self._webhook.send_simple_embed, title=title, description=message)
+                except Exception:
+                    logger.exception('Failed to post a notification to the discord webhook.')
+
+            self._notifications.task_done()
+
+    # ----------
+    # parts
+    # ----------
+
+    async def _on_new_mails(self, mails: list[tuple]) -> None:
+        if self._webhook is not None:
+            # posts every mail on its own
+            await asyncio.to_thread(discord_webhook_callback(self._webhook), 'new', self._watch_mailbox, mails)
+        else:
+            self.notify('IServ Mails',
+                        f'{len(mails)} new {"mail" if len(mails) == 1 else "mails"} in {self._watch_mailbox}.')
+
+    async def _watch_mails(self) -> None:
+        """waits for new mails with imap idle, like mail.Watcher, and connects again whenever the connection is lost"""
+        highest_uid = None
+
+        while not self._stopping.is_set():
+            try:
+                async with AsyncReceiver(self._iserv_username, self._iserv_password) as mail_receiver:
+                    if highest_uid is None:
+                        highest_uid = max(await mail_receiver.search(self._watch_mailbox), default=0)
+
+                    while not self._stopping.is_set():
+                        # mails that have arrived while the connection was lost are found as well
+                        if new_mail_uids := await mail_receiver.search(self._watch_mailbox, above_uid=highest_uid):
+                            highest_uid = max(new_mail_uids)
+                            await self._on_new_mails(await mail_receiver.minimal_mail_data_by_uids(
+                                self._watch_mailbox, sorted(new_mail_uids)))
+
+                        # re-issued regularly, before the server ends the idle command itself
+                        await mail_receiver.idle(self._watch_mailbox, timeout=28 * 60, stop=self._stopping)
+
+            except (imaplib.IMAP4.error, OSError, asyncio.IncompleteReadError):
+                logger.exception(f'The mail watcher of {self._watch_mailbox} has lost its connection.')
+
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), reconnect_delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _watch_exercises(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                if path_to_new_exercise_file := await asyncio.to_thread(self._scraper.pending_exercises_changed):
+                    self.notify('IServ Exercises', f'Your pending IServ-exercises have changed: '
+                                                   f'"{path_to_new_exercise_file}"')
+            except Exception:
+                # e.g. the session has expired; log in again next time
+                logger.exception('Failed to check the pending exercises. Logging in again.')
+                self._scraper = await asyncio.to_thread(Scraper, self._iserv_username, self._iserv_password)
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self._exercise_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self) -> bool:
+        """runs until stop is called or SIGTERM or SIGINT are received; returns False if a part has failed"""
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._notifications = asyncio.Queue()
+
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            self._loop.add_signal_handler(signal_number, self.stop)
+
+        # all logins at the same time
+        self._schedule_manager, self._scraper = await asyncio.gather(
+            asyncio.to_thread(ScheduleManager, self._iserv_username, self._iserv_password, self.notify),
+            asyncio.to_thread(Scraper, self._iserv_username, self._iserv_password)
+        )
+
+        logger.info('Running.')
+
+        notifier = asyncio.create_task(self._post_notifications())
+        parts = [
+            # the mail scheduler blocks while it waits, so it gets a thread of its own
+            asyncio.create_task(asyncio.to_thread(self._schedule_manager.run)),
+            asyncio.create_task(self._watch_mails()),
+            asyncio.create_task(self._watch_exercises())
+        ]
+
+        # a part that fails ends the daemon, so that systemd restarts it
+        stopping = asyncio.create_task(self._stopping.wait())
+        done, pending = await asyncio.wait([stopping, *parts], return_when=asyncio.FIRST_COMPLETED)
+
+        failed = stopping not in done
+        for part in done - {stopping}:
+            logger.error('A part of the daemon has stopped unexpectedly.', exc_info=part.exception())
+
+        self._stopping.set()
+        self._schedule_manager.stop()
+        await asyncio.gather(*parts, return_exceptions=True)
+
+        # the mails that are being sent are sent completely, their notifications are posted as well
+        await asyncio.gather(
+            asyncio.to_thread(self._schedule_manager.shutdown),
+            asyncio.to_thread(self._scraper.shutdown),
+            return_exceptions=True
+        )
+
+        try:
+            await asyncio.wait_for(self._notifications.join(), 30)
+        except asyncio.TimeoutError:
+            logger.warning('Not all notifications have been posted.')
+        notifier.cancel()
+
+        logger.info('Stopped.')
+
+        return not failed
+
+
+# ----------
+# run
+# ----------
+
+
+def main():
+    # credentials from the dotenv file and the keyring, there is nobody to ask
+    if not asyncio.run(Daemon(*auth.authenticate()).run()):
+        # systemd restarts the daemon
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
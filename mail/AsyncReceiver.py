@@ -0,0 +1,541 @@
+import logging
+from configparser import ConfigParser
+
+import re
+import asyncio
+from time import time
+from itertools import count
+import imaplib
+
+from mail import util
+from mail.connection import get_ssl_context
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# imap - async receiver
+# ----------
+
+
+# e.g. b'* 12 EXISTS' or b'* 3 FETCH (FLAGS (\\Seen))' or b'* OK [UIDVALIDITY 3857529045] UIDs valid'
+_untagged_response_pattern = re.compile(rb'\* (?:(?P<number>\d+) )?(?P<type>[A-Za-z-]+)(?: (?P<data>.*))?', re.DOTALL)
+_response_code_pattern = re.compile(rb'\[(?P<type>[A-Za-z-]+)(?: (?P<data>[^]]*))?\]')
+_uid_pattern = re.compile(rb'\bUID (?P<uid>\d+)')
+_tagged_response_pattern = re.compile(rb'(?P<tag>[A-Za-z0-9]+) (?P<status>[A-Za-z]+)(?: (?P<text>.*))?', re.DOTALL)
+
+# the untagged responses that belong to a command, all other ones are unsolicited and kept in
+# AsyncReceiver.untagged_responses; only one command per type of response is in flight at a time (see the locks), so
+# they can not get mixed up; STORE is always sent with .SILENT, so every FETCH response during it is unsolicited
+_expected_responses = {
+    'CAPABILITY': {'CAPABILITY'},
+    'LOGIN': {'CAPABILITY'},
+    'SELECT': {'FLAGS', 'EXISTS', 'RECENT', 'UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ', 'PERMANENTFLAGS'},
+    'EXAMINE': {'FLAGS', 'EXISTS', 'RECENT', 'UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ', 'PERMANENTFLAGS'},
+    'LIST': {'LIST', 'STATUS'},
+    'STATUS': {'STATUS'},
+    'SEARCH': {'SEARCH'},
+    'FETCH': {'FETCH'},
+    'APPEND': {'APPENDUID'},
+}
+
+
+class AsyncReceiver:
+    """an asyncio counterpart of mail.Receiver: one connection, any number of commands at the same time
+
+    commands are pipelined, i.e. sent without waiting for the answers to the previous ones, e.g.
+    overview, unread = await asyncio.gather(receiver.mailbox_overview(), receiver.search('INBOX', unread=True))
+    commands whose untagged responses could be confused (two searches, two fetches) wait for each other, though;
+    everything the server sends on its own (e.g. flag changes by other clients) ends up in untagged_responses
+    mails are identified by their uids only
+    """
+    def __init__(self, iserv_username: str, iserv_password: str) -> None:
+        self._iserv_username = iserv_username
+        self._iserv_password = iserv_password
+
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        # why the connection can not be used anymore, set once the responses are no longer read
+        self._closed = None
+
+        self.capabilities = ()
+
+        # responses the server sent on its own, e.g. {'EXISTS': [b'12']}
+        self.untagged_responses = {}
+
+        # set whenever the server has sent something on its own
+        self.untagged_response_received = asyncio.Event()
+
+        # one command at a time for each of these, their responses do not tell which command they belong to
+        self._list_lock = asyncio.Lock()
+        self._status_lock = asyncio.Lock()
+        self._search_lock = asyncio.Lock()
+        self._fetch_lock = asyncio.Lock()
+        # the uids the running fetch command has asked for; other FETCH responses are unsolicited
+        self._fetching_uids = set()
+
+        self._tags = (f'A{number}' for number in count())
+        # tag: (future, command name, {response type: [data, ...]})
+        self._pending = {}
+        self._continuation = None
+        # commands (including their literals) must not be interleaved
+        self._send_lock = asyncio.Lock()
+
+        self._selection = None
+        self._selection_is_readonly = None
+        # commands of a mailbox can be pipelined, but another mailbox can only be selected after they are finished
+        self._selection_condition = asyncio.Condition()
+        self._commands_in_selection = 0
+
+    async def __aenter__(self) -> 'AsyncReceiver':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exception_info) -> None:
+        await self.shutdown()
+
+    async def connect(self) -> None:
+        """establishes the connection, upgrades it to tls and logs in"""
+        host = config["server"]["domain"]
+        self._reader, self._writer = await asyncio.open_connection(host, int(config["port"]["imap"]))
+
+        # greeting
+        await self._reader.readline()
+
+        self._writer.write(b'STARTTLS0 STARTTLS\r\n')
+        await self._writer.drain()
+        while not (line := await self._reader.readline()).startswith(b'STARTTLS0 '):
+            if not line:
+                raise imaplib.IMAP4.abort('socket error: EOF')
+
+        if not line.split()[1].upper() == b'OK':
+            raise imaplib.IMAP4.error(f'Failed to start tls: {line.decode(errors="replace")}')
+
+        await self._writer.start_tls(get_ssl_context(), server_hostname=host)
+
+        self._closed = None
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+        status, responses = await self._command(
+            'LOGIN', util.quote(self._iserv_username), util.quote(self._iserv_password))
+        if status != 'OK':
+            raise imaplib.IMAP4.error('Failed to log in.')
+
+        # the login usually tells the capabilities, otherwise they are asked for
+        if not (capabilities := responses.get('CAPABILITY')):
+            status, responses = await self._command('CAPABILITY')
+            capabilities = responses.get('CAPABILITY')
+
+        self.capabilities = tuple(capabilities[-1].decode().upper().split()) if capabilities else ()
+
+    async def shutdown(self) -> None:
+        """logs out and closes the connection"""
+        if self._writer is None:
+            return
+
+        try:
+            await self._command('LOGOUT')
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+        self._reader_task.cancel()
+        self._writer.close()
+        self._writer = None
+
+    # ----------
+    # protocol
+    # ----------
+
+    async def _read_response(self) -> list:
+        """reads one response; like imaplib, literals are returned as (line, literal) tuples followed by the rest"""
+        chunks = []
+        line = await self._reader.readline()
+
+        while literal_size := re.search(rb'\{(\d+)\}\r\n$', line):
+            chunks.append((line[:-2], await self._reader.readexactly(int(literal_size.group(1)))))
+            line = await self._reader.readline()
+
+        if not line:
+            raise imaplib.IMAP4.abort('socket error: EOF')
+
+        chunks.append(line[:-2])
+
+        return chunks
+
+    async def _read_responses(self) -> None:
+        """hands the responses of the server to the commands waiting for them until the connection is closed"""
+        try:
+            while True:
+                chunks = await self._read_response()
+                head = chunks[0][0] if isinstance(chunks[0], tuple) else chunks[0]
+
+                if head.startswith(b'+'):
+                    if self._continuation is not None and not self._continuation.done():
+                        self._continuation.set_result(head)
+                elif head.startswith(b'* '):
+                    self._dispatch_untagged(head, chunks)
+                elif tagged_response := _tagged_response_pattern.match(head):
+                    self._complete(tagged_response)
+
+        except imaplib.IMAP4.abort as error:
+            self._closed = error
+        except (OSError, asyncio.IncompleteReadError) as error:
+            self._closed = imaplib.IMAP4.abort(f'socket error: {error}')
+        except Exception as error:
+            # e.g. a response that can not be parsed; nobody would ever answer the waiting commands otherwise
+            logger.exception('Failed to read the responses of the imap server.')
+            self._closed = imaplib.IMAP4.abort(f'failed to read a response: {error}')
+        finally:
+            if self._closed is None:
+                # cancelled by shutdown
+                self._closed = imaplib.IMAP4.abort('the connection has been closed')
+
+            for future, name, responses in self._pending.values():
+                if not future.done():
+                    future.set_exception(imaplib.IMAP4.abort(str(self._closed)))
+            self._pending.clear()
+
+    def _dispatch_untagged(self, head: bytes, chunks: list) -> None:
+        untagged_response = _untagged_response_pattern.match(head)
+        response_type = untagged_response.group('type').decode().upper()
+        data = b' '.join(filter(None, [untagged_response.group('number'), untagged_response.group('data')]))
+
+        if response_type in ('OK', 'NO', 'BAD') and (response_code := _response_code_pattern.match(data)):
+            # e.g. [UIDVALIDITY 3857529045]
+            response_type = response_code.group('type').decode().upper()
+            data = response_code.group('data') or b''
+
+        # the same format imaplib uses: the type is not part of the data anymore
+        if isinstance(chunks[0], tuple):
+            chunks = [(data, chunks[0][1]), *chunks[1:]]
+        else:
+            chunks = [data]
+
+        # a uid fetch is answered with the uids that have been asked for, flag changes of other mails are not part of it
+        solicited = response_type != 'FETCH' or any(
+            int(uid.group('uid')) in self._fetching_uids
+            for chunk in chunks for uid in [_uid_pattern.search(chunk[0] if isinstance(chunk, tuple) else chunk)]
+            if uid is not None
+        )
+
+        # the command that is waiting for this type of response gets it
+        for future, name, responses in self._pending.values():
+            if solicited and response_type in _expected_responses.get(name, ()):
+                responses.setdefault(response_type, []).extend(chunks)
+                return
+
+        self.untagged_responses.setdefault(response_type, []).extend(chunks)
+        self.untagged_response_received.set()
+
+    def _complete(self, tagged_response: re.Match) -> None:
+        if (pending := self._pending.pop(tagged_response.group('tag').decode(), None)) is None:
+            return
+
+        future, name, responses = pending
+
+        if response_code := _response_code_pattern.match(tagged_response.group('text') or b''):
+            # e.g. [CAPABILITY ...] after a login or [APPENDUID 38505 3955] after an append
+            responses.setdefault(response_code.group('type').decode().upper(), []).append(
+                response_code.group('data') or b'')
+
+        if not future.done():
+            future.set_result((tagged_response.group('status').decode().upper(), responses))
+
+    async def _send(self, name: str, *arguments: str | bytes) -> asyncio.Future:
+        """sends a command without waiting for its completion; bytes arguments are sent as literals
+
+        returns a future of the status and the untagged responses of the command; raises imaplib.IMAP4.abort right
+        away once the connection is gone, as nobody would complete the command anymore
+        """
+        tag = next(self._tags)
+        future = asyncio.get_running_loop().create_future()
+
+        async with self._send_lock:
+            if self._closed is not None:
+                raise imaplib.IMAP4.abort(str(self._closed))
+
+            self._pending[tag] = (future, name.split()[-1].upper(), {})
+
+            line = f'{tag} {name}'.encode()
+            for argument in arguments:
+                if not isinstance(argument, bytes):
+                    line += f' {argument}'.encode()
+                    continue
+
+                if 'LITERAL+' in self.capabilities:
+                    # non-synchronizing literal, no need to wait for the server
+                    self._writer.write(line + f' {{{len(argument)}+}}\r\n'.encode() + argument)
+                else:
+                    self._continuation = asyncio.get_running_loop().create_future()
+                    self._writer.write(line + f' {{{len(argument)}}}\r\n'.encode())
+                    await self._writer.drain()
+
+                    # the server may refuse the literal and end the command instead
+                    await asyncio.wait([self._continuation, future], return_when=asyncio.FIRST_COMPLETED)
+                    if future.done():
+                        return future
+
+                    self._writer.write(argument)
+
+                line = b''
+
+            self._writer.write(line + b'\r\n')
+            await self._writer.drain()
+
+        return future
+
+    async def _command(self, name: str, *arguments: str | bytes) -> tuple[str, dict]:
+        """sends a command and waits for its completion"""
+        return await (await self._send(name, *arguments))
+
+    async def _selected_command(
+            self, selection: str, readonly: bool, name: str, *arguments: str | bytes
+    ) -> tuple[str, dict]:
+        """sends a command that needs a selected mailbox, selecting it first if necessary"""
+        async with self._selection_condition:
+            # a read-write selection serves read-only commands as well
+            await self._selection_condition.wait_for(lambda: self._commands_in_selection == 0 or (
+                self._selection == selection and (readonly or not self._selection_is_readonly)))
+
+            if self._selection != selection or (self._selection_is_readonly and not readonly):
+                status, responses = await self._command(
+                    'EXAMINE' if readonly else 'SELECT', util.quote(selection))
+
+                if status != 'OK':
+                    self._selection = None
+                    logger.error(f'Failed to select mailbox {selection}.')
+                    return status, {}
+
+                self._selection, self._selection_is_readonly = selection, readonly
+
+            self._commands_in_selection += 1
+            future = await self._send(name, *arguments)
+
+        try:
+            return await future
+        finally:
+            async with self._selection_condition:
+                self._commands_in_selection -= 1
+                self._selection_condition.notify_all()
+
+    # ----------
+    # receiving mails using imap
+    # ----------
+
+    async def noop(self) -> None:
+        """keeps the connection alive and gives the server a chance to report changes (untagged_responses)"""
+        await self._command('NOOP')
+
+    async def get_available_mailboxes(self) -> list[tuple[str, str, str]]:
+        """returns the flags, the hierarchy delimiter and the name of all mailboxes"""
+        async with self._list_lock:
+            status, responses = await self._command('LIST', '""', '*')
+
+        if status != 'OK':
+            logger.error('Failed to list mailboxes.')
+            return []
+
+        mailboxes = []
+        parsed = util.parse_response(responses.get('LIST', []))
+        for flags, delimiter, mailbox_name in zip(parsed[0::3], parsed[1::3], parsed[2::3]):
+            if isinstance(mailbox_name, bytes):
+                mailbox_name = mailbox_name.decode()
+            mailboxes.append((' '.join(str(flag) for flag in flags), delimiter, str(mailbox_name)))
+
+        return mailboxes
+
+    async def mailbox_overview(self) -> dict[str, dict[str, int]]:
+        """like Receiver.mailbox_overview: the number of mails, unread mails, next uid and uidvalidity of mailboxes"""
+        if 'LIST-STATUS' in self.capabilities:
+            async with self._list_lock:
+                status, responses = await self._command(
+                    'LIST', '""', '*', 'RETURN', '(STATUS (MESSAGES UNSEEN UIDNEXT UIDVALIDITY))')
+            status_responses = responses.get('STATUS', [])
+        else:
+            mailboxes = [
+                mailbox_name for flags, delimiter, mailbox_name in await self.get_available_mailboxes()
+                if '\\noselect' not in flags.lower()
+            ]
+            # pipelined: all commands are sent before the first answer arrives; every STATUS response names its
+            # mailbox, so it does not matter which of the commands it is handed to
+            status_responses = []
+            async with self._status_lock:
+                for status, responses in await asyncio.gather(*[
+                    self._command('STATUS', util.quote(mailbox_name), '(MESSAGES UNSEEN UIDNEXT UIDVALIDITY)')
+                    for mailbox_name in mailboxes
+                ]):
+                    status_responses += responses.get('STATUS', [])
+
+        return util.parse_status_response(status_responses)
+
+    async def search(self, selection: str = 'INBOX', above_uid: int = None, **criteria) -> list[int]:
+        """searches a mailbox on the server and returns the uids of the matching mails, newest first
+
+        the criteria are the keyword arguments of mail.util.search_criteria, e.g. subject='Klausur', unread=True;
+        with above_uid, only mails with a higher uid are searched, e.g. the ones that have arrived since
+        """
+        # n:* always includes the mail with the highest uid, even if it is lower than n
+        arguments = [] if above_uid is None else ['UID', f'{above_uid + 1}:*']
+        for search_key, value in util.search_criteria(**criteria):
+            arguments.append(search_key)
+            if value is not None:
+                # unlike imaplib, any number of literals can be sent, so there is no need to search several times
+                arguments.append(util.quote(value) if value.isascii() else value.encode('utf-8'))
+
+        async with self._search_lock:
+            status, responses = await self._selected_command(
+                selection, True, 'UID SEARCH', *(['CHARSET', 'UTF-8'] if any(
+                    isinstance(argument, bytes) for argument in arguments) else []), *(arguments or ['ALL']))
+
+        if status != 'OK':
+            logger.error(f'Failed to search mailbox {selection}.')
+            return []
+
+        return sorted((
+            int(mail_uid) for mail_uid_block in responses.get('SEARCH', []) if mail_uid_block
+            for mail_uid in mail_uid_block.decode().split() if above_uid is None or int(mail_uid) > above_uid
+        ), reverse=True)
+
+    async def fetch(
+            self, selection: str, mail_uids: list[int], message_parts: str = '(FLAGS)'
+    ) -> list[tuple[int, dict]]:
+        """fetches parts of many mails with one command; returns (uid, {data item name: value}) tuples"""
+        if not mail_uids:
+            return []
+
+        async with self._fetch_lock:
+            self._fetching_uids = {int(mail_uid) for mail_uid in mail_uids}
+
+            try:
+                status, responses = await self._selected_command(
+                    selection, True, 'UID FETCH', util.message_set(mail_uids), message_parts)
+            finally:
+                self._fetching_uids = set()
+
+        if status != 'OK':
+            logger.error(f'Failed to fetch mails with uids: {util.message_set(mail_uids)}.')
+            return []
+
+        # a flag change of one of the mails may be reported on its own in the meantime, it is merged into the mail
+        mails = {}
+        for mail_id, data_items in util.parse_fetch_response(responses.get('FETCH', [])):
+            if 'UID' in data_items:
+                mails.setdefault(data_items['UID'], {}).update(data_items)
+
+        return list(mails.items())
+
+    async def minimal_mail_data_by_uids(
+            self, selection: str, mail_uids: list[int]
+    ) -> list[tuple[int, str, str, str]]:
+        """gets uid, subject, sender and date of many mails with one command, in the order of the given uids"""
+        headers = {
+            mail_uid: util.get_data_item(data_items, 'BODY[HEADER', b'')
+            for mail_uid, data_items in await self.fetch(
+                selection, mail_uids, '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])')
+        }
+
+        mail_uids = [int(mail_uid) for mail_uid in mail_uids if int(mail_uid) in headers]
+
+        return [
+            (mail_uid, *fields) for mail_uid, fields in zip(
+                mail_uids, util.parse_header_fields_batch(headers[mail_uid] for mail_uid in mail_uids))
+        ]
+
+    async def store(
+            self, selection: str, mail_uids: list[int], command: str = '+FLAGS', flags: str = '\\Seen'
+    ) -> bool:
+        """changes the flags of many mails with one command, e.g. marks them as read; returns whether it worked"""
+        status, responses = await self._selected_command(
+            selection, False, 'UID STORE', util.message_set(mail_uids), f'{command}.SILENT', f'({flags})')
+
+        if status != 'OK':
+            logger.error(f'Failed to store flags of mails with uids: {util.message_set(mail_uids)}.')
+
+        return status == 'OK'
+
+    async def append(self, mailbox: str, message: bytes, flags: str = '\\Seen', date_time: float = None) -> bool:
+        """uploads a mail to a mailbox, e.g. a sent one to INBOX/Sent; returns whether it worked"""
+        status, responses = await self._command(
+            'APPEND', util.quote(mailbox), f'({flags})', imaplib.Time2Internaldate(date_time or time()), message)
+
+        if status != 'OK':
+            logger.error(f'Failed to append a mail to mailbox {mailbox}.')
+
+        return status == 'OK'
+
+    # ----------
+    # waiting for changes using imap idle
+    # ----------
+
+    async def idle(
+            self, selection: str = 'INBOX', timeout: float = 28 * 60, stop: asyncio.Event = None
+    ) -> list[tuple[str, bytes]]:
+        """waits until the server reports changes of a mailbox, the timeout is over or stop is set
+
+        returns the untagged responses the server sent, e.g. [('EXISTS', b'12'), ('FETCH', b'3 (FLAGS (\\Seen))')]
+        like mail.Receiver.idle; no other command is sent while idling, so the connection is best used for it alone
+        """
+        # selects the mailbox if necessary; what a select reports is no news
+        if self._selection != selection:
+            await self._selected_command(selection, True, 'NOOP')
+
+            for response_type in ('EXISTS', 'RECENT', 'EXPUNGE', 'FETCH', 'VANISHED'):
+                self.untagged_responses.pop(response_type, None)
+
+        async with self._send_lock:
+            if self._closed is not None:
+                raise imaplib.IMAP4.abort(str(self._closed))
+
+            tag = next(self._tags)
+            future = asyncio.get_running_loop().create_future()
+            self._pending[tag] = (future, 'IDLE', {})
+
+            self.untagged_response_received.clear()
+            self._continuation = asyncio.get_running_loop().create_future()
+            self._writer.write(f'{tag} IDLE\r\n'.encode())
+            await self._writer.drain()
+
+            # the server confirms the start of the command (or refuses it)
+            await asyncio.wait([self._continuation, future], return_when=asyncio.FIRST_COMPLETED)
+
+            if not future.done():
+                waiting = [asyncio.create_task(self.untagged_response_received.wait())]
+                if stop is not None:
+                    waiting.append(asyncio.create_task(stop.wait()))
+
+                # the command also ends if the connection is closed
+                done, pending = await asyncio.wait([future, *waiting], timeout=timeout,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in waiting:
+                    task.cancel()
+
+                if not future.done():
+                    self._writer.write(b'DONE\r\n')
+                    await self._writer.drain()
+
+        status, responses = await future
+
+        if status != 'OK':
+            logger.error(f'The imap server refused to idle in mailbox {selection}.')
+
+        return [
+            (response_type, data)
+            for response_type in ('EXISTS', 'EXPUNGE', 'FETCH', 'VANISHED')
+            for data in self.untagged_responses.pop(response_type, [])
+        ]
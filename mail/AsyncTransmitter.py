@@ -0,0 +1,229 @@
+import logging
+from configparser import ConfigParser
+
+import re
+import asyncio
+import base64
+from time import time
+from email.message import Message
+
+from mail import util
+from mail.Composer import Composer
+from mail.AsyncReceiver import AsyncReceiver
+from mail.connection import get_ssl_context
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# smtp - async transmitter
+# ----------
+
+
+class SMTPError(Exception):
+    """the smtp server has refused a command"""
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(f'{code} {message}')
+
+        self.code = code
+        self.message = message
+
+
+class AsyncTransmitter(Composer):
+    """an asyncio counterpart of mail.Transmitter
+
+    async with AsyncTransmitter(username, password) as transmitter:
+        await transmitter.send_mail('max.mustermann', 'Hallo', 'Hallo Max!')
+    """
+    def __init__(self, iserv_username: str, iserv_password: str) -> None:
+        # loads preambles and epilogues
+        super().__init__(iserv_username)
+
+        self._iserv_username = iserv_username
+        self._iserv_password = iserv_password
+
+        self._reader = None
+        self._writer = None
+        self._smtp_extensions = {}
+        # one mail at a time per smtp connection
+        self._smtp_lock = asyncio.Lock()
+
+        # an imap connection is needed as well to push mails to INBOX/Sent when sending
+        self._mail_receiver = AsyncReceiver(iserv_username, iserv_password)
+
+    async def __aenter__(self) -> 'AsyncTransmitter':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exception_info) -> None:
+        await self.shutdown()
+
+    async def connect(self) -> None:
+        """establishes the smtp and imap connections at the same time"""
+        await asyncio.gather(self._connect_smtp(), self._mail_receiver.connect())
+
+    async def shutdown(self) -> None:
+        """terminates the smtp and imap sessions"""
+        if self._writer is not None:
+            try:
+                await self._smtp_command('QUIT')
+            except (SMTPError, OSError, asyncio.IncompleteReadError):
+                pass
+
+            self._writer.close()
+            self._writer = None
+
+        await self._mail_receiver.shutdown()
+
+    # ----------
+    # protocol
+    # ----------
+
+    async def _read_reply(self) -> tuple[int, str]:
+        """reads a (multiline) reply, e.g. 250-first line, 250 last line"""
+        lines = []
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                raise ConnectionResetError('The smtp server has closed the connection.')
+
+            lines.append(line[4:].decode(errors='replace').rstrip('\r\n'))
+
+            if line[3:4] != b'-':
+                return int(line[:3]), '\n'.join(lines)
+
+    async def _smtp_command(self, command: str, expected_codes: tuple = (250,)) -> tuple[int, str]:
+        self._writer.write(f'{command}\r\n'.encode())
+        await self._writer.drain()
+
+        code, message = await self._read_reply()
+        if code not in expected_codes:
+            raise SMTPError(code, message)
+
+        return code, message
+
+    async def _ehlo(self) -> None:
+        code, message = await self._smtp_command('EHLO iscra')
+
+        # e.g. {'PIPELINING': '', 'AUTH': 'PLAIN LOGIN', 'SIZE': '52428800'}
+        self._smtp_extensions = {
+            extension.split(' ', 1)[0].upper(): (extension.split(' ', 1)[1:] or [''])[0]
+            for extension in message.split('\n')[1:]
+        }
+
+    async def _connect_smtp(self) -> None:
+        host = config["server"]["domain"]
+        self._reader, self._writer = await asyncio.open_connection(host, int(config["port"]["smtp"]))
+
+        # greeting
+        await self._read_reply()
+
+        await self._ehlo()
+        await self._smtp_command('STARTTLS', (220,))
+        await self._writer.start_tls(get_ssl_context(), server_hostname=host)
+        # the server forgets everything it said before the tls handshake
+        await self._ehlo()
+
+        authentication_methods = self._smtp_extensions.get('AUTH', '').upper().split()
+        if 'PLAIN' in authentication_methods:
+            credentials = base64.b64encode(f'\0{self._iserv_username}\0{self._iserv_password}'.encode()).decode()
+            await self._smtp_command(f'AUTH PLAIN {credentials}', (235,))
+        elif 'LOGIN' in authentication_methods:
+            await self._smtp_command('AUTH LOGIN', (334,))
+            await self._smtp_command(base64.b64encode(self._iserv_username.encode()).decode(), (334,))
+            await self._smtp_command(base64.b64encode(self._iserv_password.encode()).decode(), (235,))
+        else:
+            # like smtplib, the credentials are not sent to a server that has not asked for them
+            raise SMTPError(504, f'The smtp server supports neither AUTH PLAIN nor AUTH LOGIN: '
+                                 f'"{self._smtp_extensions.get("AUTH", "")}"')
+
+    # ----------
+    # sending mails using smtp
+    # ----------
+
+    async def send_message(self, message: Message, append_to_sent: bool = True) -> dict[str, tuple[int, str]]:
+        """sends an already created mail and (by default) appends it to INBOX/Sent
+
+        like smtplib, returns the recipients the server has refused; raises SMTPError if it has refused all of them
+        """
+        # the same bytes are sent and appended; the mail of the caller keeps its Bcc
+        from_address, recipients, data = util.serialize_message(message)
+
+        async with self._smtp_lock:
+            envelope = [f'MAIL FROM:<{self._iserv_mail_address}>', *[f'RCPT TO:<{address}>' for address in recipients]]
+
+            if 'PIPELINING' in self._smtp_extensions:
+                # all commands at once, then all the replies; the server refuses DATA if no recipient is left
+                self._writer.write(''.join(f'{command}\r\n' for command in [*envelope, 'DATA']).encode())
+                await self._writer.drain()
+
+                replies = [await self._read_reply() for command in [*envelope, 'DATA']]
+                (mail_code, mail_message), *recipient_replies, data_reply = replies
+            else:
+                replies = []
+                for command in envelope:
+                    self._writer.write(f'{command}\r\n'.encode())
+                    await self._writer.drain()
+                    replies.append(await self._read_reply())
+
+                (mail_code, mail_message), *recipient_replies = replies
+                data_reply = None
+
+            refused_recipients = {
+                address: reply for address, reply in zip(recipients, recipient_replies) if reply[0] not in (250, 251)
+            }
+
+            if mail_code != 250 or len(refused_recipients) == len(recipients):
+                await self._smtp_command('RSET')
+
+                if mail_code != 250:
+                    raise SMTPError(mail_code, mail_message)
+                raise SMTPError(*next(iter(refused_recipients.values()), (554, 'No valid recipients.')))
+
+            if data_reply is None:
+                data_reply = await self._smtp_command('DATA', (354,))
+            elif data_reply[0] != 354:
+                await self._smtp_command('RSET')
+                raise SMTPError(*data_reply)
+
+            # lines starting with a dot get another one, a single dot ends the mail; like smtplib, the last line
+            # break is only added if it is missing, so the mail arrives exactly as it is appended to INBOX/Sent
+            self._writer.write(re.sub(rb'(?m)^\.', b'..', data) + (b'' if data.endswith(b'\r\n') else b'\r\n')
+                               + b'.\r\n')
+            await self._writer.drain()
+
+            code, reply_message = await self._read_reply()
+            if code != 250:
+                raise SMTPError(code, reply_message)
+
+        if append_to_sent:
+            await self._mail_receiver.append('INBOX/Sent', data, '\\Seen', time())
+
+        return refused_recipients
+
+    async def send_mail(self, to_user: str, subject: str, body: str, formatted_body: bool = False,
+                        attachments=None) -> dict[str, tuple[int, str]]:
+        """sends a mail with a body containing plain text or html to another IServ user"""
+        return await self.send_message(self.create_message(to_user, subject, body, formatted_body, attachments))
+
+    async def send_mail_template(self, to_user: str, subject: str, template: str, formatted_template=False,
+                                 substitution_mapping=None, attachments=None) -> dict[str, tuple[int, str]]:
+        """sends a mail to another IServ user and uses a given plain-text- or html-template as the body of the mail"""
+        body = self.render_template(template, formatted_template, substitution_mapping)
+
+        return await self.send_mail(to_user, subject, body, formatted_template, attachments)
@@ -0,0 +1,114 @@
+import logging
+from configparser import ConfigParser
+
+from os import stat, path
+from collections import OrderedDict
+from threading import Lock
+
+import mimetypes
+from email import encoders
+from email.message import Message
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# attachment cache
+# ----------
+
+
+def _add_attachment_headers(attachment: Message, attachment_file_name: str) -> Message:
+    attachment.add_header('Content-Disposition', 'attachment', filename=attachment_file_name)
+    attachment.add_header('Content-ID', '<{}>'.format(attachment_file_name))
+
+    return attachment
+
+
+class AttachmentCache:
+    """the encoded mime parts of attachments, so that a file attached to many mails is read and encoded only once
+
+    parts are keyed by path, size and modification time of their file, so a changed file is encoded again; the least
+    recently used parts are dropped once they take up more than max_size bytes, a part larger than that is encoded
+    again for every mail
+    """
+    def __init__(self, max_size: int = None) -> None:
+        # configured in MiB
+        self.max_size = max_size if max_size is not None \
+            else int(config.getfloat('attachments', 'cache_size', fallback=64) * 1024 * 1024)
+
+        # (path, size, modification time): (part, encoded size), least recently used first
+        self._parts = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def _encode(file_path: str) -> tuple[Message, int]:
+        content_type, encoding = mimetypes.guess_type(file_path)
+        if content_type is None or encoding is not None:
+            content_type = 'application/octet-stream'
+
+        maintype, subtype = content_type.split('/', 1)
+
+        if maintype == 'text':
+            attachment_file = open(file_path, 'r')
+            attachment = MIMEText(attachment_file.read(), _subtype=subtype)
+            attachment_file.close()
+
+        else:
+            attachment_file = open(file_path, 'rb')
+            attachment = MIMEBase(maintype, subtype)
+            attachment.set_payload(attachment_file.read())
+            attachment_file.close()
+
+            encoders.encode_base64(attachment)
+
+        _add_attachment_headers(attachment, path.basename(file_path))
+
+        return attachment, len(attachment.get_payload())
+
+    def get(self, file_path: str) -> Message:
+        """returns the mime part of an attachment; parts that are kept ready must not be changed"""
+        stat_result = stat(file_path)
+        key = (file_path, stat_result.st_size, stat_result.st_mtime_ns)
+
+        with self._lock:
+            if (cached_part := self._parts.get(key)) is not None:
+                self._parts.move_to_end(key)
+
+        if cached_part is None:
+            cached_part = self._encode(file_path)
+
+            # a part larger than the whole cache is used for this mail only
+            if cached_part[1] <= self.max_size:
+                with self._lock:
+                    if key not in self._parts:
+                        self._parts[key] = cached_part
+                        self._size += cached_part[1]
+
+                    while self._size > self.max_size:
+                        evicted_key, (evicted_part, evicted_size) = self._parts.popitem(last=False)
+                        self._size -= evicted_size
+
+        return cached_part[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._parts.clear()
+            self._size = 0
@@ -0,0 +1,130 @@
+import logging
+from configparser import ConfigParser
+
+from datetime import datetime
+
+from email.utils import formatdate
+
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from mail.TemplateCache import TemplateCache
+from mail.AttachmentCache import AttachmentCache
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# composer
+# ----------
+
+
+# shared by all composers of the process, so every template is only read and compiled once
+template_cache = TemplateCache()
+# and every attachment is only encoded once
+attachment_cache = AttachmentCache()
+
+
+def _timestamp() -> str:
+    return datetime.now().strftime("%Y-%m-%d | %H-%M")
+
+
+class Composer:
+    """creates the mails the transmitters send: adds preambles, epilogues and attachments"""
+    def __init__(self, iserv_username: str) -> None:
+        self._iserv_mail_address = f'{iserv_username}@{config["server"]["domain"]}'
+
+        self.load_extensions()
+
+    @staticmethod
+    def _extension_path(name: str, formatted: bool) -> str:
+        """e.g. preamble.txt in the plaintext extension directory"""
+        if formatted:
+            return f'{config["path"]["mail_extension_html"]}/{name}.html'
+
+        return f'{config["path"]["mail_extension_plaintext"]}/{name}.txt'
+
+    def _render_extension(self, name: str, formatted: bool) -> str:
+        """renders a preamble or epilogue; its TIMESTAMP is the time the mail is created at"""
+        return template_cache.get(self._extension_path(name, formatted)).substitute(
+            # substitutions
+            TIMESTAMP=_timestamp()
+        )
+
+    def load_extensions(self) -> None:
+        """loads mail preambles and epilogues and makes sure they can be rendered
+
+        they are cached and only loaded again when their files have changed, which is checked for every mail
+        """
+        for name in ('preamble', 'epilogue'):
+            for formatted in (False, True):
+                self._render_extension(name, formatted)
+
+    # ----------
+    # composing mails
+    # ----------
+
+    @staticmethod
+    def _attach_files(to_message: MIMEMultipart, files_to_attach: list) -> None:
+        """attach files to a given MIME multipart"""
+        for file_to_attach in files_to_attach:
+            # encoded only once as long as the file does not change
+            to_message.attach(attachment_cache.get(file_to_attach))
+
+    def create_message(self, to_user: str, subject: str, body: str, formatted_body: bool = False,
+                       attachments=None) -> MIMEMultipart:
+        """creates a mail with a body containing plain text or html to another IServ user"""
+        if attachments is None:
+            attachments = []
+
+        # create the message
+        message = MIMEMultipart('alternative')
+        message['From'] = self._iserv_mail_address
+        # with IServ, you can only send mails to other IServ users
+        # turn the given username into a mail address
+        message['To'] = f'{to_user}@{config["server"]["domain"]}'
+        message['Date'] = formatdate(localtime=True)
+        message['Subject'] = subject
+
+        if formatted_body:
+            # add the preamble and epilogue to the body of the mail
+            body = self._render_extension('preamble', True) + body + self._render_extension('epilogue', True)
+            # attach the body to the mail
+            message.attach(MIMEText(body, 'html'))
+        else:
+            body = self._render_extension('preamble', False) + body + self._render_extension('epilogue', False)
+            # attach the body to the mail
+            message.attach(MIMEText(body, 'plain'))
+
+        # attachments
+        self._attach_files(message, attachments)
+
+        return message
+
+    @staticmethod
+    def render_template(template: str, formatted_template=False, substitution_mapping=None) -> str:
+        """renders a plain-text- or html-template and substitutes everything listed in the substitution_mapping
+
+        $TIMESTAMP is substituted with the current time, unless the substitution_mapping contains it
+        """
+        if substitution_mapping is None:
+            substitution_mapping = {}
+
+        return template_cache.get(
+            f'{config["path"]["mail_template"]}/{"html" if formatted_template else "plaintext"}/{template}'
+        ).safe_substitute(**{'TIMESTAMP': _timestamp(), **substitution_mapping})
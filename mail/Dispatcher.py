@@ -0,0 +1,274 @@
+import logging
+from configparser import ConfigParser
+
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from time import time, monotonic, sleep
+from email.message import Message
+
+import smtplib
+import imaplib
+
+from mail import util
+from mail.Composer import Composer
+from mail.SMTPPool import SMTPPool
+from mail.SentAppender import SentAppender
+from mail.connection import connect_imap, connect_with_backoff
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# rate limits
+# ----------
+
+
+class TokenBucket:
+    """lets rate events per second pass on average and up to burst of them at once; a rate of 0 lets everything pass"""
+    def __init__(self, rate: float, burst: float = 1) -> None:
+        self._rate = rate
+        self._burst = max(burst, 1)
+
+        self._tokens = self._burst
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        """waits until the next event may pass"""
+        if not self._rate:
+            return
+
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+            # the token is taken right away, even if it still has to be waited for; later callers queue up behind
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+
+        if wait:
+            sleep(wait)
+
+    def is_full(self) -> bool:
+        """whether the bucket has refilled completely, i.e. it behaves like a new one"""
+        with self._lock:
+            return not self._rate or self._tokens + (monotonic() - self._updated) * self._rate >= self._burst
+
+
+# ----------
+# dispatcher
+# ----------
+
+
+class Dispatcher(Composer):
+    """sends many mails at the same time through a pool of smtp connections, within the rate limits of the server
+
+    appending the sent mails to INBOX/Sent (in batches, see SentAppender) and everything else that is to be done
+    afterwards (e.g. notifications) happens in the background, so it never holds up sending
+    """
+    def __init__(self, iserv_username: str, iserv_password: str) -> None:
+        # loads preambles and epilogues
+        super().__init__(iserv_username)
+
+        self._iserv_username = iserv_username
+        self._iserv_password = iserv_password
+
+        connections = config.getint('dispatch', 'connections', fallback=3)
+        self._smtp_pool = SMTPPool(iserv_username, iserv_password, max_size=connections)
+        self._send_executor = ThreadPoolExecutor(max_workers=connections, thread_name_prefix='IScrADispatcher')
+
+        # the rates are configured per minute
+        self._rate_limit = TokenBucket(
+            config.getfloat('dispatch', 'rate', fallback=60) / 60, config.getfloat('dispatch', 'burst', fallback=20))
+        self._recipient_rate = config.getfloat('dispatch', 'recipient_rate', fallback=6) / 60
+        self._recipient_burst = config.getfloat('dispatch', 'recipient_burst', fallback=3)
+        self._recipient_rate_limits = {}
+        self._recipient_rate_limits_lock = Lock()
+        # the number of buckets at which the full ones are dropped next
+        self._recipient_rate_limits_prune_at = 256
+
+        self._sent_appender = SentAppender(iserv_username, iserv_password)
+
+        # one imap connection for mails that have been sent before, used by the single background thread only
+        self._background_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='IScrADispatcherBackground')
+        self._imap_connection = None
+
+    def _recipient_rate_limit(self, recipient: str) -> TokenBucket:
+        with self._recipient_rate_limits_lock:
+            if (rate_limit := self._recipient_rate_limits.get(recipient.lower())) is None:
+                if len(self._recipient_rate_limits) >= self._recipient_rate_limits_prune_at:
+                    # a full bucket is the same as a new one, so only recipients mailed recently are remembered
+                    self._recipient_rate_limits = {
+                        known_recipient: known_rate_limit
+                        for known_recipient, known_rate_limit in self._recipient_rate_limits.items()
+                        if not known_rate_limit.is_full()
+                    }
+                    self._recipient_rate_limits_prune_at = max(2 * len(self._recipient_rate_limits), 256)
+
+                rate_limit = self._recipient_rate_limits[recipient.lower()] = TokenBucket(
+                    self._recipient_rate, self._recipient_burst)
+
+        return rate_limit
+
+    # ----------
+    # background
+    # ----------
+
+    def _is_in_sent(self, message_id: str) -> bool:
+        status, response = self._imap_connection.select('INBOX/Sent', readonly=True)
+        if status.lower() != 'ok':
+            return False
+
+        status, response = self._imap_connection.search(None, 'HEADER', 'Message-ID', util.quote(message_id))
+
+        return status.lower() == 'ok' and bool(response[0])
+
+    def _check_imap_connection(self) -> None:
+        """forgets the imap connection if it has been dropped, so that the next append connects again"""
+        if self._imap_connection is not None and self._imap_connection.needs_check() \
+                and not self._imap_connection.is_alive():
+            logger.warning('The imap connection of the dispatcher has been dropped.')
+
+            try:
+                self._imap_connection.shutdown()
+            except OSError:
+                pass
+
+            self._imap_connection = None
+
+    def _connect_imap_if_necessary(self) -> None:
+        self._check_imap_connection()
+
+        if self._imap_connection is None:
+            self._imap_connection = connect_with_backoff(
+                lambda: connect_imap(self._iserv_username, self._iserv_password), 'the imap server')
+
+    def _append_to_sent(self, message: Message, unless_present: bool = False) -> bool:
+        """appends a mail to INBOX/Sent; returns whether it worked"""
+        try:
+            self._connect_imap_if_necessary()
+
+            # e.g. after a crash, the mail may have been appended before it could be noted
+            if unless_present and message['Message-ID'] and self._is_in_sent(message['Message-ID']):
+                return True
+
+            status, response = self._imap_connection.append(
+                'INBOX/Sent', '\\SEEN', imaplib.Time2Internaldate(time()), util.serialize_message(message)[2])
+        except (imaplib.IMAP4.error, OSError):
+            logger.exception(f'Failed to append the mail "{message["Subject"]}" to {message["To"]} to INBOX/Sent.')
+
+            # the connection may be broken, the next append connects again
+            self._imap_connection = None
+            return False
+
+        return status.lower() == 'ok'
+
+    @staticmethod
+    def _after_sending(message: Message, appended: bool, on_sent: Callable | None) -> None:
+        if on_sent is not None:
+            try:
+                on_sent(message, appended)
+            except Exception:
+                # the mail has been sent, nothing that goes wrong afterwards makes it unsent
+                logger.exception(f'Failed to finish sending the mail "{message["Subject"]}" to {message["To"]}.')
+
+    def submit_append(self, message: Message, on_appended: Callable[[Message], None] = None) -> Future:
+        """appends a mail that has been sent before to INBOX/Sent in the background, unless it is there already
+
+        on_appended is called in the background if it has worked
+        """
+        def append() -> None:
+            if self._append_to_sent(message, unless_present=True) and on_appended is not None:
+                on_appended(message)
+
+        return self._background_executor.submit(append)
+
+    def keepalive(self) -> None:
+        """sends a NOOP over the connections that have not been used for a while and drops the dead ones
+
+        long-running processes call it regularly, so that the next mail does not have to wait for a new connection
+        """
+        self._smtp_pool.keepalive()
+
+        # the imap connection is only ever used by the background thread; the sent appender keeps its own alive
+        self._background_executor.submit(self._check_imap_connection)
+
+    def flush(self) -> None:
+        """waits until the mails that have been sent so far are appended to INBOX/Sent and on_sent has been called"""
+        self._sent_appender.flush()
+
+    # ----------
+    # sending
+    # ----------
+
+    def _send(self, message: Message, append_to_sent: bool, on_sent: Callable | None) -> dict:
+        # serialized once, the same bytes are sent and appended to INBOX/Sent
+        from_address, recipients, message_bytes = util.serialize_message(message)
+
+        for recipient in recipients:
+            self._recipient_rate_limit(recipient).acquire()
+        self._rate_limit.acquire()
+
+        try:
+            with self._smtp_pool.connection() as smtp_connection:
+                refused_recipients = smtp_connection.sendmail(from_address, recipients, message_bytes)
+        except smtplib.SMTPServerDisconnected:
+            # an idle connection may have been closed by the server in the meantime, the mail has not been accepted
+            # then (see mail.connection.MailMaybeSent, which is not caught: the mail may have been sent already)
+            with self._smtp_pool.connection(fresh=True) as smtp_connection:
+                refused_recipients = smtp_connection.sendmail(from_address, recipients, message_bytes)
+
+        if append_to_sent:
+            # waits if too many sent mails are waiting to be appended already
+            self._sent_appender.append(
+                message_bytes, on_appended=lambda appended: self._after_sending(message, appended, on_sent))
+        else:
+            self._background_executor.submit(self._after_sending, message, False, on_sent)
+
+        return refused_recipients
+
+    def submit(self, message: Message, append_to_sent: bool = True,
+               on_sent: Callable[[Message, bool], None] = None) -> Future:
+        """sends an already created mail as soon as a connection is free and the rate limits allow it
+
+        returns a future of the recipients the server has refused (like smtplib); on_sent(message, appended) is
+        called in the background after the mail has been sent and (possibly) appended to INBOX/Sent, see flush
+        """
+        return self._send_executor.submit(self._send, message, append_to_sent, on_sent)
+
+    def submit_mail_template(self, to_user: str, subject: str, template: str, formatted_template=False,
+                             substitution_mapping=None, attachments=None, on_sent=None) -> Future:
+        """like submit, for a mail to another IServ user that uses a plain-text- or html-template as its body"""
+        body = self.render_template(template, formatted_template, substitution_mapping)
+
+        return self.submit(
+            self.create_message(to_user, subject, body, formatted_template, attachments), on_sent=on_sent)
+
+    def shutdown(self) -> None:
+        """waits for all mails to be sent and appended, then terminates the smtp and imap sessions"""
+        self._send_executor.shutdown(wait=True)
+        self._sent_appender.shutdown()
+        self._background_executor.shutdown(wait=True)
+
+        self._smtp_pool.shutdown()
+
+        if self._imap_connection is not None:
+            self._imap_connection.logout()
+            self._imap_connection = None
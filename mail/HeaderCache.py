@@ -0,0 +1,138 @@
+import logging
+from configparser import ConfigParser
+
+from os import makedirs, replace, path
+from threading import get_ident
+from urllib.parse import quote
+
+import json
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# header cache
+# ----------
+
+
+class HeaderCache:
+    """persistent cache of the mail headers and flags of one mailbox, keyed by uid and bound to its uidvalidity
+
+    mails that only have their flags synchronized yet have no header fields (subject, from, date) in the cache
+    """
+    def __init__(self, iserv_username: str, mailbox: str) -> None:
+        cache_directory = f'{config.get("path", "mail_cache", fallback="./data/mail/cache")}/{iserv_username}'
+        makedirs(cache_directory, exist_ok=True)
+
+        # mailbox names may contain slashes and other characters that are not allowed in file names
+        self._cache_file_path = f'{cache_directory}/{quote(mailbox, safe="")}.json'
+
+        self.uidvalidity = None
+        # the mod-sequence up to which the cached flags are known to be up-to-date (condstore)
+        self.highestmodseq = None
+        self.mails = {}
+
+        self.load()
+
+    def load(self) -> None:
+        """loads the cache file of the mailbox if there is one"""
+        if not path.isfile(self._cache_file_path):
+            return
+
+        try:
+            with open(self._cache_file_path, mode='r', encoding='utf-8') as cache_file:
+                cache = json.load(cache_file)
+                cache_file.close()
+        except (OSError, ValueError):
+            logger.exception(f'Failed to load the mail header cache "{self._cache_file_path}". Starting over.')
+            return
+
+        self.uidvalidity = cache.get('uidvalidity')
+        self.highestmodseq = cache.get('highestmodseq')
+        # json only knows string keys
+        self.mails = {int(uid): mail_data for uid, mail_data in cache.get('mails', {}).items()}
+
+    def save(self) -> None:
+        """writes the cache to a new file first and then replaces the old one, so it can not be left half-written"""
+        # several receivers may save the cache of the same mailbox at the same time
+        new_cache_file_path = f'{self._cache_file_path}.{get_ident()}.new'
+
+        with open(new_cache_file_path, mode='w', encoding='utf-8') as new_cache_file:
+            json.dump(
+                {'uidvalidity': self.uidvalidity, 'highestmodseq': self.highestmodseq, 'mails': self.mails},
+                new_cache_file
+            )
+            new_cache_file.close()
+
+        replace(src=new_cache_file_path, dst=self._cache_file_path)
+
+    def validate(self, uidvalidity: int) -> bool:
+        """drops all cached mails if the uids of the mailbox have been reassigned; returns whether it was valid"""
+        if self.uidvalidity == uidvalidity:
+            return True
+
+        if self.uidvalidity is not None:
+            logger.info(f'The UIDVALIDITY of a cached mailbox has changed. Dropping "{self._cache_file_path}".')
+
+        self.uidvalidity = uidvalidity
+        self.highestmodseq = None
+        self.mails = {}
+
+        return False
+
+    @property
+    def highest_uid(self) -> int:
+        return max(self.mails, default=0)
+
+    def has_headers(self, uid: int) -> bool:
+        return 'subject' in self.mails.get(uid, {})
+
+    def has_preview(self, uid: int) -> bool:
+        return 'preview' in self.mails.get(uid, {})
+
+    def unread_uids(self) -> list[int]:
+        """returns the uids of all cached mails whose flags are known and do not include \\Seen, newest first"""
+        return sorted((
+            uid for uid, mail_data in self.mails.items()
+            if 'flags' in mail_data and '\\seen' not in [flag.lower() for flag in mail_data['flags']]
+        ), reverse=True)
+
+    def prune(self, existing_uids: list[int]) -> None:
+        """removes mails that do not exist on the server anymore"""
+        existing_uids = set(existing_uids)
+
+        self.mails = {uid: mail_data for uid, mail_data in self.mails.items() if uid in existing_uids}
+
+    def matches_status(self, mailbox_status: dict) -> bool:
+        """returns whether neither mails nor flags have changed according to a status of the mailbox (condstore)
+
+        mailbox_status: e.g. {'messages': 231, 'uidnext': 4711, 'uidvalidity': 1675209600, 'highestmodseq': 90210}
+        """
+        return (
+            self.uidvalidity is not None
+            and self.uidvalidity == mailbox_status.get('uidvalidity')
+            and self.highestmodseq is not None
+            and self.highestmodseq == mailbox_status.get('highestmodseq')
+            and len(self.mails) == mailbox_status.get('messages')
+            and self.highest_uid < mailbox_status.get('uidnext', 0)
+        )
+
+    def discard(self, uids: list[int]) -> None:
+        """removes the given mails, e.g. the ones the server reported as vanished"""
+        for uid in uids:
+            self.mails.pop(uid, None)
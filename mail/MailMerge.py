@@ -0,0 +1,130 @@
+import logging
+
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from string import Template
+from email.message import Message
+
+import csv
+import smtplib
+
+from mail.Dispatcher import Dispatcher
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# mail merge
+# ----------
+
+
+class MailMerge:
+    """sends the same templated mail to many IServ users, with substitutions of its own for every one of them
+
+    every substitution mapping (e.g. a row of a csv file) needs a to_user; everything in it is substituted in the
+    template and the subject, e.g. $first_name
+
+    the mails are sent through the pooled connections of the dispatcher, at most max_pending of them are created
+    ahead of sending; the dispatcher appends the sent mails to INBOX/Sent in batches
+    """
+    def __init__(self, dispatcher: Dispatcher, subject: str, template: str, formatted_template: bool = False,
+                 attachments: list[str] = None, max_pending: int = 50) -> None:
+        self._dispatcher = dispatcher
+
+        self.subject = Template(subject)
+        self.template = template
+        self.formatted_template = formatted_template
+        self.attachments = attachments or []
+
+        self.max_pending = max_pending
+
+    @staticmethod
+    def read_csv(csv_file_path: str, delimiter: str = ',') -> Iterator[dict]:
+        """reads the substitution mappings from a csv file with a header row, one row at a time"""
+        with open(csv_file_path, mode='r', encoding='utf-8-sig', newline='') as csv_file:
+            yield from csv.DictReader(csv_file, delimiter=delimiter)
+            csv_file.close()
+
+    @staticmethod
+    def write_report(report: list[dict], report_file_path: str) -> None:
+        """writes the report of send to a csv file"""
+        with open(report_file_path, mode='w', encoding='utf-8', newline='') as report_file:
+            csv_writer = csv.DictWriter(report_file, fieldnames=['to_user', 'status', 'appended', 'error'])
+            csv_writer.writeheader()
+            csv_writer.writerows(report)
+            report_file.close()
+
+    def _create_message(self, substitution_mapping: dict) -> Message:
+        return self._dispatcher.create_message(
+            substitution_mapping['to_user'],
+            self.subject.safe_substitute(**substitution_mapping),
+            self._dispatcher.render_template(self.template, self.formatted_template, substitution_mapping),
+            self.formatted_template,
+            self.attachments
+        )
+
+    def send(self, substitution_mappings: Iterable[dict] | str) -> list[dict]:
+        """sends one mail per substitution mapping (or row of a csv file, if a path is given)
+
+        returns a report with one entry per mapping, in the same order:
+        {'to_user': ..., 'status': 'sent' or 'failed', 'appended': whether it is in INBOX/Sent, 'error': ...}
+        """
+        if isinstance(substitution_mappings, str):
+            substitution_mappings = self.read_csv(substitution_mappings)
+
+        report = []
+        # future of a mail that is being sent: its report entry
+        pending = {}
+
+        def collect(done: set[Future]) -> None:
+            for future in done:
+                entry = pending.pop(future)
+
+                try:
+                    if refused_recipients := future.result():
+                        raise smtplib.SMTPRecipientsRefused(refused_recipients)
+                except (smtplib.SMTPException, OSError) as error:
+                    entry['status'], entry['error'] = 'failed', str(error) or type(error).__name__
+                    continue
+
+                entry['status'] = 'sent'
+
+        for substitution_mapping in substitution_mappings:
+            entry = {'to_user': substitution_mapping.get('to_user') or '', 'status': 'pending', 'appended': False,
+                     'error': ''}
+            report.append(entry)
+
+            if not entry['to_user']:
+                entry['status'], entry['error'] = 'failed', 'no to_user'
+                continue
+
+            try:
+                message = self._create_message(substitution_mapping)
+            except OSError as error:
+                # e.g. a missing template or attachment
+                entry['status'], entry['error'] = 'failed', str(error)
+                continue
+
+            # called in the background once the mail has been appended to INBOX/Sent (or has failed to)
+            def on_sent(message: Message, appended: bool, entry: dict = entry) -> None:
+                entry['appended'] = appended
+
+            pending[self._dispatcher.submit(message, on_sent=on_sent)] = entry
+
+            if len(pending) >= self.max_pending:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        collect(wait(pending).done)
+        self._dispatcher.flush()
+
+        logger.info(f'Mail merge "{self.subject.template}": '
+                    f'{sum(entry["status"] == "sent" for entry in report)} of {len(report)} mails sent.')
+
+        return report
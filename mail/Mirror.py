@@ -0,0 +1,294 @@
+import logging
+from configparser import ConfigParser
+
+from os import makedirs, replace, remove, utime, listdir, path, name as os_name
+from datetime import datetime
+from threading import get_ident
+from urllib.parse import quote
+
+from email import message_from_bytes
+from email.message import Message
+import hashlib
+import gzip
+import json
+
+from mail.ReceiverPool import ReceiverPool
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# mirror
+# ----------
+
+
+# the flags of a mail are part of its file name in a maildir, e.g. "...:2,FS" for a flagged mail that has been read
+_maildir_flags = {'\\draft': 'D', '\\flagged': 'F', '\\answered': 'R', '\\seen': 'S', '\\deleted': 'T'}
+
+# colons are not allowed in file names on windows; the mailbox module of the standard library uses "!" there as well
+_maildir_info_separator = '!' if os_name == 'nt' else ':'
+
+
+class Mirror:
+    """keeps a local copy of all mailboxes of a user in maildirs, e.g. for searching and retention
+
+    {mail_mirror}/{user}/maildir/{mailbox}/(cur|new|tmp) - the mails, their file names contain uidvalidity and uid
+    {mail_mirror}/{user}/attachments/{sha256[:2]}/{sha256}(.gz) - attachments, stored once no matter how often sent
+    {mail_mirror}/{user}/state/{mailbox}.json - uidvalidity, the highest mirrored uid and mod-sequence (or the number of
+    mails and next uid, without condstore) of every mailbox
+
+    every run only downloads mails with a higher uid than the ones mirrored already and can be interrupted at any time;
+    mails that are deleted on the server are kept
+    """
+    def __init__(self, iserv_username: str, iserv_password: str, compress_attachments: bool = False,
+                 max_connections: int = 4) -> None:
+        self._mirror_directory = f'{config.get("path", "mail_mirror", fallback="./data/mail/mirror")}/{iserv_username}'
+        self._attachment_directory = f'{self._mirror_directory}/attachments'
+        self._state_directory = f'{self._mirror_directory}/state'
+
+        makedirs(self._attachment_directory, exist_ok=True)
+        makedirs(self._state_directory, exist_ok=True)
+
+        self._compress_attachments = compress_attachments
+
+        self._mail_receiver_pool = ReceiverPool(iserv_username, iserv_password, max_size=max_connections)
+
+    def shutdown(self) -> None:
+        """closes all connections and logs out"""
+        self._mail_receiver_pool.shutdown()
+
+    def mirror(self, selections: list[str] = None) -> dict[str, int]:
+        """mirrors the given mailboxes (all of them by default) in parallel; returns the number of new mails of each"""
+        with self._mail_receiver_pool.receiver() as mail_receiver:
+            # one round trip tells which mailboxes have new mails at all
+            mailbox_overview = mail_receiver.mailbox_overview()
+
+        if selections is None:
+            selections = list(mailbox_overview)
+
+        selections = [selection for selection in selections if selection in mailbox_overview]
+
+        return dict(zip(selections, self._mail_receiver_pool.map(
+            lambda mail_receiver, selection: self._mirror_mailbox(
+                mail_receiver, selection, mailbox_overview[selection]),
+            selections
+        )))
+
+    def _mirror_mailbox(self, mail_receiver, selection: str, mailbox_status: dict) -> int:
+        """downloads the new mails of a mailbox and updates the flags of the mirrored ones"""
+        state = self._load_state(selection)
+
+        if state.get('uidvalidity') != mailbox_status['uidvalidity']:
+            # the uids have been reassigned, start over; the old mails stay, their file names differ by the uidvalidity
+            state = {'uidvalidity': mailbox_status['uidvalidity'], 'last_uid': 0}
+
+        maildir = self._create_maildir(selection)
+        mail_files = self._index_mail_files(maildir, state['uidvalidity'])
+
+        number_of_new_mails = 0
+        if mailbox_status['uidnext'] - 1 > state['last_uid']:
+            selection, new_mail_uids = mail_receiver.get_uids_of_new_mails(selection, state['last_uid'])
+
+            for mail_uid, flags, internal_date, raw_mail in mail_receiver.raw_mails_by_uids(selection, new_mail_uids):
+                self._store_mail(maildir, mail_files, state['uidvalidity'], mail_uid, flags, internal_date, raw_mail)
+
+                # saved after every mail, so an interrupted run continues where it stopped
+                state['last_uid'] = mail_uid
+                self._save_state(selection, state)
+
+                number_of_new_mails += 1
+
+        # only changed flags are transferred if the server supports condstore; the mirror keeps a mod-sequence of its
+        # own, the one of the header cache may be ahead of it
+        if mailbox_status.get('highestmodseq') is not None:
+            flags_may_have_changed = mailbox_status['highestmodseq'] != state.get('highestmodseq')
+        else:
+            # without condstore, the flags of all mails are fetched, but only if mails have been added or removed;
+            # changes of the flags alone are mirrored along with the next change of the mailbox
+            flags_may_have_changed = (mailbox_status['messages'], mailbox_status['uidnext']) \
+                                     != (state.get('messages'), state.get('uidnext'))
+
+        if flags_may_have_changed and (
+                changed := mail_receiver.flags_changed_since(selection, state.get('highestmodseq'))) is not None:
+            state['highestmodseq'], changed_flags = changed
+
+            for mail_uid, flags in changed_flags:
+                if mail_uid <= state['last_uid']:
+                    self._update_flags(maildir, mail_files, state['uidvalidity'], mail_uid, flags)
+
+            # the status the flags have been mirrored at; if they could not be fetched, they are fetched next time
+            state['messages'], state['uidnext'] = mailbox_status['messages'], mailbox_status['uidnext']
+
+        self._save_state(selection, state)
+
+        return number_of_new_mails
+
+    # ----------
+    # state
+    # ----------
+
+    def _state_file_path(self, selection: str) -> str:
+        # mailbox names may contain slashes and other characters that are not allowed in file names
+        return f'{self._state_directory}/{quote(selection, safe="")}.json'
+
+    def _load_state(self, selection: str) -> dict:
+        if not path.isfile(state_file_path := self._state_file_path(selection)):
+            return {}
+
+        try:
+            with open(state_file_path, mode='r', encoding='utf-8') as state_file:
+                state = json.load(state_file)
+                state_file.close()
+        except (OSError, ValueError):
+            logger.exception(f'Failed to load the mirror state "{state_file_path}". Mirroring the mailbox again.')
+            return {}
+
+        return state
+
+    def _save_state(self, selection: str, state: dict) -> None:
+        state_file_path = self._state_file_path(selection)
+        new_state_file_path = f'{state_file_path}.{get_ident()}.new'
+
+        with open(new_state_file_path, mode='w', encoding='utf-8') as new_state_file:
+            json.dump(state, new_state_file)
+            new_state_file.close()
+
+        replace(src=new_state_file_path, dst=state_file_path)
+
+    # ----------
+    # maildir
+    # ----------
+
+    def _create_maildir(self, selection: str) -> str:
+        maildir = f'{self._mirror_directory}/maildir/{quote(selection, safe="")}'
+
+        for sub_directory in ('cur', 'new', 'tmp'):
+            makedirs(f'{maildir}/{sub_directory}', exist_ok=True)
+
+        return maildir
+
+    @staticmethod
+    def _mail_file_name(uidvalidity: int, mail_uid: int, flags: list[str]) -> str:
+        # the same mail always gets the same name (apart from its flags), so mirroring it again overwrites it
+        maildir_flags = ''.join(sorted(
+            _maildir_flags[str(flag).lower()] for flag in flags if str(flag).lower() in _maildir_flags))
+
+        return f'{uidvalidity}.{mail_uid}.iscra{_maildir_info_separator}2,{maildir_flags}'
+
+    @staticmethod
+    def _index_mail_files(maildir: str, uidvalidity: int) -> dict[int, str]:
+        """returns the file names of the mirrored mails with the given uidvalidity by their uids"""
+        mail_files = {}
+        for file_name in listdir(f'{maildir}/cur'):
+            file_uidvalidity, mail_uid, rest = file_name.split('.', 2) if file_name.count('.') >= 2 else ('', '', '')
+
+            if file_uidvalidity == str(uidvalidity) and mail_uid.isdigit() and rest.startswith('iscra'):
+                mail_files[int(mail_uid)] = file_name
+
+        return mail_files
+
+    def _store_mail(self, maildir: str, mail_files: dict[int, str], uidvalidity: int, mail_uid: int, flags: list[str],
+                    internal_date: str | None, raw_mail: bytes) -> None:
+        """writes a mail to the maildir, after its attachments have been moved to the attachment store"""
+        message = message_from_bytes(raw_mail)
+
+        attachments = [
+            part for part in message.walk()
+            if not part.is_multipart() and (part.get_content_disposition() == 'attachment' or part.get_filename())
+        ]
+        for part in attachments:
+            self._externalize_attachment(part)
+
+        if attachments:
+            raw_mail = message.as_bytes()
+
+        if old_file_name := mail_files.pop(mail_uid, None):
+            # left over from an interrupted run
+            remove(f'{maildir}/cur/{old_file_name}')
+
+        file_name = mail_files[mail_uid] = self._mail_file_name(uidvalidity, mail_uid, flags)
+
+        # maildir: written to tmp first and then moved, so no other program ever sees half a mail
+        with open(f'{maildir}/tmp/{file_name}', mode='wb') as mail_file:
+            mail_file.write(raw_mail)
+            mail_file.close()
+
+        replace(src=f'{maildir}/tmp/{file_name}', dst=f'{maildir}/cur/{file_name}')
+
+        if internal_date:
+            # maildir readers use the modification time as the date the mail has been received at
+            try:
+                received = datetime.strptime(internal_date, '%d-%b-%Y %H:%M:%S %z').timestamp()
+                utime(f'{maildir}/cur/{file_name}', (received, received))
+            except ValueError:
+                pass
+
+    def _update_flags(self, maildir: str, mail_files: dict[int, str], uidvalidity: int, mail_uid: int,
+                      flags: list[str]) -> None:
+        if not (old_file_name := mail_files.get(mail_uid)):
+            return
+
+        if (new_file_name := self._mail_file_name(uidvalidity, mail_uid, flags)) != old_file_name:
+            replace(src=f'{maildir}/cur/{old_file_name}', dst=f'{maildir}/cur/{new_file_name}')
+            mail_files[mail_uid] = new_file_name
+
+    # ----------
+    # attachments
+    # ----------
+
+    def _externalize_attachment(self, part: Message) -> None:
+        """stores the content of an attachment by its hash and replaces it with a reference (message/external-body)"""
+        data = part.get_payload(decode=True) or b''
+        digest = hashlib.sha256(data).hexdigest()
+
+        self._store_attachment(digest, data)
+
+        # the headers of the original content are the body of an external-body part (rfc 2046)
+        content_headers = [
+            (key, value) for key, value in part.items()
+            if key.lower().startswith('content-') and key.lower() != 'content-disposition'
+        ]
+        for key in {key for key, value in content_headers}:
+            del part[key]
+
+        part['Content-Type'] = f'message/external-body; access-type="x-iscra-sha256"; ' \
+                               f'sha256="{digest}"; size={len(data)}'
+        part.set_payload(''.join(f'{key}: {value}\n' for key, value in content_headers) + '\n')
+
+    def _store_attachment(self, digest: str, data: bytes) -> None:
+        directory = f'{self._attachment_directory}/{digest[:2]}'
+        file_path = f'{directory}/{digest}'
+
+        if path.isfile(file_path) or path.isfile(f'{file_path}.gz'):
+            # the same content has been mirrored before
+            return
+
+        makedirs(directory, exist_ok=True)
+
+        if self._compress_attachments:
+            file_path += '.gz'
+            data = gzip.compress(data)
+
+        # other threads may store the same attachment at the same time
+        new_file_path = f'{file_path}.{get_ident()}.new'
+
+        with open(new_file_path, mode='wb') as attachment_file:
+            attachment_file.write(data)
+            attachment_file.close()
+
+        replace(src=new_file_path, dst=file_path)
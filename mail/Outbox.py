@@ -0,0 +1,159 @@
+import logging
+from configparser import ConfigParser
+
+from os import makedirs, path
+from threading import Lock
+from time import time
+from email import message_from_bytes
+from email.message import Message
+
+import sqlite3
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# outbox
+# ----------
+
+
+class Outbox:
+    """a journal of the mails that are to be sent, so that no mail is lost or sent twice if the process dies
+
+    every mail goes through the states queued -> sent -> appended (to INBOX/Sent), or ends up as failed once it has
+    been retried too often; the Message-ID of a mail is its key, so queueing the same mail again changes nothing
+
+    a mail that was being handed over to the smtp server when the process died is still queued and sent again,
+    with the same Message-ID, so mail clients show it only once
+    """
+    def __init__(self, database_path: str = None) -> None:
+        schedule_directory = config.get('path', 'mail_schedule', fallback='./data/mail/schedule')
+
+        self._database_path = database_path or f'{schedule_directory}/outbox.sqlite3'
+        makedirs(path.dirname(self._database_path) or '.', exist_ok=True)
+
+        # the retries of a failed mail are delayed by retry_delay seconds, twice as long every time
+        self.retries = config.getint('dispatch', 'retries', fallback=5)
+        self.retry_delay = config.getfloat('dispatch', 'retry_delay', fallback=60)
+
+        # used by the dispatcher threads as well
+        self._connection = sqlite3.connect(self._database_path, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = Lock()
+
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode = WAL')
+            self._connection.execute('PRAGMA synchronous = NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS outbox ('
+                'id INTEGER PRIMARY KEY, '
+                'message_id TEXT NOT NULL UNIQUE, '
+                'state TEXT NOT NULL, '
+                'attempts INTEGER NOT NULL DEFAULT 0, '
+                'next_attempt REAL NOT NULL, '
+                'updated REAL NOT NULL, '
+                'error TEXT, '
+                'message BLOB NOT NULL)'
+            )
+            # the mails to send next are always the first ones in the index
+            self._connection.execute('CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, next_attempt)')
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    # ----------
+    # queueing
+    # ----------
+
+    def enqueue(self, message: Message) -> bool:
+        """stores a mail with a Message-ID to be sent; returns False if a mail with its Message-ID is known already"""
+        if not message['Message-ID']:
+            raise ValueError('A mail needs a Message-ID to be put into the outbox.')
+
+        with self._lock, self._connection:
+            return self._connection.execute(
+                'INSERT OR IGNORE INTO outbox (message_id, state, next_attempt, updated, message) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (message['Message-ID'], 'queued', time(), time(), message.as_bytes())
+            ).rowcount == 1
+
+    def _mails(self, query: str, parameters: tuple = ()) -> list[tuple[str, Message]]:
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+
+        return [(row['message_id'], message_from_bytes(row['message'])) for row in rows]
+
+    def due(self) -> list[tuple[str, Message]]:
+        """returns the Message-IDs and mails that are to be sent (again) now, oldest first"""
+        return self._mails(
+            "SELECT message_id, message FROM outbox WHERE state = 'queued' AND next_attempt <= ? ORDER BY next_attempt",
+            (time(),))
+
+    def unappended(self) -> list[tuple[str, Message]]:
+        """returns the mails that have been sent but not appended to INBOX/Sent, e.g. because the process died"""
+        return self._mails("SELECT message_id, message FROM outbox WHERE state = 'sent' ORDER BY id")
+
+    def next_attempt(self) -> float | None:
+        """returns the unix timestamp the next mail is to be sent at, None if there is none"""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT MIN(next_attempt) FROM outbox WHERE state = 'queued'").fetchone()[0]
+
+    # ----------
+    # states
+    # ----------
+
+    def mark_as_sent(self, message_id: str) -> None:
+        with self._lock, self._connection:
+            # the mail may have been appended in the background already
+            self._connection.execute(
+                "UPDATE outbox SET state = 'sent', updated = ? WHERE message_id = ? AND state = 'queued'",
+                (time(), message_id))
+
+    def mark_as_appended(self, message_id: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE outbox SET state = 'appended', updated = ? WHERE message_id = ?", (time(), message_id))
+
+    def mark_as_failed(self, message_id: str, error: str, retry: bool = True) -> bool:
+        """schedules another attempt with exponential backoff; returns False if the mail has finally failed"""
+        with self._lock, self._connection:
+            if (row := self._connection.execute(
+                    'SELECT attempts FROM outbox WHERE message_id = ?', (message_id,)).fetchone()) is None:
+                return False
+
+            attempts = row['attempts'] + 1
+            failed = not retry or attempts > self.retries
+
+            self._connection.execute(
+                'UPDATE outbox SET state = ?, attempts = ?, next_attempt = ?, updated = ?, error = ? '
+                'WHERE message_id = ?',
+                (
+                    'failed' if failed else 'queued', attempts, time() + self.retry_delay * 2 ** (attempts - 1),
+                    time(), error, message_id
+                )
+            )
+
+        return not failed
+
+    def purge(self, older_than: float = 30 * 24 * 60 * 60) -> int:
+        """forgets mails that have been appended to INBOX/Sent a while ago; returns how many"""
+        with self._lock, self._connection:
+            return self._connection.execute(
+                "DELETE FROM outbox WHERE state = 'appended' AND updated < ?", (time() - older_than,)).rowcount
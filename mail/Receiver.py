@@ -2,11 +2,16 @@ import logging
 from configparser import ConfigParser
 
 import re
+from os import remove
+from collections.abc import Iterator
+from threading import Event, Lock, Timer
 
-from email.header import make_header, decode_header
-from email import message_from_bytes
 import imaplib
 
+from mail import util
+from mail.connection import IMAP4, connect_imap, connect_with_backoff
+from mail.HeaderCache import HeaderCache
+
 
 # ----------
 # logger
@@ -30,43 +35,149 @@ config.read('config.ini', encoding='utf-8')
 # ----------
 
 
+# e.g. b'* 12 EXISTS' or b'* 3 FETCH (FLAGS (\\Seen))' or b'* VANISHED 5:7'
+untagged_response_pattern = re.compile(rb'\* (?:(?P<number>\d+) )?(?P<type>[A-Z-]+)(?: (?P<data>.*))?')
+
+
 class Receiver:
     """a simple mailer for IServ using smtp and imap"""
     def __init__(self, iserv_username: str, iserv_password: str) -> None:
-        # establish connections and login
-        self._imap_connection = imaplib.IMAP4(host=config["server"]["domain"], port=int(config["port"]["imap"]))
-        self._imap_connection.starttls()
-        self._imap_connection.login(user=iserv_username, password=iserv_password)
+        self._iserv_username = iserv_username
+        # kept to log in again if the connection is dropped
+        self._iserv_password = iserv_password
 
         self._current_selection = None
         self._current_selection_is_readonly = None
+        self._current_uidvalidity = None
+        self._current_highestmodseq = None
+
+        # state of a running IDLE command, which can be ended from another thread
+        self._idle_lock = Lock()
+        self._idle_tag = None
+        self._idling = False
+        self._idle_done_sent = False
+        self._idle_wakeup = Event()
+
+        # establish connections and login; compressed if the server supports it
+        self._connection = connect_imap(iserv_username, iserv_password)
+
+        # servers usually advertise extensions like condstore only after the login
+        self._capabilities = self._fetch_capabilities()
+        self._condstore_enabled, self._qresync_enabled = self._enable_condstore()
 
     def shutdown(self) -> None:
         """close all connections and logout"""
-        if self._imap_connection.state == 'SELECTED':
+        if self._connection.dropped:
+            return
+
+        if self._connection.state == 'SELECTED':
             # performs the same actions as imaplib.IMAP4.close(),
             # except that no messages are permanently removed from the currently selected mailbox
-            self._imap_connection.unselect()
+            self._connection.unselect()
 
-        self._imap_connection.logout()  # includes imaplib.IMAP4.shutdown()
+        self._connection.logout()  # includes imaplib.IMAP4.shutdown()
+
+    # ----------
+    # keepalive
+    # ----------
+
+    @property
+    def _imap_connection(self) -> IMAP4:
+        """the imap connection, checked before every command (see keepalive)"""
+        self.keepalive()
+
+        return self._connection
+
+    def is_alive(self) -> bool:
+        """checks the connection with a NOOP, without connecting again; False if it has been dropped"""
+        return self._idle_tag is None and self._connection.is_alive()
+
+    def keepalive(self) -> None:
+        """sends a NOOP if the connection has not been used for a while and connects again if it has been dropped
+
+        happens before every command anyway; long-running processes call it regularly to keep the connection alive
+        """
+        # while idling, the connection is busy waiting for the server, which keeps it alive
+        if self._idle_tag is not None or not self._connection.needs_check() or self._connection.is_alive():
+            return
+
+        logger.warning('The imap connection has been dropped, connecting again.')
+
+        try:
+            self._connection.shutdown()
+        except OSError:
+            pass
+
+        self._connection = connect_with_backoff(
+            lambda: connect_imap(self._iserv_username, self._iserv_password), 'the imap server')
+        self._capabilities = self._fetch_capabilities()
+        self._condstore_enabled, self._qresync_enabled = self._enable_condstore()
+
+        # the new connection has no mailbox selected yet; the header caches notice if the uidvalidity has changed
+        selection, readonly = self._current_selection, self._current_selection_is_readonly
+        self._current_selection = self._current_selection_is_readonly = None
+
+        if selection is not None:
+            self.change_selection_if_necessary(selection, readonly=readonly)
+
+    def _fetch_capabilities(self) -> tuple[str]:
+        """returns the current capabilities of the server"""
+        # already brought up to date by the login (mail.connection.IMAP4)
+        return tuple(self._connection.capabilities)
+
+    def _enable_condstore(self) -> tuple[bool, bool]:
+        """enables qresync (which includes condstore) or only condstore if the server supports it
+
+        returns whether condstore and qresync are enabled
+        """
+        for extension in ('QRESYNC', 'CONDSTORE'):
+            if extension not in self._capabilities or 'ENABLE' not in self._capabilities:
+                continue
+
+            status, response = self._connection.enable(extension)
+
+            if status.lower() == 'ok':
+                return True, extension == 'QRESYNC'
+
+            logger.warning(f'The imap server advertises {extension}, but failed to enable it.')
+
+        # a server that supports condstore, but not enable, turns it on with the first command that uses it
+        return 'CONDSTORE' in self._capabilities, False
 
     # ----------
     # receiving mails using imap
     # ----------
 
     def change_selection_if_necessary(self, new_selection: str, readonly: bool = True):
-        if (self._current_selection == new_selection) and (self._current_selection_is_readonly == readonly):
+        # a mailbox selected for writing serves reading as well, mails are only ever fetched with BODY.PEEK
+        if (self._current_selection == new_selection) and (self._current_selection_is_readonly in (readonly, False)):
             return
 
-        if self._imap_connection.state == 'SELECTED':
-            self._imap_connection.close()
-
+        # no CLOSE beforehand: selecting another mailbox leaves the current one as well, but without expunging it
         status, response = self._imap_connection.select(new_selection, readonly=readonly)
         self._current_selection, self._current_selection_is_readonly = new_selection, readonly
+        self._remember_selection_state()
 
         if status.lower() != 'ok':
             logger.exception(f'Failed to select mailbox {new_selection}.')
 
+    def _remember_selection_state(self) -> None:
+        """keeps the uidvalidity and highest mod-sequence the server reported when the mailbox was selected
+
+        called right after every select
+        """
+        code, data = self._imap_connection.response('UIDVALIDITY')
+        self._current_uidvalidity = int(data[-1]) if data[-1] else None
+
+        # only sent if condstore is enabled and the mailbox supports mod-sequences (no NOMODSEQ)
+        code, data = self._imap_connection.response('HIGHESTMODSEQ')
+        self._current_highestmodseq = int(data[-1]) if data[-1] else None
+
+        # the state of the mailbox the server reported when it was selected is not a change, it must not be taken
+        # for one by idle (or a poll)
+        for response_type in ('EXISTS', 'RECENT', 'EXPUNGE', 'FETCH', 'VANISHED'):
+            self._imap_connection.untagged_responses.pop(response_type, None)
+
     def get_available_mailboxes(self) -> [(str, str, str)] or []:
         """returns a list of all available mailboxes"""
         status, response = self._imap_connection.list()
@@ -87,6 +198,50 @@ class Receiver:
 
         return mailboxes
 
+    def mailbox_overview(self) -> dict[str, dict[str, int]]:
+        """returns the number of mails, unread mails, the next uid and the uidvalidity of all mailboxes at once
+
+        e.g. {'INBOX': {'messages': 231, 'unseen': 3, 'uidnext': 4711, 'uidvalidity': 1675209600}, ...}
+        with condstore, the highest mod-sequence ('highestmodseq') is included as well
+        no mailbox has to be selected for that
+        """
+        status_items = 'MESSAGES UNSEEN UIDNEXT UIDVALIDITY' + (' HIGHESTMODSEQ' if self._condstore_enabled else '')
+
+        if 'LIST-STATUS' in self._capabilities:
+            # checked once, the responses are read from the connection the command has been sent over
+            imap_connection = self._imap_connection
+
+            # a single command: the server sends a STATUS response after the LIST response of every mailbox
+            status, response = imap_connection._simple_command(
+                'LIST', '""', '*', 'RETURN', f'(STATUS ({status_items}))')
+            imap_connection.response('LIST')
+
+            if status.lower() == 'ok':
+                return util.parse_status_response(imap_connection.response('STATUS')[1])
+
+            logger.warning('The imap server advertises LIST-STATUS, but failed to list the mailboxes with it.')
+
+        mailboxes = [
+            mailbox_name for flags, delimiter, mailbox_name in self.get_available_mailboxes()
+            if '\\noselect' not in flags.lower()
+        ]
+
+        # checked once: the pipelined commands are all sent and completed over the same connection
+        imap_connection = self._imap_connection
+
+        # pipelining: all STATUS commands are sent before the first answer is read, so there is only one round trip
+        tags = [
+            imap_connection._command('STATUS', util.quote(mailbox_name), f'({status_items})')
+            for mailbox_name in mailboxes
+        ]
+        for mailbox_name, tag in zip(mailboxes, tags):
+            status, response = imap_connection._command_complete('STATUS', tag)
+
+            if status.lower() != 'ok':
+                logger.warning(f'Failed to get the status of mailbox {mailbox_name}.')
+
+        return util.parse_status_response(imap_connection.response('STATUS')[1])
+
     def get_ids_of_unread_mails(self, selection: str = 'INBOX', max_amount=None) -> (str, [str] or []):
         """checks the inbox for unread mails and returns a list of their ids"""
         self.change_selection_if_necessary(selection, readonly=True)
@@ -112,6 +267,7 @@ class Receiver:
         """checks the inbox for unread mails and returns a list of their ids"""
         status, response = self._imap_connection.select(selection, readonly=True)
         self._current_selection, self._current_selection_is_readonly = selection, True
+        self._remember_selection_state()
 
         if status.lower() != 'ok':
             logger.exception(f'Failed to select mailbox {selection}.')
@@ -127,6 +283,250 @@ class Receiver:
         # therefore, turn the ids into string
         return selection, [str(mail_id) for mail_id in range(number_of_mails, (number_of_mails - max_amount), -1)]
 
+    def _search_uids(self, selection: str, criteria: str, max_amount=None) -> (str, [int] or []):
+        """searches a mailbox and returns the uids of the matching mails, newest first"""
+        self.change_selection_if_necessary(selection, readonly=True)
+
+        status, response = self._imap_connection.uid('SEARCH', None, criteria)
+
+        if status.lower() != 'ok':
+            logger.error(f'Failed to search mailbox {selection} for {criteria}.')
+            return selection, []
+
+        mail_uids = []
+        for mail_uid_block in response:
+            if mail_uid_block:
+                mail_uids += [int(mail_uid) for mail_uid in mail_uid_block.decode().split()]
+
+        # unlike sequence numbers, uids do not change when other mails are deleted
+        mail_uids.sort(reverse=True)
+
+        return selection, mail_uids[0:max_amount]
+
+    def get_uids_of_unread_mails(
+            self, selection: str = 'INBOX', max_amount=None, mailbox_status: dict = None
+    ) -> (str, [int] or []):
+        """checks a mailbox for unread mails and returns a list of their uids, newest first
+
+        mailbox_status is the status of the mailbox from mailbox_overview, if it has just been requested
+        """
+        if self._condstore_enabled:
+            # the locally cached flags are brought up to date, instead of searching the whole mailbox again
+            header_cache, changed_flags = self._synchronize_flags(selection, mailbox_status)
+
+            if header_cache is not None:
+                return selection, header_cache.unread_uids()[0:max_amount]
+
+        return self._search_uids(selection, '(UNSEEN)', max_amount)
+
+    def get_uids_of_mails(
+            self, selection: str = 'INBOX', max_amount=None, mailbox_status: dict = None
+    ) -> (str, [int] or []):
+        """returns a list of the uids of all mails in a mailbox, newest first"""
+        if self._condstore_enabled:
+            header_cache, changed_flags = self._synchronize_flags(selection, mailbox_status)
+
+            if header_cache is not None:
+                return selection, sorted(header_cache.mails, reverse=True)[0:max_amount]
+
+        return self._search_uids(selection, 'ALL', max_amount)
+
+    def search(self, selections: list[str] = None, **criteria) -> list[tuple[str, int]]:
+        """searches mailboxes on the server and returns (mailbox, uid) tuples of the matching mails, newest first
+
+        the criteria are the keyword arguments of mail.util.search_criteria, e.g. subject='Klausur', unread=True
+        all selectable mailboxes are searched if no selections are given
+        """
+        if selections is None:
+            selections = [
+                mailbox_name for flags, delimiter, mailbox_name in self.get_available_mailboxes()
+                if '\\noselect' not in flags.lower()
+            ]
+
+        results = []
+        for selection in selections:
+            results += [(selection, mail_uid) for mail_uid in self.search_mailbox(selection, **criteria)]
+
+        return results
+
+    def search_mailbox(self, selection: str = 'INBOX', **criteria) -> list[int]:
+        """searches one mailbox on the server and returns the uids of the matching mails, newest first"""
+        criteria = util.search_criteria(**criteria)
+
+        # ascii can be sent as quoted strings, everything else (e.g. umlauts) has to be sent as an utf-8 literal
+        inline_criteria = [
+            search_key if value is None else f'{search_key} {util.quote(value)}'
+            for search_key, value in criteria if value is None or value.isascii()
+        ]
+        literal_criteria = [(search_key, value) for search_key, value in criteria if value and not value.isascii()]
+
+        if not literal_criteria:
+            return self._search_uids(selection, f'({" ".join(inline_criteria) or "ALL"})')[1]
+
+        # imaplib supports only one literal per command, which has to be the last argument
+        # therefore, search once per literal and keep the mails that matched all of the searches
+        self.change_selection_if_necessary(selection, readonly=True)
+
+        matching_uids = None
+        for search_key, value in literal_criteria:
+            self._imap_connection.literal = value.encode('utf-8')
+            status, response = self._imap_connection.uid('SEARCH', 'CHARSET', 'UTF-8', *inline_criteria, search_key)
+
+            if status.lower() != 'ok':
+                logger.error(f'Failed to search mailbox {selection} for {search_key}.')
+                return []
+
+            mail_uids = {int(mail_uid) for mail_uid_block in response if mail_uid_block
+                         for mail_uid in mail_uid_block.decode().split()}
+            matching_uids = mail_uids if matching_uids is None else matching_uids & mail_uids
+
+        return sorted(matching_uids, reverse=True)
+
+    def get_uids_of_new_mails(self, selection: str = 'INBOX', above_uid: int = 0) -> (str, [int] or []):
+        """returns the uids of all mails in a mailbox whose uid is higher than the given one, newest first"""
+        selection, mail_uids = self._search_uids(selection, f'UID {above_uid + 1}:*')
+
+        # "n:*" always includes the mail with the highest uid, even if that one is lower than n
+        return selection, [mail_uid for mail_uid in mail_uids if mail_uid > above_uid]
+
+    def sync_flags(self, selection: str = 'INBOX') -> list[tuple[int, list[str]]]:
+        """returns the uids and flags of all mails whose flags have changed since the last synchronization
+
+        on the first synchronization of a mailbox (or without condstore), all mails are considered changed
+        """
+        header_cache, changed_flags = self._synchronize_flags(selection)
+
+        return changed_flags
+
+    def flags_changed_since(
+            self, selection: str, modseq: int | None
+    ) -> tuple[int | None, list[tuple[int, list[str]]]] | None:
+        """returns the highest mod-sequence of a mailbox and the uids and flags of all mails changed since the given one
+
+        all mails are considered changed if no mod-sequence is given or the server does not support condstore; unlike
+        sync_flags, the header cache is left alone, so every caller can keep a mod-sequence of its own
+        returns None if the flags could not be fetched, the caller keeps its mod-sequence then
+        """
+        # select again, even if the mailbox is selected already, to learn about its current highest mod-sequence
+        # a mailbox selected for writing stays selected for writing
+        readonly = not (self._current_selection == selection and self._current_selection_is_readonly is False)
+
+        status, response = self._imap_connection.select(selection, readonly=readonly)
+        self._current_selection, self._current_selection_is_readonly = selection, readonly
+        self._remember_selection_state()
+
+        if status.lower() != 'ok':
+            logger.error(f'Failed to select mailbox {selection}.')
+            return None
+
+        # changes after the select are fetched once more next time at worst
+        highestmodseq = self._current_highestmodseq
+
+        if not int(response[0]) or (modseq is not None and modseq == highestmodseq):
+            return highestmodseq, []
+
+        fetch_arguments = ('1:*', '(UID FLAGS)')
+        if modseq is not None and highestmodseq is not None:
+            fetch_arguments += (f'(CHANGEDSINCE {modseq})',)
+
+        status, response = self._imap_connection.uid('FETCH', *fetch_arguments)
+
+        if status.lower() != 'ok':
+            logger.error(f'Failed to fetch the flags of the mails in mailbox {selection}.')
+            return None
+
+        return highestmodseq, [
+            (data_items['UID'], data_items.get('FLAGS', []))
+            for mail_id, data_items in util.parse_fetch_response(response) if 'UID' in data_items
+        ]
+
+    def _synchronize_flags(
+            self, selection: str, mailbox_status: dict = None
+    ) -> tuple[HeaderCache | None, list[tuple[int, list[str]]]]:
+        """brings the flags in the header cache of a mailbox up to date, using condstore and qresync if possible
+
+        if a fresh status of the mailbox (from mailbox_overview) shows that nothing has changed, it is not even selected
+        """
+        if mailbox_status is not None:
+            header_cache = HeaderCache(self._iserv_username, selection)
+
+            if header_cache.matches_status(mailbox_status):
+                return header_cache, []
+
+        # select again, even if the mailbox is selected already, to learn about its current highest mod-sequence
+        # a mailbox selected for writing stays selected for writing
+        readonly = not (self._current_selection == selection and self._current_selection_is_readonly is False)
+
+        status, response = self._imap_connection.select(selection, readonly=readonly)
+        self._current_selection, self._current_selection_is_readonly = selection, readonly
+        self._remember_selection_state()
+
+        if status.lower() != 'ok':
+            logger.error(f'Failed to select mailbox {selection}.')
+            return None, []
+
+        number_of_mails = int(response[0])
+
+        header_cache = HeaderCache(self._iserv_username, selection)
+        header_cache.validate(self._current_uidvalidity)
+
+        if (
+                header_cache.highestmodseq is not None
+                and header_cache.highestmodseq == self._current_highestmodseq
+                and len(header_cache.mails) == number_of_mails
+        ):
+            # nothing has changed since the last synchronization, not even a single flag
+            return header_cache, []
+
+        full_synchronization = (header_cache.highestmodseq is None) or (self._current_highestmodseq is None)
+
+        if full_synchronization:
+            # (re)build: the flags of all mails
+            fetch_arguments = ('1:*', '(UID FLAGS)')
+        else:
+            # only mails whose mod-sequence is higher than the last known one, including new mails
+            # with qresync, the uids of mails that have been deleted in the meantime are reported as well
+            fetch_arguments = (
+                '1:*', '(UID FLAGS)',
+                f'(CHANGEDSINCE {header_cache.highestmodseq}{" VANISHED" if self._qresync_enabled else ""})'
+            )
+
+        changed_flags = []
+        if number_of_mails:
+            status, response = self._imap_connection.uid('FETCH', *fetch_arguments)
+
+            if status.lower() != 'ok':
+                logger.error(f'Failed to fetch the flags of the mails in mailbox {selection}.')
+                return None, []
+
+            changed_flags = [
+                (data_items['UID'], data_items.get('FLAGS', []))
+                for mail_id, data_items in util.parse_fetch_response(response) if 'UID' in data_items
+            ]
+
+        if full_synchronization:
+            # every existing mail has been part of the response
+            header_cache.prune([mail_uid for mail_uid, flags in changed_flags])
+
+        for mail_uid, flags in changed_flags:
+            header_cache.mails.setdefault(mail_uid, {})['flags'] = flags
+
+        code, vanished = self._imap_connection.response('VANISHED')
+        for vanished_block in vanished:
+            if vanished_block:
+                # e.g. b'(EARLIER) 300:310,405'
+                header_cache.discard(util.expand_message_set(vanished_block.decode().split()[-1]))
+
+        if len(header_cache.mails) != number_of_mails:
+            # without qresync, deleted mails are not reported; find out which ones are gone
+            selection, mail_uids = self._search_uids(selection, 'ALL')
+            header_cache.prune(mail_uids)
+
+        header_cache.highestmodseq = self._current_highestmodseq
+        header_cache.save()
+
+        return header_cache, changed_flags
+
     def minimal_mail_data_by_id(self, selection: str, mail_id: int | str) -> tuple[str, str] | None:
         """gets subject and sender of a mail"""
         self.change_selection_if_necessary(selection, readonly=True)
@@ -140,32 +540,226 @@ class Receiver:
         # response: [(header, content), closing byte]
         # we only want the tuple
         # skip the header in the tuple as well
-        message = message_from_bytes(response[0][1])
+        # only the header is parsed, subject and sender are decoded
+        return util.parse_header_fields(response[0][1], ('subject', 'from'))
 
-        # extract message contents
-        # subject
-        subject = str(make_header(decode_header(message['subject'])))
-        # sender
-        from_sender = str(make_header(decode_header(message['from'])))
+    def minimal_mail_data_by_ids(
+            self, selection: str, mail_ids: list[int | str], batch_size: int = 500, by_uid: bool = False,
+            preview: bool = False
+    ) -> Iterator[tuple[str, str, str, str] | tuple[str, str, str, str, str]]:
+        """generator; gets id, subject, sender and date of many mails with one fetch command per batch of mails
+
+        with preview, the beginning of the text of every mail is handed out as well (fifth item)
+        """
+        self.change_selection_if_necessary(selection, readonly=True)
+
+        # peek, so the mails are not marked as read; only the three header fields are transferred
+        message_parts = 'BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)]'
+        if preview:
+            # the text of most mails is their part 1, so its beginning is fetched right away on a guess
+            message_parts += f' BODYSTRUCTURE BODY.PEEK[1]<0.{self._preview_size}>'
+
+        for batch in util.batched(list(mail_ids), batch_size):
+            status, response = self._fetch(util.message_set(batch), f'({message_parts})', by_uid)
+
+            if status.lower() != 'ok':
+                logger.error(f'Failed to fetch mails with ids: {util.message_set(batch)}.')
+                continue
 
-        return subject, from_sender
+            # the response to a uid fetch always contains the uids of the mails
+            mails = {
+                str(data_items['UID'] if by_uid else mail_id): data_items
+                for mail_id, data_items in util.parse_fetch_response(response)
+            }
+
+            previews = self._previews(mails, by_uid) if preview else {}
+
+            # the server answers in ascending order, hand out the mails in the order they were requested in
+            mail_ids = [str(mail_id) for mail_id in batch if str(mail_id) in mails]
+            headers = util.parse_header_fields_batch(
+                util.get_data_item(mails[mail_id], 'BODY[HEADER', b'') for mail_id in mail_ids)
+
+            for mail_id, (subject, from_sender, date) in zip(mail_ids, headers):
+                yield mail_id, subject, from_sender, date, *([previews.get(mail_id, '')] if preview else [])
+
+    # bytes of the text of a mail that are fetched for its preview
+    _preview_size = 512
+
+    def _previews(self, mails: dict[str, dict], by_uid: bool = False) -> dict[str, str]:
+        """makes previews of mails whose BODYSTRUCTURE and the beginning of part 1 have been fetched
+
+        mails whose text is not their part 1 (e.g. 1.1 if there are attachments) are fetched again,
+        with one command per part number
+        """
+        previews = {}
+        mails_by_part_number = {}
+
+        for mail_id, data_items in mails.items():
+            parts = util.walk_body_structure(data_items['BODYSTRUCTURE']) if data_items.get('BODYSTRUCTURE') else []
+
+            if (part := util.preview_part(parts)) is None:
+                previews[mail_id] = ''
+            elif part['part'] == '1':
+                previews[mail_id] = util.text_preview(util.get_data_item(data_items, 'BODY[1]<', b''), part)
+            else:
+                mails_by_part_number.setdefault(part['part'], []).append((mail_id, part))
+
+        for part_number, part_mails in mails_by_part_number.items():
+            message_set = util.message_set([mail_id for mail_id, part in part_mails])
+            status, response = self._fetch(
+                message_set, f'(BODY.PEEK[{part_number}]<0.{self._preview_size}>)', by_uid)
+
+            if status.lower() != 'ok':
+                logger.error(f'Failed to fetch the beginning of part {part_number} of mails with ids: '
+                                 f'{message_set}.')
+                continue
+
+            texts = {
+                str(data_items['UID'] if by_uid else mail_id): util.get_data_item(
+                    data_items, f'BODY[{part_number}]<', b'')
+                for mail_id, data_items in util.parse_fetch_response(response)
+            }
+
+            for mail_id, part in part_mails:
+                previews[mail_id] = util.text_preview(texts.get(mail_id, b''), part)
+
+        return previews
+
+    def cached_minimal_mail_data(
+            self, selection: str = 'INBOX', unread_only: bool = False, max_amount=None, mailbox_status: dict = None,
+            preview: bool = False
+    ) -> Iterator[tuple[str, str, str, str] | tuple[str, str, str, str, str]]:
+        """generator; like minimal_mail_data_by_ids, but yields uids and only fetches headers that are not cached yet
+
+        mailbox_status is the status of the mailbox from mailbox_overview, if it has just been requested;
+        previews are cached along with the headers
+        """
+        if unread_only:
+            selection, mail_uids = self.get_uids_of_unread_mails(selection, mailbox_status=mailbox_status)
+        else:
+            selection, mail_uids = self.get_uids_of_mails(selection, mailbox_status=mailbox_status)
+
+        header_cache = HeaderCache(self._iserv_username, selection)
+        # the mailbox has not been selected if the cache has been up-to-date according to its status
+        header_cache.validate(
+            mailbox_status['uidvalidity'] if mailbox_status is not None else self._current_uidvalidity)
+
+        if not unread_only and not self._condstore_enabled:
+            # all uids are known, forget about mails that have been deleted in the meantime
+            header_cache.prune(mail_uids)
+
+        mail_uids = mail_uids[0:max_amount]
+
+        # typically only the mails that arrived since the last time, i.e. the ones above the highest cached uid
+        if uncached_mail_uids := [
+            mail_uid for mail_uid in mail_uids
+            if not header_cache.has_headers(mail_uid) or (preview and not header_cache.has_preview(mail_uid))
+        ]:
+            for mail_uid, subject, from_sender, date, *mail_preview in self.minimal_mail_data_by_ids(
+                    selection, uncached_mail_uids, by_uid=True, preview=preview
+            ):
+                mail_data = header_cache.mails.setdefault(int(mail_uid), {})
+                mail_data.update({'subject': subject, 'from': from_sender, 'date': date})
+
+                if mail_preview:
+                    mail_data['preview'] = mail_preview[0]
+
+        header_cache.save()
+
+        for mail_uid in mail_uids:
+            if not header_cache.has_headers(mail_uid):
+                continue
+
+            mail_data = header_cache.mails[mail_uid]
+
+            yield (
+                str(mail_uid), mail_data['subject'], mail_data['from'], mail_data['date'],
+                *([mail_data.get('preview', '')] if preview else [])
+            )
+
+    def raw_mails_by_uids(
+            self, selection: str, mail_uids: list[int], batch_size: int = 20
+    ) -> Iterator[tuple[int, list[str], str, bytes]]:
+        """generator; gets uid, flags, internal date (arrival on the server) and the complete raw mail of many mails
+
+        the mails are handed out in ascending order of their uids, only one batch of them is kept in memory;
+        stops at the first batch that can not be fetched, so no mail is skipped silently
+        """
+        self.change_selection_if_necessary(selection, readonly=True)
+
+        for batch in util.batched(sorted(int(mail_uid) for mail_uid in mail_uids), batch_size):
+            status, response = self._fetch(util.message_set(batch), '(UID FLAGS INTERNALDATE BODY.PEEK[])', by_uid=True)
+
+            if status.lower() != 'ok':
+                logger.error(f'Failed to fetch mails with uids: {util.message_set(batch)}.')
+                return
+
+            mails = sorted(
+                (data_items['UID'], data_items) for mail_id, data_items in util.parse_fetch_response(response)
+                if 'UID' in data_items
+            )
+
+            for mail_uid, data_items in mails:
+                yield (
+                    mail_uid,
+                    data_items.get('FLAGS') or [],
+                    data_items.get('INTERNALDATE'),
+                    util.get_data_item(data_items, 'BODY[]', b'')
+                )
+
+    def _fetch(self, message_set: str, message_parts: str, by_uid: bool = False) -> tuple[str, list]:
+        """fetches parts of the mails in a message set, which consists of either sequence numbers or uids"""
+        if by_uid:
+            return self._imap_connection.uid('FETCH', message_set, message_parts)
+
+        return self._imap_connection.fetch(message_set, message_parts)
+
+    def _fetch_body_structure(
+            self, mail_id: int | str, by_uid: bool = False, message_parts: str = ''
+    ) -> tuple[list[dict], dict] | None:
+        """fetches the BODYSTRUCTURE of a mail (and other message parts) and returns its parts and all data items"""
+        status, response = self._fetch(
+            str(mail_id), f'(BODYSTRUCTURE{f" {message_parts}" if message_parts else ""})', by_uid)
+
+        if status.lower() != 'ok' or not (mails := util.parse_fetch_response(response)):
+            logger.error(f'Failed to fetch the body structure of the mail with id: {mail_id}.')
+            return
+
+        data_items = mails[0][1]
+
+        return util.walk_body_structure(data_items.get('BODYSTRUCTURE') or []), data_items
+
+    def _fetch_parts(self, mail_id: int | str, parts: list[dict], by_uid: bool = False) -> dict | None:
+        """fetches only the given parts of a mail with one command, without marking it as read"""
+        if not parts:
+            return {}
+
+        message_parts = ' '.join(f'BODY.PEEK[{part["part"]}]' for part in parts)
+        status, response = self._fetch(str(mail_id), f'({message_parts})', by_uid)
+
+        if status.lower() != 'ok' or not (mails := util.parse_fetch_response(response)):
+            logger.error(f'Failed to fetch parts of the mail with id: {mail_id}.')
+            return
+
+        data_items = mails[0][1]
+
+        return {part['part']: data_items.get(f'BODY[{part["part"]}]') or b'' for part in parts}
 
     def fetch_mail_content_by_id(
-            self, selection: str, mail_id: int | str
+            self, selection: str, mail_id: int | str, by_uid: bool = False
     ) -> tuple[str, str, str, str, tuple[str, str], list[tuple[str, str]]] | None:
-        """gets information about and text content of a mail by its id"""
-        self.change_selection_if_necessary(selection, readonly=True)
+        """gets information about and text content of a mail by its id
 
-        status, response = self._imap_connection.fetch(str(mail_id), '(RFC822)')  # fetch the whole mail
+        only the header fields and text parts are downloaded, attachments are left on the server
+        """
+        self.change_selection_if_necessary(selection, readonly=True)
 
-        if status.lower() != 'ok':
-            logger.exception(f'Failed to fetch mail with id: {mail_id}.')
+        # the body structure tells which parts there are, without downloading any of them
+        if (fetched := self._fetch_body_structure(
+                mail_id, by_uid, 'BODY.PEEK[HEADER.FIELDS (DATE SUBJECT FROM TO)]')) is None:
             return
 
-        # response: [(header, content), closing byte]
-        # we only want the tuple
-        # skip the header in the tuple as well
-        message = message_from_bytes(response[0][1])
+        parts, data_items = fetched
 
         # extract message contents
 
@@ -173,103 +767,347 @@ class Receiver:
         # header
         # ----------
 
-        # date
-        date = str(make_header(decode_header(message['date'])))
-        # subject
-        subject = str(make_header(decode_header(message['subject'])))
-        # sender
-        from_sender = str(make_header(decode_header(message['from'])))
-        # receiver
-        to_receiver = str(make_header(decode_header(message['to'])))
+        # date, subject, sender and receiver
+        date, subject, from_sender, to_receiver = util.parse_header_fields(
+            util.get_data_item(data_items, 'BODY[HEADER', b''), ('date', 'subject', 'from', 'to'))
 
         # ----------
         # content
         # ----------
 
-        body = ('', '')
-
+        text_parts = []
         attachment_data = []
 
-        if not message.is_multipart():
-            if content_type := message.get_content_type() == 'text/plain':
-                # there is only text for us to extract
-                body = (message.get_payload(decode=True).decode().strip(), '')
-            elif content_type == 'text/html':
-                body = ('', message.get_payload(decode=True).decode().strip())
-            else:
-                # there is no text for us to extract
-                attachment_data.append((message.get_filename(), content_type))
+        if len(parts) == 1 and parts[0]['part'] == '1' and parts[0]['content_type'] not in ['text/plain', 'text/html']:
+            # a single part mail without any text for us to extract
+            attachment_data.append((parts[0]['file_name'], parts[0]['content_type']))
 
         else:
-            body_plaintext = ''
-            body_html = ''
+            # the text parts need to be separated from the rest
+            for part in parts:
+                if (part['disposition'] == 'attachment') and part['file_name']:
+                    attachment_data.append((part['file_name'], part['content_type']))
 
-            # the message is a multipart and the text parts need to be separated from the rest
-            for part in message.walk():
+                elif part['content_type'] in ['text/plain', 'text/html']:
+                    text_parts.append(part)
+
+        if (text_part_data := self._fetch_parts(mail_id, text_parts, by_uid)) is None:
+            return
 
-                content_type = part.get_content_type()
-                content_disposition = str(part.get('Content-Disposition'))
+        body_plaintext = ''
+        body_html = ''
 
-                if ('attachment' in content_disposition) and (attachment_file_name := part.get_filename()):
-                    attachment_data.append((attachment_file_name, content_type))
+        for part in text_parts:
+            text = util.decode_part(text_part_data[part['part']], part['encoding'], part['charset'] or 'utf-8')
 
-                elif content_type == 'text/plain':
-                    body_plaintext += part.get_payload(decode=True).decode()
-                elif content_type == 'text/html':
-                    body_html += part.get_payload(decode=True).decode()
+            if part['content_type'] == 'text/plain':
+                body_plaintext += text
+            else:
+                body_html += text
 
-            body = (body_plaintext, body_html)
+        body = (body_plaintext.strip(), body_html.strip()) if len(parts) == 1 else (body_plaintext, body_html)
 
         return date, subject, from_sender, to_receiver, body, attachment_data
 
-    def download_mail_attachments_by_id(self, selection: str, mail_id: int | str, to_location: str) -> bool:
-        """generator; gets information about and text content of a mail by its id"""
+    def download_mail_attachments_by_id(
+            self, selection: str, mail_id: int | str, to_location: str, by_uid: bool = False, part: str = None
+    ) -> bool:
+        """downloads the attachments of a mail, or only the one with the given part number, to a directory"""
         to_location = to_location.removesuffix('/').removesuffix('\\')
 
         self.change_selection_if_necessary(selection, readonly=True)
 
-        status, response = self._imap_connection.fetch(str(mail_id), '(RFC822)')  # fetch the whole mail
-
-        if status.lower() != 'ok':
-            logger.exception(f'Failed to fetch mail with id: {mail_id}.')
+        if (fetched := self._fetch_body_structure(mail_id, by_uid)) is None:
             return False
 
-        # response: [(header, content), closing byte]
-        # we only want the tuple
-        # skip the header in the tuple as well
-        message = message_from_bytes(response[0][1])
+        parts, data_items = fetched
+
+        if len(parts) == 1 and parts[0]['part'] == '1':
+            # not a multipart: the whole body is an attachment, unless it is text
+            attachment_parts = [] if parts[0]['content_type'] in ['text/plain', 'text/html'] else parts
+        else:
+            attachment_parts = [
+                attachment_part for attachment_part in parts
+                if attachment_part['disposition'] == 'attachment' and attachment_part['file_name']
+            ]
 
-        # download attachments
-        if not message.is_multipart():
-            if message.get_content_type() not in ['text/plain', 'text/html']:
-                # there is an attachment for us to download
-                open(f'{to_location}/{message.get_filename()}', 'wb').write(message.get_payload(decode=True))
+        if part is not None:
+            attachment_parts = [
+                attachment_part for attachment_part in attachment_parts if attachment_part['part'] == part
+            ]
 
-        # the message is a multipart
-        for part in message.walk():
+        for attachment_part in attachment_parts:
+            # the name is chosen by the sender; it must not point outside of the directory or overwrite other files
+            attachment_file_path, attachment_file = util.open_unique_file(
+                to_location, util.safe_file_name(attachment_part['file_name']))
 
-            if not ('attachment' in str(part.get('Content-Disposition')) and part.get_filename()):
-                continue
+            with attachment_file:
+                downloaded = self._download_part(mail_id, attachment_part, attachment_file, by_uid)
+                attachment_file.close()
 
-            # there is an attachment for us to download
-            open(f'{to_location}/{part.get_filename()}', 'wb').write(part.get_payload(decode=True))
+            if not downloaded:
+                remove(attachment_file_path)
+                return False
 
         return True
 
-    def mark_as_read_by_id(self, selection: str, mail_id: int | str):
-        self.change_selection_if_necessary(selection, readonly=False)
+    def _download_part(
+            self, mail_id: int | str, part: dict, to_file, by_uid: bool = False, chunk_size: int = 1024 * 1024
+    ) -> bool:
+        """streams a body part into a binary file, decoding it on the way
 
-        self._imap_connection.store(str(mail_id), '+FLAGS', '\\SEEN')
+        the part is fetched in chunks (BODY.PEEK[n]<offset.length>), so memory usage does not depend on its size
+        """
+        stream_decoder = util.StreamDecoder(part['encoding'])
 
-    def mark_as_unread_by_id(self, selection: str, mail_id: int | str):
-        self.change_selection_if_necessary(selection, readonly=False)
+        offset = 0
+        while True:
+            status, response = self._fetch(
+                str(mail_id), f'(BODY.PEEK[{part["part"]}]<{offset}.{chunk_size}>)', by_uid)
+
+            if status.lower() != 'ok' or not (mails := util.parse_fetch_response(response)):
+                logger.error(f'Failed to fetch part {part["part"]} of the mail with id: {mail_id}.')
+                return False
+
+            # the data item is named after the offset, e.g. BODY[2]<1048576>
+            chunk = util.get_data_item(mails[0][1], f'BODY[{part["part"]}]', b'') or b''
+
+            to_file.write(stream_decoder.decode(chunk))
+            offset += len(chunk)
+
+            if len(chunk) < chunk_size:
+                # the end of the part has been reached
+                break
+
+        to_file.write(stream_decoder.flush())
+
+        return True
+
+    def _store(self, message_set: str, command: str, flags: str, by_uid: bool = False) -> tuple[str, list]:
+        """alters the flags of the mails in a message set, which consists of either sequence numbers or uids"""
+        if by_uid:
+            return self._imap_connection.uid('STORE', message_set, command, flags)
 
-        self._imap_connection.store(str(mail_id), '-FLAGS', '\\SEEN')
+        return self._imap_connection.store(message_set, command, flags)
+
+    def mark_as_read_by_id(self, selection: str, mail_id: int | str, by_uid: bool = False):
+        self.mark_as_read(selection, [mail_id], by_uid)
+
+    def mark_as_unread_by_id(self, selection: str, mail_id: int | str, by_uid: bool = False):
+        self.mark_as_unread(selection, [mail_id], by_uid)
 
     # other flags to store?
     # too unsafe?
     # https://stackoverflow.com/questions/17367611/python-imaplib-mark-email-as-unread-or-unseen
 
-    # TODO: BODYSTRUCTURE
-    # fetch and analyse BODYSTRUCTURE and only download what is really needed:
-    # status, response = self._imap_connection.fetch(str(mail_id), '(BODYSTRUCTURE)')  # get the mails body structure
+    # ----------
+    # changing many mails at once
+    # ----------
+
+    # mail_ids are either a list of ids (or uids) or a message set like '1:500' or '4711:*';
+    # every operation is a single command, no matter how many mails it concerns
+
+    @staticmethod
+    def _message_set(mail_ids: list[int | str] | str) -> str:
+        return mail_ids if isinstance(mail_ids, str) else util.message_set(mail_ids)
+
+    def store_flags(
+            self, selection: str, mail_ids: list[int | str] | str, command: str, flags: str, by_uid: bool = False
+    ) -> bool:
+        """adds (+FLAGS), removes (-FLAGS) or replaces (FLAGS) the flags of many mails; returns whether it worked"""
+        if not mail_ids:
+            return True
+
+        self.change_selection_if_necessary(selection, readonly=False)
+
+        # silent: the server does not answer with the new flags of every single mail
+        status, response = self._store(self._message_set(mail_ids), f'{command}.SILENT', f'({flags})', by_uid)
+
+        if status.lower() != 'ok':
+            logger.error(f'Failed to store the flags {flags} of mails with ids: {self._message_set(mail_ids)}.')
+
+        return status.lower() == 'ok'
+
+    def mark_as_read(self, selection: str, mail_ids: list[int | str] | str, by_uid: bool = False) -> bool:
+        return self.store_flags(selection, mail_ids, '+FLAGS', '\\Seen', by_uid)
+
+    def mark_as_unread(self, selection: str, mail_ids: list[int | str] | str, by_uid: bool = False) -> bool:
+        return self.store_flags(selection, mail_ids, '-FLAGS', '\\Seen', by_uid)
+
+    def flag(self, selection: str, mail_ids: list[int | str] | str, by_uid: bool = False) -> bool:
+        return self.store_flags(selection, mail_ids, '+FLAGS', '\\Flagged', by_uid)
+
+    def unflag(self, selection: str, mail_ids: list[int | str] | str, by_uid: bool = False) -> bool:
+        return self.store_flags(selection, mail_ids, '-FLAGS', '\\Flagged', by_uid)
+
+    def copy(self, selection: str, mail_ids: list[int | str] | str, to_selection: str, by_uid: bool = False) -> bool:
+        """copies many mails to another mailbox; returns whether it worked"""
+        if not mail_ids:
+            return True
+
+        self.change_selection_if_necessary(selection, readonly=True)
+
+        if by_uid:
+            status, response = self._imap_connection.uid('COPY', self._message_set(mail_ids), util.quote(to_selection))
+        else:
+            status, response = self._imap_connection.copy(self._message_set(mail_ids), util.quote(to_selection))
+
+        if status.lower() != 'ok':
+            logger.error(f'Failed to copy mails with ids {self._message_set(mail_ids)} to {to_selection}.')
+
+        return status.lower() == 'ok'
+
+    def move(self, selection: str, mail_ids: list[int | str] | str, to_selection: str, by_uid: bool = False) -> bool:
+        """moves many mails to another mailbox (MOVE, otherwise COPY and delete); returns whether it worked"""
+        if not mail_ids:
+            return True
+
+        if 'MOVE' not in self._capabilities:
+            # if the mails can not be deleted, the copies stay and the move has not worked
+            return self.copy(selection, mail_ids, to_selection, by_uid) and self.delete(selection, mail_ids, by_uid)
+
+        self.change_selection_if_necessary(selection, readonly=False)
+
+        if by_uid:
+            status, response = self._imap_connection.uid('MOVE', self._message_set(mail_ids), util.quote(to_selection))
+        else:
+            status, response = self._imap_connection._simple_command(
+                'MOVE', self._message_set(mail_ids), util.quote(to_selection))
+
+        if status.lower() != 'ok':
+            logger.error(f'Failed to move mails with ids {self._message_set(mail_ids)} to {to_selection}.')
+
+        return status.lower() == 'ok'
+
+    def delete(self, selection: str, mail_ids: list[int | str] | str, by_uid: bool = False) -> bool:
+        """deletes many mails permanently; returns whether it worked
+
+        other mails that are marked as deleted (e.g. by another client) are not expunged along with them; without
+        UIDPLUS, the mails are then only marked as deleted, which does not count as having worked
+        """
+        if not self.store_flags(selection, mail_ids, '+FLAGS', '\\Deleted', by_uid):
+            return False
+
+        if 'UIDPLUS' in self._capabilities:
+            if not by_uid:
+                # UID EXPUNGE needs uids, which can be found without a round trip per mail
+                selection, mail_ids = self._search_uids(selection, self._message_set(mail_ids))
+                if not mail_ids:
+                    return True
+
+            status, response = self._imap_connection.uid('EXPUNGE', self._message_set(mail_ids))
+        else:
+            # EXPUNGE removes all mails marked as deleted; only use it if there are no other ones
+            selection, other_deleted_mail_uids = self._search_uids(
+                selection, f'(DELETED NOT {"UID " if by_uid else ""}{self._message_set(mail_ids)})')
+
+            if other_deleted_mail_uids:
+                # the mails are still there, so e.g. a move has not worked
+                logger.error(f'Mails with ids {self._message_set(mail_ids)} in mailbox {selection} are only marked '
+                             f'as deleted, other mails that are marked as deleted would be removed as well.')
+                return False
+
+            status, response = self._imap_connection.expunge()
+
+        if status.lower() != 'ok':
+            logger.error(f'Failed to expunge mails with ids {self._message_set(mail_ids)}.')
+
+        return status.lower() == 'ok'
+
+    # ----------
+    # waiting for changes using imap idle
+    # ----------
+
+    def idle(self, selection: str = 'INBOX', timeout: float = 28 * 60) -> list[tuple[str, bytes]]:
+        """waits until the server reports changes of a mailbox, the timeout is over or end_idle is called
+
+        returns the untagged responses the server sent, e.g. [('EXISTS', b'12'), ('FETCH', b'3 (FLAGS (\\Seen))')]
+        servers end an IDLE command after 30 minutes, so the timeout should be a bit shorter than that
+        """
+        self.change_selection_if_necessary(selection, readonly=True)
+
+        # a wakeup is only consumed once it has ended the command, one that has come in before (e.g. a stop) is kept
+        if 'IDLE' not in self._capabilities:
+            # poll instead
+            self._idle_wakeup.wait(min(timeout, 60))
+            self._idle_wakeup.clear()
+            return self._poll_untagged_responses()
+
+        with self._idle_lock:
+            self._idle_tag = f'IDLE{id(self)}'.encode()
+            self._idle_done_sent = False
+            self._imap_connection.send(self._idle_tag + b' IDLE\r\n')
+
+        if not self._imap_connection.readline().startswith(b'+'):
+            logger.error(f'The imap server refused to start idling in mailbox {selection}.')
+            with self._idle_lock:
+                self._idle_tag = None
+            return []
+
+        # DONE must not be sent before the server has confirmed the start of the command
+        with self._idle_lock:
+            self._idling = True
+
+        if self._idle_wakeup.is_set():
+            # end_idle has been called in the meantime
+            self.end_idle()
+
+        # the server does not answer before DONE has been sent, so a timer ends the command
+        timer = Timer(timeout, self.end_idle)
+        timer.daemon = True
+        timer.start()
+
+        responses = []
+        try:
+            while line := self._imap_connection.readline():
+                if line.startswith(self._idle_tag):
+                    # tagged completion response of the idle command
+                    break
+
+                while literal_size := re.search(rb'\{(\d+)\}\r\n$', line):
+                    # the rest of the response follows a literal
+                    line = line[:literal_size.start()] + self._imap_connection.read(int(literal_size.group(1))) \
+                           + self._imap_connection.readline()
+
+                if untagged_response := untagged_response_pattern.match(line.strip()):
+                    data = b' '.join(filter(None, [untagged_response.group('number'), untagged_response.group('data')]))
+                    responses.append((untagged_response.group('type').decode().upper(), data))
+
+                    # there is something to process: end the command, the rest of the responses are read until the
+                    # server has confirmed it
+                    self.end_idle()
+            else:
+                raise imaplib.IMAP4.abort('socket error: EOF')
+        finally:
+            timer.cancel()
+
+            with self._idle_lock:
+                self._idle_tag = None
+                self._idling = False
+
+            # the command has ended, whatever has woken it up has been handled
+            self._idle_wakeup.clear()
+
+        return responses
+
+    def end_idle(self) -> None:
+        """ends a running idle command; thread-safe"""
+        self._idle_wakeup.set()
+
+        with self._idle_lock:
+            if not self._idling or self._idle_done_sent:
+                return
+
+            self._imap_connection.send(b'DONE\r\n')
+            self._idle_done_sent = True
+
+    def _poll_untagged_responses(self) -> list[tuple[str, bytes]]:
+        """asks the server for changes with a noop command and returns the untagged responses it sent"""
+        self._imap_connection.noop()
+
+        responses = []
+        for response_type in ('EXISTS', 'EXPUNGE', 'FETCH', 'VANISHED'):
+            code, data = self._imap_connection.response(response_type)
+            responses += [(response_type, response_data) for response_data in data if response_data is not None]
+
+        return responses
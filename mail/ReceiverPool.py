@@ -0,0 +1,130 @@
+import logging
+
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from threading import BoundedSemaphore, Lock
+
+import imaplib
+
+from mail.Receiver import Receiver
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# receiver pool
+# ----------
+
+
+class ReceiverPool:
+    """hands out receivers to tasks, so that several of them can use imap at the same time
+
+    every receiver has its own imap connection and therefore its own selected mailbox;
+    connections are only established when needed and are reused afterwards
+    """
+    def __init__(self, iserv_username: str, iserv_password: str, max_size: int = 4) -> None:
+        self._iserv_username = iserv_username
+        self._iserv_password = iserv_password
+
+        self.max_size = max_size
+
+        # the receiver that has been used last is handed out first, its mailbox is likely to be selected already
+        self._idle_receivers = LifoQueue()
+        self._available = BoundedSemaphore(max_size)
+
+        self._receivers_lock = Lock()
+        self._receivers = []
+
+    @contextmanager
+    def receiver(self) -> Iterator[Receiver]:
+        """waits for a free receiver (or establishes a new connection) and lends it to the caller
+
+        with pool.receiver() as mail_receiver:
+            ...
+        """
+        self._available.acquire()
+
+        try:
+            try:
+                mail_receiver = self._idle_receivers.get_nowait()
+            except Empty:
+                mail_receiver = Receiver(self._iserv_username, self._iserv_password)
+
+                with self._receivers_lock:
+                    self._receivers.append(mail_receiver)
+
+            try:
+                yield mail_receiver
+            except BaseException as error:
+                # a connection that has survived the error (e.g. a bug in the caller) is handed out again; a broken
+                # one (or one that is in the middle of a command) is not, and a new one takes its place
+                if not isinstance(error, (imaplib.IMAP4.abort, OSError)) and mail_receiver.is_alive():
+                    self._idle_receivers.put(mail_receiver)
+                else:
+                    self._discard(mail_receiver)
+                raise
+            else:
+                self._idle_receivers.put(mail_receiver)
+
+        finally:
+            self._available.release()
+
+    def _discard(self, mail_receiver: Receiver) -> None:
+        with self._receivers_lock:
+            if mail_receiver in self._receivers:
+                self._receivers.remove(mail_receiver)
+
+        try:
+            mail_receiver.shutdown()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    def map(self, function: Callable, arguments: list) -> list:
+        """calls function(receiver, argument) for every argument concurrently, e.g. once per mailbox
+
+        returns the results in the order of the arguments
+        """
+        def task(argument):
+            with self.receiver() as mail_receiver:
+                return function(mail_receiver, argument)
+
+        with ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix='IScrAReceiverPool') as executor:
+            return list(executor.map(task, arguments))
+
+    def search(self, selections: list[str] = None, **criteria) -> list[tuple[str, int]]:
+        """like Receiver.search, but searches the mailboxes concurrently; returns (mailbox, uid) tuples"""
+        if selections is None:
+            with self.receiver() as mail_receiver:
+                selections = [
+                    mailbox_name for flags, delimiter, mailbox_name in mail_receiver.get_available_mailboxes()
+                    if '\\noselect' not in flags.lower()
+                ]
+
+        results = []
+        for selection, mail_uids in zip(selections, self.map(
+                lambda mail_receiver, selection: mail_receiver.search_mailbox(selection, **criteria), selections
+        )):
+            results += [(selection, mail_uid) for mail_uid in mail_uids]
+
+        return results
+
+    def shutdown(self) -> None:
+        """closes all connections and logs out"""
+        with self._receivers_lock:
+            mail_receivers, self._receivers = self._receivers, []
+
+        for mail_receiver in mail_receivers:
+            try:
+                mail_receiver.shutdown()
+            except (imaplib.IMAP4.error, OSError):
+                logger.exception('Failed to shut down a pooled mail receiver.')
+
+        self._idle_receivers = LifoQueue()
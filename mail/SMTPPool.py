@@ -0,0 +1,141 @@
+import logging
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+
+import smtplib
+
+from mail.connection import MailMaybeSent, connect_smtp, connect_with_backoff, smtp_is_alive, keepalive_interval
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# smtp pool
+# ----------
+
+
+class SMTPPool:
+    """hands out smtp connections to tasks, so that several mails can be sent at the same time
+
+    connections are only established when needed and are reused afterwards; idle connections that have not been
+    used for a while are checked with a NOOP before they are handed out again
+    """
+    def __init__(self, iserv_username: str, iserv_password: str, max_size: int = 3) -> None:
+        self._iserv_username = iserv_username
+        self._iserv_password = iserv_password
+
+        self.max_size = max_size
+
+        # the connection that has been used last is handed out first, it is the least likely to have timed out
+        # (connection, last used) tuples
+        self._idle_connections = LifoQueue()
+        self._available = BoundedSemaphore(max_size)
+
+        self._connections_lock = Lock()
+        self._connections = []
+
+    @contextmanager
+    def connection(self, fresh: bool = False) -> Iterator[smtplib.SMTP]:
+        """waits for a free connection (or establishes a new one) and lends it to the caller
+
+        with pool.connection() as smtp_connection:
+            ...
+
+        a fresh connection is always a new one, e.g. to try again after an idle one has turned out to be dropped
+        """
+        self._available.acquire()
+
+        try:
+            try:
+                smtp_connection, last_used = (None, None) if fresh else self._idle_connections.get_nowait()
+            except Empty:
+                smtp_connection = None
+            else:
+                # the server may have closed a connection that has been idle for a while
+                if monotonic() - last_used > keepalive_interval and not smtp_is_alive(smtp_connection):
+                    logger.warning('A pooled smtp connection has been dropped, connecting again.')
+                    self._discard(smtp_connection)
+                    smtp_connection = None
+
+            if smtp_connection is None:
+                smtp_connection = connect_with_backoff(
+                    lambda: connect_smtp(self._iserv_username, self._iserv_password), 'the smtp server')
+
+                with self._connections_lock:
+                    self._connections.append(smtp_connection)
+
+            try:
+                yield smtp_connection
+            except (smtplib.SMTPServerDisconnected, MailMaybeSent, OSError):
+                # the connection is broken, do not hand it out again
+                self._discard(smtp_connection)
+                raise
+            else:
+                self._idle_connections.put((smtp_connection, monotonic()))
+
+        finally:
+            self._available.release()
+
+    def _discard(self, smtp_connection: smtplib.SMTP) -> None:
+        with self._connections_lock:
+            if smtp_connection in self._connections:
+                self._connections.remove(smtp_connection)
+
+        try:
+            smtp_connection.close()
+        except OSError:
+            pass
+
+    def keepalive(self) -> None:
+        """sends a NOOP over the idle connections that have not been used for a while and drops the dead ones
+
+        long-running processes call it regularly, so that the server does not close the connections
+        """
+        # the checked connections count as lent, so that no one establishes additional connections meanwhile
+        checked_connections = []
+        while self._available.acquire(blocking=False):
+            try:
+                checked_connections.append(self._idle_connections.get_nowait())
+            except Empty:
+                self._available.release()
+                break
+
+        try:
+            alive_connections = []
+            for smtp_connection, last_used in checked_connections:
+                if monotonic() - last_used <= keepalive_interval:
+                    alive_connections.append((smtp_connection, last_used))
+                elif smtp_is_alive(smtp_connection):
+                    alive_connections.append((smtp_connection, monotonic()))
+                else:
+                    self._discard(smtp_connection)
+
+            # the connection used last ends up on top again
+            for smtp_connection, last_used in sorted(alive_connections, key=lambda connection: connection[1]):
+                self._idle_connections.put((smtp_connection, last_used))
+        finally:
+            for _ in checked_connections:
+                self._available.release()
+
+    def shutdown(self) -> None:
+        """terminates all smtp sessions"""
+        with self._connections_lock:
+            smtp_connections, self._connections = self._connections, []
+
+        for smtp_connection in smtp_connections:
+            try:
+                smtp_connection.quit()
+            except (smtplib.SMTPException, OSError):
+                logger.exception('Failed to shut down a pooled smtp connection.')
+
+        self._idle_connections = LifoQueue()
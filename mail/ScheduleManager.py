@@ -1,12 +1,17 @@
 import logging
 from configparser import ConfigParser
 
-from datetime import datetime, timedelta
-from os import replace
+from collections.abc import Callable
+from threading import Event
+from time import time
+from concurrent.futures import as_completed
+from email.message import Message
 
-from dateutil import tz
+import smtplib
 
-import mail
+from mail.Dispatcher import Dispatcher
+from mail.ScheduleStore import ScheduleStore
+from mail.Outbox import Outbox
 
 from plyer import notification
 
@@ -31,77 +36,215 @@ config.read('config.ini', encoding='utf-8')
 # schedule manager
 # ----------
 
-class ScheduleManager:
-    def __init__(self, iserv_username: str, iserv_password: str):
-        self._mail_transmitter = mail.Transmitter(iserv_username=iserv_username, iserv_password=iserv_password)
 
+class ScheduleManager:
+    """sends the mails in the schedule store when they are due
+
+    the next due time is looked up in the index of the store and only looked up again when the schedule has changed;
+    the rest of the time, nothing is done at all until the next mail is due
+
+    due mails are put into the outbox and taken off the schedule before they are sent; the outbox keeps track of
+    them until they have been sent and appended to INBOX/Sent, so nothing is lost or sent twice if the process dies
+    """
+    def __init__(self, iserv_username: str, iserv_password: str, notify: Callable[[str, str], None] = None):
+        self._iserv_username = iserv_username
+        # notify(title, message) informs the user about sent mails, with a desktop notification by default
+        self._notify = notify or self._desktop_notification
+
+        # due mails are sent several at a time, within the rate limits configured in the dispatch section
+        self._mail_dispatcher = Dispatcher(iserv_username=iserv_username, iserv_password=iserv_password)
+
+        self._schedule_store = ScheduleStore()
+        self._outbox = Outbox()
+        self._failed_file_path = f'{config.get("path", "mail_schedule", fallback="./data/mail/schedule")}/failed.txt'
+
+        # a schedule.txt of an earlier version becomes part of the store
+        for invalid_line in self._schedule_store.migrate_legacy():
+            self._dump_failed_line(invalid_line)
+
+        # the data version of the store changes whenever another process (e.g. the schedule editor) has changed it
+        self._data_version = None
+        self._next_due = None
+
+        self._stopped = Event()
+
+        self._recover()
+
+    def _recover(self) -> None:
+        """finishes what the process has been doing when it died; queued mails are simply sent when they are due"""
+        self._outbox.purge()
+
+        # sent, but maybe not appended to INBOX/Sent; the dispatcher checks by Message-ID
+        for message_id, message in self._outbox.unappended():
+            self._mail_dispatcher.submit_append(
+                message, on_appended=lambda appended_message, message_id=message_id: self._outbox.mark_as_appended(
+                    message_id))
+
+    def _dump_failed_line(self, line: str) -> None:
+        """dumps a scheduled mail that can not be sent into a text file next to the schedule"""
+        failed_mails_file = open(self._failed_file_path, mode='a', encoding='utf-8')
+        failed_mails_file.write(f'{line}\n')
+        failed_mails_file.close()
+
+        # do not raise an exception, mark the wrongly scheduled mail as failed and continue with the next one
+        logger.error(f'There is an invalid mail in the schedule. The bad mail definition has been dumped into '
+                     f'"{self._failed_file_path}": {line}')
+
+    def reload_if_changed(self) -> bool:
+        """looks up the next due time again if the schedule has been changed by someone else; returns whether it had"""
+        if (data_version := self._schedule_store.data_version()) == self._data_version:
+            return False
+
+        self._data_version = data_version
+        self._next_due = self._schedule_store.next_due()
+
+        return True
+
+    # ----------
+    # sending
+    # ----------
+
+    def _on_sent(self, message_id: str, message: Message, appended: bool) -> None:
+        # called in the background
+        if appended:
+            self._outbox.mark_as_appended(message_id)
+
+        # inform the user that a mail has been sent
+        logger.info(f'A mail has been sent to "{message["To"]}". Subject of the mail: "{message["Subject"]}"')
+        self._notify(
+            'IServ Mails', f'A mail has been sent to "{message["To"]}". \nSubject of the mail: "{message["Subject"]}"')
+
+    @staticmethod
+    def _desktop_notification(title: str, message: str) -> None:
+        notification.notify(
+            title=title,
+            message=message,
+            app_name='IScrA',
+            app_icon='./assets/icon/send.ico',
+            timeout=3,
+        )
+
+    def _create_scheduled_mail(self, scheduled_mail: dict) -> Message:
+        mail_template_content_type, mail_template = scheduled_mail['template'].split('/')
+        formatted_template = True if mail_template_content_type == 'html' else False
+
+        message = self._mail_dispatcher.create_message(
+            to_user=scheduled_mail['to_user'],
+            subject=scheduled_mail['subject'],
+            body=self._mail_dispatcher.render_template(mail_template, formatted_template),
+            formatted_body=formatted_template,
+            attachments=scheduled_mail['attachments']
+        )
+
+        # the same for the same scheduled mail and due time, so it is only put into the outbox once
+        message['Message-ID'] = (f'<iscra.schedule.{scheduled_mail["id"]}.{int(scheduled_mail["due"])}.'
+                                 f'{self._iserv_username}@{config["server"]["domain"]}>')
+
+        return message
+
+    def _next_due_time(self, scheduled_mail: dict) -> str | None:
+        try:
+            # repetitions that have been missed in the meantime are skipped
+            return ScheduleStore.next_due_time(scheduled_mail, after=time())
+        except ValueError:
+            # e.g. an empty repetition stored before those were refused; it would be due again right away forever
+            self._dump_failed_line(ScheduleStore.format_line(scheduled_mail))
+            return None
+
+    def _queue_due_mails(self) -> None:
+        """moves the due mails from the schedule into the outbox"""
+        # the mails are rescheduled (or removed, if they are not to be repeated) in memory and written in one go
+        next_due_times = {}
+
+        for scheduled_mail in self._schedule_store.due_mails(time()):
+            try:
+                message = self._create_scheduled_mail(scheduled_mail)
+            except OSError:
+                # e.g. a missing template or attachment
+                logger.exception(f'Failed to create the scheduled mail to "{scheduled_mail["to_user"]}".')
+                self._dump_failed_line(ScheduleStore.format_line(scheduled_mail))
+            else:
+                # if the process dies before the mails are rescheduled, queueing them again changes nothing
+                self._outbox.enqueue(message)
+
+            next_due_times[scheduled_mail['id']] = self._next_due_time(scheduled_mail)
+
+        # only the rows of the due mails are changed
+        self._schedule_store.reschedule_many(next_due_times)
+
+        self._next_due = self._schedule_store.next_due()
+
+    def _send_queued_mails(self) -> None:
+        """sends the mails in the outbox that are due (again)"""
+        sending = {
+            self._mail_dispatcher.submit(
+                message, on_sent=lambda sent_message, appended, message_id=message_id: self._on_sent(
+                    message_id, sent_message, appended)
+            ): message_id
+            for message_id, message in self._outbox.due()
+        }
+
+        # every mail is noted as sent as soon as it has been sent, in the order they are sent in
+        for future in as_completed(sending):
+            message_id = sending[future]
+
+            try:
+                if refused_recipients := future.result():
+                    logger.warning(f'Some recipients of the mail {message_id} have been refused: {refused_recipients}')
+
+                self._outbox.mark_as_sent(message_id)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as error:
+                # the server has rejected the mail itself, trying again will not help
+                logger.exception(f'The mail {message_id} has been rejected.')
+                self._outbox.mark_as_failed(message_id, str(error), retry=False)
+            except (smtplib.SMTPException, OSError) as error:
+                if self._outbox.mark_as_failed(message_id, str(error)):
+                    logger.warning(f'Failed to send the mail {message_id}, trying again later: {error}')
+                else:
+                    logger.exception(f'Failed to send the mail {message_id}, giving up.')
+
+    def _next_attempt(self) -> float | None:
+        return min((due for due in (self._next_due, self._outbox.next_attempt()) if due is not None), default=None)
+
+    def send_due_mails(self) -> float | None:
+        """sends all mails that are due; returns the seconds until the next one is due, None if there is none"""
+        while (next_attempt := self._next_attempt()) is not None and next_attempt <= time() \
+                and not self._stopped.is_set():
+            self._queue_due_mails()
+            self._send_queued_mails()
+
+        return max(next_attempt - time(), 0) if next_attempt is not None else None
 
     def send_and_reschedule_scheduled_mails(self) -> None:
         """sEndS aNd ResChEduLEs schEdUleD mAiLs"""
+        self.reload_if_changed()
+        self.send_due_mails()
+
+    def run(self, check_interval: float = 10) -> None:
+        """sends the scheduled mails until stop is called
+
+        sleeps until the next mail is due; meanwhile, the data version of the schedule store is checked every
+        check_interval seconds, which is all the work done while waiting
+        """
+        self._stopped.clear()
+
+        while not self._stopped.is_set():
+            self.reload_if_changed()
+
+            if (seconds_until_next_mail := self.send_due_mails()) is None:
+                seconds_until_next_mail = check_interval
+
+            self._stopped.wait(min(seconds_until_next_mail, check_interval))
+
+            # the connections are kept alive for the next mail
+            self._mail_dispatcher.keepalive()
 
-        mail_schedule_file = open('./data/mail/schedule/schedule.txt', mode='r', encoding='utf-8')
-        new_mail_schedule_file = open('./data/mail/schedule/new_schedule.txt', mode='w', encoding='utf-8')
-
-        # read the mail schedule line by line (and therefore mail by mail)
-        while scheduled_mail := mail_schedule_file.readline().strip():
-            now = datetime.now(tz=tz.tzlocal())  # get the exact time for every mail; very likely unnecessary
-
-            if ((scheduled_for := datetime.strptime(scheduled_mail.split(' | ')[1], '%d-%m-%Y_-_%H-%M-%S')
-                .replace(tzinfo=tz.gettz(scheduled_mail.split(' | ')[0]))) - now).total_seconds() > 0:
-                # the mail is to be sent in the future
-                new_mail_schedule_file.write(f'{scheduled_mail}\n')
-                continue
-
-            # the difference the time for which the mail has been scheduled and now (timedelta) is negative or equal to zero
-            # send the mail
-            scheduled_mail = scheduled_mail.split(' | ')
-            mail_template_content_type, mail_template = scheduled_mail[4].split('/')
-
-            if mail_template_content_type not in ['plaintext', 'html']:
-                # dump the failed scheduled mails into a text file
-                failed_mails_file = open('./data/mail/schedule/failed.txt', mode='a', encoding='utf-8')
-                failed_mails_file.write(f'{scheduled_mail}\n')
-                failed_mails_file.close()
-                # do not raise an exception, mark the wrongly scheduled mail as failed and continue with the next one
-                logger.exception('There is an invalid template type defined for a mail in the schedule.txt. '
-                                 'The bad mail definition has been dumped into a "failed.txt" file in the same directory.')
-                continue
-
-            # send the scheduled mail
-            self._mail_transmitter.send_mail_template(
-                to_user=scheduled_mail[2],
-                subject=scheduled_mail[3],
-                template=mail_template,
-                formatted_template=True if mail_template_content_type == 'html' else False,
-                attachments=scheduled_mail[6:len(scheduled_mail)]
-            )
-            # inform the user that a mail has been sent
-            logger.info(f'A mail has been sent to "{scheduled_mail[2]}". Subject of the mail: "{scheduled_mail[3]}"')
-            notification.notify(
-                title='IServ Mails',
-                message=f'A mail has been sent to "{scheduled_mail[2]}". \nSubject of the mail: "{scheduled_mail[3]}"',
-                app_name='IScrA',
-                app_icon='./assets/icon/send.ico',
-                timeout=3,
-            )
-
-            if scheduled_mail[5].split(' ')[0] == 'repeat':
-                # if the mail is to be repeated, calculate when it is to be sent next and append it to the new schedule
-                repeat_in_timedelta = scheduled_mail[5].split(' ')[1].split('-')
-                scheduled_mail[1] = (scheduled_for + timedelta(
-                    weeks=int(repeat_in_timedelta[0]),
-                    days=int(repeat_in_timedelta[1]),
-                    hours=int(repeat_in_timedelta[2]),
-                    minutes=int(repeat_in_timedelta[3]),
-                    seconds=int(repeat_in_timedelta[4])
-                )).strftime('%d-%m-%Y_-_%H-%M-%S')
-                new_mail_schedule_file.write(f'{" | ".join(scheduled_mail)}\n')
-
-        new_mail_schedule_file.close()
-        mail_schedule_file.close()
-
-        # replace the old schedule file with the new one
-        replace(src='./data/mail/schedule/new_schedule.txt', dst='./data/mail/schedule/schedule.txt')
+    def stop(self) -> None:
+        """makes run return; a mail that is being sent is sent completely"""
+        self._stopped.set()
 
     def shutdown(self):
-        self._mail_transmitter.shutdown()
+        # waits for the mails that are being sent and appended
+        self._mail_dispatcher.shutdown()
+        self._outbox.close()
+        self._schedule_store.close()
@@ -0,0 +1,395 @@
+import logging
+from configparser import ConfigParser
+
+from os import makedirs, replace, path
+from threading import Lock
+from datetime import datetime, timedelta
+
+from dateutil import tz
+
+import json
+import sqlite3
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# schedule store
+# ----------
+
+
+# the format of the due times in the legacy schedule.txt, in the time zone of the mail
+_due_time_format = '%d-%m-%Y_-_%H-%M-%S'
+
+
+class InvalidScheduledMail(ValueError):
+    """a line of a mail schedule can not be understood"""
+
+
+class ScheduleChanged(Exception):
+    """the mail schedule has been changed by someone else in the meantime"""
+
+
+class ScheduleStore:
+    """the mail schedule in an sqlite database, shared by the scheduler service and the schedule editor
+
+    every change is a transaction of its own; readers are never blocked by a writer (write-ahead log)
+
+    a scheduled mail is a dict with the keys id, timezone, scheduled_for (dd-mm-yyyy_-_hh-mm-ss in its time zone),
+    due (unix timestamp), to_user, subject, template (e.g. plaintext/name.txt), repeat (once or repeat w-d-h-m-s)
+    and attachments (a list of paths)
+    """
+    def __init__(self, database_path: str = None) -> None:
+        schedule_directory = config.get('path', 'mail_schedule', fallback='./data/mail/schedule')
+
+        self._database_path = database_path or f'{schedule_directory}/schedule.sqlite3'
+        makedirs(path.dirname(self._database_path) or '.', exist_ok=True)
+
+        # one connection per store, used by one thread at a time; other processes wait up to 30 seconds for a lock
+        self._connection = sqlite3.connect(self._database_path, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = Lock()
+
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode = WAL')
+            self._connection.execute('PRAGMA synchronous = NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS scheduled_mail ('
+                'id INTEGER PRIMARY KEY, '
+                'due REAL NOT NULL, '
+                'timezone TEXT NOT NULL, '
+                'scheduled_for TEXT NOT NULL, '
+                'to_user TEXT NOT NULL, '
+                'subject TEXT NOT NULL, '
+                'template TEXT NOT NULL, '
+                'repeat TEXT NOT NULL, '
+                'attachments TEXT NOT NULL)'
+            )
+            # the next mail to send is always the first one in the index
+            self._connection.execute('CREATE INDEX IF NOT EXISTS scheduled_mail_due ON scheduled_mail (due, id)')
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    # ----------
+    # legacy format
+    # ----------
+
+    @staticmethod
+    def due_time(timezone: str, scheduled_for: str) -> float:
+        """turns a due time like 24-12-2023_-_18-00-00 in a time zone like Europe/Berlin into a unix timestamp"""
+        return datetime.strptime(scheduled_for, _due_time_format).replace(tzinfo=tz.gettz(timezone)).timestamp()
+
+    @staticmethod
+    def repeat_interval(repeat: str) -> timedelta | None:
+        """turns a repetition like repeat 0-1-0-0-0 (w-d-h-m-s) into an interval, None if the mail is only sent once
+
+        raises ValueError unless there are exactly five non-negative numbers that add up to more than nothing
+        """
+        if repeat.split(' ')[0] != 'repeat':
+            return None
+
+        if len(repeat.split(' ')) != 2 or len(values := repeat.split(' ')[1].split('-')) != 5 \
+                or not all(value.isdigit() for value in values):
+            raise ValueError(f'A repetition needs five non-negative numbers (w-d-h-m-s): "{repeat}"')
+
+        weeks, days, hours, minutes, seconds = (int(value) for value in values)
+        interval = timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+        # the mail would be due again right away, forever
+        if not interval:
+            raise ValueError(f'A repetition must not be empty: "{repeat}"')
+
+        return interval
+
+    @classmethod
+    def next_due_time(cls, scheduled_mail: dict, after: float = None) -> str | None:
+        """returns when a repeated mail is to be sent next (in its time zone), None if it is only sent once
+
+        if a unix timestamp is given, the repetitions that are due until then are skipped, so a mail that has been
+        missed many times (e.g. while the computer was off) is only sent once
+        """
+        if (interval := cls.repeat_interval(scheduled_mail['repeat'])) is None:
+            return None
+
+        next_due = datetime.strptime(scheduled_mail['scheduled_for'], _due_time_format) + interval
+
+        if after is not None:
+            now = datetime.fromtimestamp(after, tz.gettz(scheduled_mail['timezone'])).replace(tzinfo=None)
+
+            if next_due <= now:
+                next_due += ((now - next_due) // interval + 1) * interval
+
+        return next_due.strftime(_due_time_format)
+
+    @classmethod
+    def parse_line(cls, line: str) -> dict:
+        """parses a line of the legacy schedule.txt, e.g.
+
+        Europe/Berlin | 24-12-2023_-_18-00-00 | max.mustermann | subject | plaintext/name.txt | once | ./attachment
+        """
+        fields = line.strip().split(' | ')
+
+        if len(fields) < 6:
+            raise InvalidScheduledMail(f'A scheduled mail needs at least six fields: "{line.strip()}"')
+
+        timezone, scheduled_for, to_user, subject, template, repeat, *attachments = fields
+
+        if tz.gettz(timezone) is None:
+            raise InvalidScheduledMail(f'Unknown time zone "{timezone}": "{line.strip()}"')
+
+        try:
+            due = cls.due_time(timezone, scheduled_for)
+        except ValueError:
+            raise InvalidScheduledMail(f'Invalid due time "{scheduled_for}": "{line.strip()}"')
+
+        if template.split('/')[0] not in ['plaintext', 'html'] or len(template.split('/')) != 2:
+            raise InvalidScheduledMail(f'Invalid template "{template}": "{line.strip()}"')
+
+        scheduled_mail = {
+            'timezone': timezone, 'scheduled_for': scheduled_for, 'due': due, 'to_user': to_user, 'subject': subject,
+            'template': template, 'repeat': repeat, 'attachments': attachments
+        }
+
+        try:
+            cls.repeat_interval(repeat)
+        except ValueError:
+            raise InvalidScheduledMail(f'Invalid repetition "{repeat}": "{line.strip()}"')
+
+        return scheduled_mail
+
+    @staticmethod
+    def format_line(scheduled_mail: dict) -> str:
+        """turns a scheduled mail into a line of the legacy schedule.txt"""
+        return ' | '.join([
+            scheduled_mail['timezone'], scheduled_mail['scheduled_for'], scheduled_mail['to_user'],
+            scheduled_mail['subject'], scheduled_mail['template'], scheduled_mail['repeat'],
+            *scheduled_mail['attachments']
+        ])
+
+    # ----------
+    # reading
+    # ----------
+
+    @staticmethod
+    def _scheduled_mail(row: sqlite3.Row) -> dict:
+        return {**dict(row), 'attachments': json.loads(row['attachments'])}
+
+    def scheduled_mails(self) -> list[dict]:
+        """returns all scheduled mails in the order they are due"""
+        with self._lock:
+            rows = self._connection.execute('SELECT * FROM scheduled_mail ORDER BY due, id').fetchall()
+
+        return [self._scheduled_mail(row) for row in rows]
+
+    def due_mails(self, until: float) -> list[dict]:
+        """returns the mails that are due at the given unix timestamp, in the order they are due"""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT * FROM scheduled_mail WHERE due <= ? ORDER BY due, id', (until,)).fetchall()
+
+        return [self._scheduled_mail(row) for row in rows]
+
+    def next_due(self) -> float | None:
+        """returns the unix timestamp the next mail is due at, None if there is none"""
+        with self._lock:
+            return self._connection.execute('SELECT MIN(due) FROM scheduled_mail').fetchone()[0]
+
+    def data_version(self) -> int:
+        """changes whenever another connection (e.g. the schedule editor) has changed the schedule"""
+        with self._lock:
+            return self._connection.execute('PRAGMA data_version').fetchone()[0]
+
+    # ----------
+    # writing
+    # ----------
+
+    @staticmethod
+    def _insert(connection: sqlite3.Connection, scheduled_mail: dict) -> int:
+        return connection.execute(
+            'INSERT INTO scheduled_mail '
+            '(due, timezone, scheduled_for, to_user, subject, template, repeat, attachments) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                scheduled_mail['due'], scheduled_mail['timezone'], scheduled_mail['scheduled_for'],
+                scheduled_mail['to_user'], scheduled_mail['subject'], scheduled_mail['template'],
+                scheduled_mail['repeat'], json.dumps(scheduled_mail['attachments'])
+            )
+        ).lastrowid
+
+    def add(self, line: str) -> int:
+        """adds a mail in the format of the legacy schedule.txt; returns its id"""
+        scheduled_mail = self.parse_line(line)
+
+        with self._lock, self._connection:
+            return self._insert(self._connection, scheduled_mail)
+
+    @staticmethod
+    def _update(connection: sqlite3.Connection, mail_id: int, scheduled_mail: dict) -> bool:
+        return connection.execute(
+            'UPDATE scheduled_mail SET due = ?, timezone = ?, scheduled_for = ?, to_user = ?, subject = ?, '
+            'template = ?, repeat = ?, attachments = ? WHERE id = ?',
+            (
+                scheduled_mail['due'], scheduled_mail['timezone'], scheduled_mail['scheduled_for'],
+                scheduled_mail['to_user'], scheduled_mail['subject'], scheduled_mail['template'],
+                scheduled_mail['repeat'], json.dumps(scheduled_mail['attachments']), mail_id
+            )
+        ).rowcount == 1
+
+    def update(self, mail_id: int, line: str) -> bool:
+        """replaces a scheduled mail; returns whether it still existed"""
+        scheduled_mail = self.parse_line(line)
+
+        with self._lock, self._connection:
+            return self._update(self._connection, mail_id, scheduled_mail)
+
+    @classmethod
+    def _reschedule(cls, connection: sqlite3.Connection, mail_id: int, scheduled_for: str | None) -> bool:
+        if scheduled_for is None:
+            return connection.execute('DELETE FROM scheduled_mail WHERE id = ?', (mail_id,)).rowcount == 1
+
+        if (row := connection.execute('SELECT timezone FROM scheduled_mail WHERE id = ?', (mail_id,)).fetchone()) \
+                is None:
+            return False
+
+        connection.execute(
+            'UPDATE scheduled_mail SET due = ?, scheduled_for = ? WHERE id = ?',
+            (cls.due_time(row['timezone'], scheduled_for), scheduled_for, mail_id)
+        )
+
+        return True
+
+    def reschedule(self, mail_id: int, scheduled_for: str) -> bool:
+        """moves a scheduled mail to another due time in its time zone; returns whether it still existed"""
+        with self._lock, self._connection:
+            return self._reschedule(self._connection, mail_id, scheduled_for)
+
+    def reschedule_many(self, next_due_times: dict[int, str | None]) -> None:
+        """moves scheduled mails to their next due times (None removes a mail), all in one transaction
+
+        mails that no longer exist are left out
+        """
+        if not next_due_times:
+            return
+
+        with self._lock, self._connection:
+            for mail_id, scheduled_for in next_due_times.items():
+                self._reschedule(self._connection, mail_id, scheduled_for)
+
+    def delete(self, mail_id: int) -> bool:
+        """removes a scheduled mail; returns whether it still existed"""
+        with self._lock, self._connection:
+            return self._reschedule(self._connection, mail_id, None)
+
+    def save_edited(self, lines: list[str], loaded_mails: list[dict], loaded_data_version: int) -> None:
+        """saves the lines of the schedule editor, which has loaded the given mails at the given data version
+
+        unchanged mails are left alone, changed ones are updated in place and keep their id (their Message-IDs stay
+        the same), the rest is deleted or added; all in one transaction
+
+        raises InvalidScheduledMail if one of the lines is invalid and ScheduleChanged if someone else (e.g. the
+        scheduler service) has changed the schedule since it has been loaded, both without changing anything
+        """
+        lines = [line.strip() for line in lines if line.strip()]
+        scheduled_mails = {line: self.parse_line(line) for line in lines}
+
+        # the ids of the loaded mails by their lines
+        loaded_ids = {}
+        for scheduled_mail in loaded_mails:
+            loaded_ids.setdefault(self.format_line(scheduled_mail), []).append(scheduled_mail['id'])
+
+        changed_lines = []
+        for line in lines:
+            if loaded_ids.get(line):
+                loaded_ids[line].pop(0)
+            else:
+                changed_lines.append(line)
+
+        # loaded mails whose lines are no longer in the editor, in the order they have been loaded in
+        left_ids = {mail_id for mail_ids in loaded_ids.values() for mail_id in mail_ids}
+        left_ids = [scheduled_mail['id'] for scheduled_mail in loaded_mails if scheduled_mail['id'] in left_ids]
+
+        with self._lock, self._connection:
+            # nobody else can write until the transaction is over
+            self._connection.execute('BEGIN IMMEDIATE')
+
+            if self._connection.execute('PRAGMA data_version').fetchone()[0] != loaded_data_version:
+                raise ScheduleChanged('The schedule has been changed since it has been loaded.')
+
+            # a changed line replaces the first loaded mail that is left, as if it had been edited in place
+            for mail_id, line in zip(left_ids, changed_lines):
+                self._update(self._connection, mail_id, scheduled_mails[line])
+
+            for mail_id in left_ids[len(changed_lines):]:
+                self._connection.execute('DELETE FROM scheduled_mail WHERE id = ?', (mail_id,))
+
+            for line in changed_lines[len(left_ids):]:
+                self._insert(self._connection, scheduled_mails[line])
+
+    # ----------
+    # import and export
+    # ----------
+
+    def import_legacy(self, schedule_file_path: str) -> list[str]:
+        """adds all mails of a legacy schedule.txt in one transaction; returns the lines that are invalid"""
+        with open(schedule_file_path, mode='r', encoding='utf-8') as schedule_file:
+            lines = [line.strip() for line in schedule_file if line.strip()]
+            schedule_file.close()
+
+        scheduled_mails, invalid_lines = [], []
+        for line in lines:
+            try:
+                scheduled_mails.append(self.parse_line(line))
+            except InvalidScheduledMail:
+                invalid_lines.append(line)
+
+        with self._lock, self._connection:
+            for scheduled_mail in scheduled_mails:
+                self._insert(self._connection, scheduled_mail)
+
+        logger.info(f'Imported {len(scheduled_mails)} scheduled mails from "{schedule_file_path}".')
+
+        return invalid_lines
+
+    def export_legacy(self, schedule_file_path: str) -> None:
+        """writes the schedule in the format of the legacy schedule.txt"""
+        new_schedule_file_path = f'{schedule_file_path}.new'
+
+        with open(new_schedule_file_path, mode='w', encoding='utf-8') as new_schedule_file:
+            for scheduled_mail in self.scheduled_mails():
+                new_schedule_file.write(f'{self.format_line(scheduled_mail)}\n')
+            new_schedule_file.close()
+
+        replace(src=new_schedule_file_path, dst=schedule_file_path)
+
+    def migrate_legacy(self, schedule_file_path: str = None) -> list[str]:
+        """imports the legacy schedule.txt once and renames it, so it is not imported again; returns invalid lines"""
+        schedule_file_path = schedule_file_path or f'{path.dirname(self._database_path)}/schedule.txt'
+        imported_schedule_file_path = f'{schedule_file_path}.imported'
+
+        if not path.isfile(schedule_file_path):
+            return []
+
+        try:
+            # the file is moved away first: if the editor and the service start at the same time, only one imports it
+            replace(src=schedule_file_path, dst=imported_schedule_file_path)
+        except FileNotFoundError:
+            return []
+
+        return self.import_legacy(imported_schedule_file_path)
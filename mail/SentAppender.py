@@ -0,0 +1,165 @@
+import logging
+from configparser import ConfigParser
+
+from collections.abc import Callable
+from queue import Queue, Empty
+from threading import Thread
+from time import time, monotonic
+
+import imaplib
+
+from mail.connection import IMAP4, connect_imap, connect_with_backoff, keepalive_interval
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# sent appender
+# ----------
+
+
+class SentAppender:
+    """appends sent mails to INBOX/Sent in a background thread, so sending never waits for it
+
+    mails are appended as the bytes that have been sent (see mail.util.serialize_message), up to batch_size of them
+    with a single command if the server supports MULTIAPPEND; mails that are queued within batch_delay seconds of
+    each other end up in the same batch
+
+    at most max_queued mails wait to be appended, append blocks while the queue is full; shutdown appends all
+    queued mails before it returns
+    """
+    def __init__(self, iserv_username: str, iserv_password: str, imap_connection: IMAP4 = None) -> None:
+        self._iserv_username = iserv_username
+        self._iserv_password = iserv_password
+
+        self.batch_size = config.getint('sent', 'batch_size', fallback=25)
+        self.batch_delay = config.getfloat('sent', 'batch_delay', fallback=0.2)
+
+        # used by the background thread only; established when it is needed first, unless one is handed over
+        self._imap_connection = imap_connection
+
+        # (mail, on_appended) tuples; None makes the background thread finish
+        self._queue = Queue(maxsize=config.getint('sent', 'max_queued', fallback=100))
+
+        self._thread = Thread(target=self._run, name='IScrASentAppender', daemon=True)
+        self._thread.start()
+
+    def append(self, message_bytes: bytes, on_appended: Callable[[bool], None] = None) -> None:
+        """queues a sent mail; on_appended(appended) is called in the background afterwards"""
+        self._queue.put((message_bytes, on_appended))
+
+    def flush(self) -> None:
+        """waits until all queued mails have been appended (or have failed to)"""
+        self._queue.join()
+
+    def shutdown(self) -> None:
+        """appends the queued mails, then logs out"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+        if self._imap_connection is not None and not self._imap_connection.dropped:
+            try:
+                self._imap_connection.logout()
+            except (imaplib.IMAP4.error, OSError):
+                logger.exception('Failed to log out of the imap session of the sent appender.')
+
+        self._imap_connection = None
+
+    # ----------
+    # background
+    # ----------
+
+    def _check_imap_connection(self) -> None:
+        """forgets the imap connection if it has been dropped, so that the next batch connects again"""
+        if self._imap_connection is not None and self._imap_connection.needs_check() \
+                and not self._imap_connection.is_alive():
+            logger.warning('The imap connection of the sent appender has been dropped.')
+
+            try:
+                self._imap_connection.shutdown()
+            except OSError:
+                pass
+
+            self._imap_connection = None
+
+    def _append_batch(self, batch: list[tuple[bytes, Callable | None]]) -> None:
+        try:
+            self._check_imap_connection()
+
+            if self._imap_connection is None:
+                self._imap_connection = connect_with_backoff(
+                    lambda: connect_imap(self._iserv_username, self._iserv_password), 'the imap server')
+
+            status, response = self._imap_connection.multiappend(
+                'INBOX/Sent', '\\SEEN', [(time(), message_bytes) for message_bytes, on_appended in batch])
+            appended = status.lower() == 'ok'
+        except (imaplib.IMAP4.error, OSError):
+            logger.exception(f'Failed to append {len(batch)} sent mails to INBOX/Sent.')
+
+            # the connection may be broken, the next batch connects again
+            self._imap_connection = None
+            appended = False
+
+        if not appended:
+            logger.error(f'{len(batch)} sent mails have not been appended to INBOX/Sent.')
+
+        for message_bytes, on_appended in batch:
+            if on_appended is None:
+                continue
+
+            try:
+                on_appended(appended)
+            except Exception:
+                logger.exception('A callback of the sent appender failed.')
+
+    def _run(self) -> None:
+        stopping = False
+
+        while not stopping:
+            try:
+                # while there is nothing to do, the connection is kept alive
+                item = self._queue.get(timeout=keepalive_interval)
+            except Empty:
+                self._check_imap_connection()
+                continue
+
+            batch = []
+            deadline = monotonic() + self.batch_delay
+
+            while True:
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+
+                if stopping or len(batch) >= self.batch_size:
+                    break
+
+                try:
+                    item = self._queue.get(timeout=max(deadline - monotonic(), 0))
+                except Empty:
+                    break
+
+            try:
+                if batch:
+                    self._append_batch(batch)
+            finally:
+                # the stop item is done as well
+                for _ in range(len(batch) + stopping):
+                    self._queue.task_done()
@@ -0,0 +1,55 @@
+import logging
+
+from os import stat
+from threading import Lock
+from string import Template
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# template cache
+# ----------
+
+
+class TemplateCache:
+    """compiled templates of template files (e.g. mail templates, preambles and epilogues)
+
+    a file is only read and compiled again once it has changed (modification time or size); everything that is
+    substituted is left to the caller, so a cached template can be rendered differently for every mail
+    """
+    def __init__(self) -> None:
+        # template path: ((modification time, size), template)
+        self._templates = {}
+        self._lock = Lock()
+
+    def get(self, template_path: str) -> Template:
+        """returns the compiled template of a file; raises OSError if it can not be read"""
+        stat_result = stat(template_path)
+        version = (stat_result.st_mtime_ns, stat_result.st_size)
+
+        with self._lock:
+            if (cached_template := self._templates.get(template_path)) is not None and cached_template[0] == version:
+                return cached_template[1]
+
+        with open(template_path, mode='r', encoding='utf-8') as template_file:
+            template = Template(template_file.read())
+            template_file.close()
+
+        logger.debug(f'Compiled template "{template_path}".')
+
+        with self._lock:
+            self._templates[template_path] = (version, template)
+
+        return template
+
+    def clear(self) -> None:
+        """forgets all templates, so that they are read again"""
+        with self._lock:
+            self._templates.clear()
@@ -0,0 +1,162 @@
+import logging
+
+from collections.abc import Callable
+from threading import Event, Thread
+
+import imaplib
+
+from plyer import notification
+
+from mail import util
+from mail.Receiver import Receiver
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# callbacks
+# ----------
+
+
+def desktop_notification_callback(event: str, selection: str, mails: list[tuple]) -> None:
+    """informs the user about new mails with a desktop notification"""
+    if event != 'new':
+        return
+
+    message = f'{len(mails)} new {"mail" if len(mails) == 1 else "mails"} in {selection}.'
+    if len(mails) == 1:
+        message += f' \n{mails[0][2]}: "{mails[0][1]}"'
+
+    notification.notify(
+        title='IServ Mails',
+        message=message,
+        app_name='IScrA',
+        app_icon='./assets/icon/mail.ico',
+        timeout=3,
+    )
+
+
+def discord_webhook_callback(webhook) -> Callable[[str, str, list[tuple]], None]:
+    """returns a callback that posts new mails to a discord webhook (integration.discord.Webhook)"""
+    def callback(event: str, selection: str, mails: list[tuple]) -> None:
+        if event != 'new':
+            return
+
+        for mail_uid, subject, from_sender, date in mails:
+            webhook.send_simple_embed(title=subject or '(no subject)', description=f'{from_sender}\n{date}')
+
+    return callback
+
+
+# ----------
+# watcher
+# ----------
+
+
+class Watcher:
+    """waits for changes of a mailbox using imap idle and passes them on to callbacks
+
+    callbacks are called with the name of the event, the mailbox and a list of mails:
+    'new': [(uid, subject, sender, date), ...], 'expunged': [(mail_id,), ...], 'flags': [(mail_id, [flag, ...]), ...]
+    expunged mails and mails with changed flags are identified by their uids if the server supports qresync,
+    otherwise by their sequence numbers
+    """
+    def __init__(self, iserv_username: str, iserv_password: str, selection: str = 'INBOX',
+                 idle_timeout: float = 28 * 60) -> None:
+        # the connection is used exclusively for idling
+        self._mail_receiver = Receiver(iserv_username, iserv_password)
+
+        self._selection = selection
+        self._idle_timeout = idle_timeout
+
+        self._callbacks = []
+
+        self._stopped = Event()
+        self._thread = None
+
+    def add_callback(self, callback: Callable[[str, str, list[tuple]], None]) -> None:
+        self._callbacks.append(callback)
+
+    def start(self) -> None:
+        """watches the mailbox in a background thread"""
+        self._stopped.clear()
+
+        self._thread = Thread(target=self.run, name='IScrAMailWatcher', daemon=True)
+        self._thread.start()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def stop(self) -> None:
+        """ends the idle command and waits for the background thread to finish"""
+        self._stopped.set()
+        self._mail_receiver.end_idle()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def shutdown(self) -> None:
+        """stops watching, closes the connection and logs out"""
+        self.stop()
+        self._mail_receiver.shutdown()
+
+    def run(self) -> None:
+        """watches the mailbox until stop is called"""
+        selection, mail_uids = self._mail_receiver.get_uids_of_new_mails(self._selection, above_uid=0)
+        highest_uid = max(mail_uids, default=0)
+
+        while not self._stopped.is_set():
+            try:
+                # re-issued regularly, before the server ends the idle command itself
+                responses = self._mail_receiver.idle(self._selection, timeout=self._idle_timeout)
+                dropped = False
+            except (imaplib.IMAP4.abort, OSError):
+                # the receiver connects again before the next command; new mails may have arrived in the meantime
+                logger.warning(f'The connection of the mail watcher of {self._selection} has been dropped.')
+                responses, dropped = [], True
+
+            if self._stopped.is_set():
+                break
+
+            if dropped or any(response_type == 'EXISTS' for response_type, data in responses):
+                # EXISTS only tells the new number of mails; the uids of the new ones are higher than all known ones
+                selection, new_mail_uids = self._mail_receiver.get_uids_of_new_mails(self._selection, highest_uid)
+
+                if new_mail_uids:
+                    highest_uid = max(new_mail_uids)
+                    self._emit('new', list(self._mail_receiver.minimal_mail_data_by_ids(
+                        self._selection, new_mail_uids, by_uid=True)))
+
+            expunged_mails = []
+            for response_type, data in responses:
+                if response_type == 'EXPUNGE':
+                    expunged_mails.append((int(data),))
+                elif response_type == 'VANISHED':
+                    # e.g. b'5:7' or b'(EARLIER) 5:7'
+                    expunged_mails += [(mail_uid,) for mail_uid in util.expand_message_set(data.decode().split()[-1])]
+
+            if expunged_mails:
+                self._emit('expunged', expunged_mails)
+
+            if flag_changes := [
+                (data_items.get('UID', mail_id), data_items['FLAGS'])
+                for mail_id, data_items in util.parse_fetch_response(
+                    [data for response_type, data in responses if response_type == 'FETCH'])
+                if 'FLAGS' in data_items
+            ]:
+                self._emit('flags', flag_changes)
+
+    def _emit(self, event: str, mails: list[tuple]) -> None:
+        for callback in self._callbacks:
+            try:
+                callback(event, self._selection, mails)
+            except Exception:
+                # a failing callback must not stop the watcher
+                logger.exception(f'A mail watcher callback failed handling the event "{event}".')
@@ -1,3 +1,13 @@
 from mail.Transmitter import Transmitter
 from mail.Receiver import Receiver
+from mail.AsyncTransmitter import AsyncTransmitter
+from mail.AsyncReceiver import AsyncReceiver
+from mail.ReceiverPool import ReceiverPool
+from mail.SMTPPool import SMTPPool
+from mail.Dispatcher import Dispatcher
+from mail.Outbox import Outbox
+from mail.MailMerge import MailMerge
+from mail.Mirror import Mirror
+from mail.ScheduleStore import ScheduleStore
 from mail.ScheduleManager import ScheduleManager
+from mail.Watcher import Watcher, desktop_notification_callback, discord_webhook_callback
@@ -0,0 +1,382 @@
+import logging
+from configparser import ConfigParser
+
+from collections.abc import Callable
+from threading import Lock
+from time import monotonic, sleep
+from typing import TypeVar
+
+import ssl
+import zlib
+import smtplib
+import imaplib
+
+
+# ----------
+# logger
+# ----------
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------
+# config
+# ----------
+
+
+config = ConfigParser()
+config.read('config.ini', encoding='utf-8')
+
+
+# ----------
+# keepalive
+# ----------
+
+
+# connections that have not been used for this long are checked with a NOOP before the next command
+keepalive_interval = config.getfloat('keepalive', 'interval', fallback=4 * 60)
+
+# a dropped connection is established again up to this many times, waiting twice as long after every failure
+reconnect_attempts = config.getint('keepalive', 'reconnect_attempts', fallback=5)
+reconnect_delay = config.getfloat('keepalive', 'reconnect_delay', fallback=1)
+
+T = TypeVar('T')
+
+
+def connect_with_backoff(connect: Callable[[], T], description: str = 'the mail server') -> T:
+    """calls connect until it works, waiting twice as long after every failure; raises the last error"""
+    for attempt in range(reconnect_attempts):
+        try:
+            return connect()
+        except (imaplib.IMAP4.error, smtplib.SMTPException, OSError):
+            if attempt == reconnect_attempts - 1:
+                raise
+
+            logger.warning(f'Failed to connect to {description}, trying again in {reconnect_delay * 2 ** attempt}s.')
+            sleep(reconnect_delay * 2 ** attempt)
+
+
+def smtp_is_alive(smtp_connection: smtplib.SMTP) -> bool:
+    """checks an smtp connection with a NOOP; returns False if it has been dropped"""
+    if smtp_connection.sock is None:
+        return False
+
+    try:
+        code, message = smtp_connection.noop()
+    except (smtplib.SMTPException, OSError):
+        return False
+
+    return code == 250
+
+
+# ----------
+# tls session reuse
+# ----------
+
+
+# the same context imaplib and smtplib create by default; sessions can only be resumed with the context they stem from
+_ssl_context = ssl._create_stdlib_context()
+
+# the last tls session of every server and port, handed to the next connection to skip the full handshake
+_tls_sessions = {}
+_tls_sessions_lock = Lock()
+
+
+def get_ssl_context() -> ssl.SSLContext:
+    """returns the ssl context all mail connections share, e.g. for asyncio connections"""
+    return _ssl_context
+
+
+class _SessionReusingContext:
+    """passed to starttls of imaplib and smtplib instead of an ssl context, resumes the last session of the server"""
+    def __init__(self, host: str, port: int) -> None:
+        self._key = (host, port)
+
+    def wrap_socket(self, sock, server_hostname: str = None, **kwargs) -> ssl.SSLSocket:
+        with _tls_sessions_lock:
+            session = _tls_sessions.get(self._key)
+
+        # if the server does not know the session anymore, a full handshake is done instead
+        return _ssl_context.wrap_socket(sock, server_hostname=server_hostname, session=session, **kwargs)
+
+
+def _remember_tls_session(host: str, port: int, sock) -> None:
+    """keeps the session of a tls connection; with tls 1.3, it is only known after the server has sent something"""
+    if not isinstance(sock, ssl.SSLSocket) or sock.session is None:
+        return
+
+    logger.debug(f'TLS session with {host}:{port} {"resumed" if sock.session_reused else "established"}.')
+
+    with _tls_sessions_lock:
+        _tls_sessions[(host, port)] = sock.session
+
+
+# ----------
+# imap
+# ----------
+
+
+# imaplib refuses commands it does not know
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+
+class IMAP4(imaplib.IMAP4):
+    """imaplib.IMAP4 that can compress the connection (COMPRESS=DEFLATE, rfc 4978) and resume tls sessions
+
+    it notes when it has last been used and whether it has been dropped, so that it can be checked before use
+    """
+    def __init__(self, host: str = '', port: int = imaplib.IMAP4_PORT, timeout: float = None) -> None:
+        # set before connecting, the compression replaces the way responses are read
+        self._compressor = None
+        self._decompressor = None
+        self._inflated = bytearray()
+
+        self.last_used = monotonic()
+        self.dropped = False
+
+        self._multiappend_chunks = None
+
+        super().__init__(host, port, timeout)
+
+    def starttls(self, ssl_context=None) -> tuple[str, list]:
+        return super().starttls(ssl_context=ssl_context or _SessionReusingContext(self.host, self.port))
+
+    def login(self, user: str, password: str) -> tuple[str, list]:
+        response = super().login(user, password)
+
+        # the server has answered over tls by now, so its session ticket has arrived
+        _remember_tls_session(self.host, self.port, self.sock)
+
+        # servers usually advertise extensions like compress only after the login, often as part of its response
+        code, capabilities = self.response('CAPABILITY')
+        if not capabilities[-1]:
+            status, capabilities = self.capability()
+
+        if capabilities[-1]:
+            self.capabilities = tuple(capabilities[-1].decode().upper().split())
+
+        return response
+
+    def compress(self) -> bool:
+        """compresses everything sent and received from now on if the server supports it; returns whether it does"""
+        if self._compressor is not None:
+            return True
+
+        if 'COMPRESS=DEFLATE' not in self.capabilities:
+            return False
+
+        status, response = self._simple_command('COMPRESS', 'DEFLATE')
+
+        if status.lower() != 'ok':
+            logger.warning('The imap server advertises COMPRESS=DEFLATE, but failed to enable it.')
+            return False
+
+        # raw deflate without zlib header (negative window size)
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+
+        return True
+
+    def _inflate(self) -> bool:
+        """decompresses the next chunk received; returns False if the connection has been closed"""
+        # read1 returns what the buffered reader holds first, which may already be compressed
+        if not (data := self.file.read1(16384)):
+            return False
+
+        self._inflated += self._decompressor.decompress(data)
+
+        return True
+
+    def is_alive(self) -> bool:
+        """checks the connection with a NOOP; returns False if it has been dropped"""
+        if self.dropped or self.state == 'LOGOUT':
+            return False
+
+        try:
+            status, response = self.noop()
+        except (imaplib.IMAP4.error, OSError):
+            self.dropped = True
+            return False
+
+        return status.lower() == 'ok'
+
+    def needs_check(self) -> bool:
+        """whether the connection has been dropped or has not been used for a while, and may have timed out"""
+        return self.dropped or monotonic() - self.last_used > keepalive_interval
+
+    def multiappend(self, mailbox: str, flags: str, messages: list[tuple[float, bytes]]) -> tuple[str, list]:
+        """appends several mails (with the unix timestamps to date them with) to a mailbox
+
+        with MULTIAPPEND (rfc 3502), all of them are appended with a single command, atomically; otherwise, they are
+        appended one after the other, until one of them fails
+        """
+        if 'MULTIAPPEND' not in self.capabilities or len(messages) < 2:
+            status, response = 'OK', [None]
+
+            for date_time, message in messages:
+                status, response = self.append(mailbox, flags, imaplib.Time2Internaldate(date_time), message)
+
+                if status.lower() != 'ok':
+                    break
+
+            return status, response
+
+        literals = [
+            (imaplib.Time2Internaldate(date_time), imaplib.MapCRLF.sub(imaplib.CRLF, message))
+            for date_time, message in messages
+        ]
+
+        # the rest of the command line, with the size of the next mail, follows the literal of the previous one;
+        # imaplib sends one chunk for every continuation request of the server
+        self._multiappend_chunks = iter([
+            literal + f' ({flags}) {next_date_time} {{{len(next_literal)}}}'.encode()
+            for (date_time, literal), (next_date_time, next_literal) in zip(literals, literals[1:])
+        ] + [literals[-1][1]])
+        # imaplib only accepts a method, and only adds the size of a literal to the command line if it is none
+        self.literal = self._next_multiappend_chunk
+
+        first_date_time, first_literal = literals[0]
+        try:
+            return self._simple_command('APPEND', mailbox, f'({flags})', first_date_time, f'{{{len(first_literal)}}}')
+        finally:
+            self._multiappend_chunks = None
+
+    def _next_multiappend_chunk(self, continuation_response: bytes) -> bytes:
+        return next(self._multiappend_chunks)
+
+    def read(self, size: int) -> bytes:
+        try:
+            data = self._read(size)
+        except OSError:
+            self.dropped = True
+            raise
+
+        if size and not data:
+            # the server has closed the connection
+            self.dropped = True
+
+        return data
+
+    def readline(self) -> bytes:
+        try:
+            line = self._readline()
+        except OSError:
+            self.dropped = True
+            raise
+
+        if not line:
+            self.dropped = True
+
+        return line
+
+    def _read(self, size: int) -> bytes:
+        if self._decompressor is None:
+            return super().read(size)
+
+        while len(self._inflated) < size and self._inflate():
+            pass
+
+        data = bytes(self._inflated[:size])
+        del self._inflated[:size]
+
+        return data
+
+    def _readline(self) -> bytes:
+        if self._decompressor is None:
+            return super().readline()
+
+        searched = 0
+        while (end := self._inflated.find(b'\n', searched) + 1) == 0:
+            if len(self._inflated) > imaplib._MAXLINE:
+                raise self.error(f'got more than {imaplib._MAXLINE} bytes')
+
+            searched = len(self._inflated)
+
+            if not self._inflate():
+                # the connection has been closed, hand out the rest
+                end = len(self._inflated)
+                break
+
+        line = bytes(self._inflated[:end])
+        del self._inflated[:end]
+
+        return line
+
+    def send(self, data: bytes) -> None:
+        self.last_used = monotonic()
+
+        if self._compressor is not None:
+            # the sync flush makes the server able to decompress everything sent so far right away
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        try:
+            super().send(data)
+        except OSError:
+            self.dropped = True
+            raise
+
+
+def connect_imap(iserv_username: str, iserv_password: str, compress: bool = True) -> IMAP4:
+    """connects to the imap server of IServ, upgrades the connection to tls and logs in"""
+    imap_connection = IMAP4(host=config["server"]["domain"], port=int(config["port"]["imap"]))
+    imap_connection.starttls()
+    imap_connection.login(user=iserv_username, password=iserv_password)
+
+    if compress:
+        # headers and text compress well, which pays off on slow connections
+        imap_connection.compress()
+
+    return imap_connection
+
+
+# ----------
+# smtp
+# ----------
+
+
+class MailMaybeSent(smtplib.SMTPException):
+    """the connection has been lost after a whole mail has been sent, before the server has confirmed it
+
+    the server may have accepted the mail, so sending it again right away may send it twice
+    """
+
+
+class SMTP(smtplib.SMTP):
+    """smtplib.SMTP that tells apart whether a lost connection has lost the mail as well
+
+    raises MailMaybeSent instead of SMTPServerDisconnected if the connection is lost after the end of the mail data
+    has been sent; an SMTPServerDisconnected always means that the mail has not been accepted
+    """
+    _mail_data_sent = False
+
+    def send(self, s: str | bytes) -> None:
+        super().send(s)
+
+        # the end of the mail data (see smtplib.SMTP.data): from now on, the server may accept the mail
+        if isinstance(s, bytes) and s.endswith(b'\r\n.\r\n'):
+            self._mail_data_sent = True
+
+    def data(self, msg: str | bytes) -> tuple[int, bytes]:
+        self._mail_data_sent = False
+
+        try:
+            return super().data(msg)
+        except smtplib.SMTPServerDisconnected as error:
+            if self._mail_data_sent:
+                raise MailMaybeSent(f'The connection has been lost before the mail has been confirmed: {error}') \
+                    from error
+            raise
+
+
+def connect_smtp(iserv_username: str, iserv_password: str) -> SMTP:
+    """connects to the smtp server of IServ, upgrades the connection to tls and logs in"""
+    host, port = config["server"]["domain"], int(config["port"]["smtp"])
+
+    smtp_connection = SMTP(host=host, port=port)
+    smtp_connection.starttls(context=_SessionReusingContext(host, port))
+    smtp_connection.login(user=iserv_username, password=iserv_password)
+
+    _remember_tls_session(host, port, smtp_connection.sock)
+
+    return smtp_connection
@@ -0,0 +1,521 @@
+import re
+from collections.abc import Iterator, Iterable
+from functools import lru_cache
+
+import codecs
+import binascii
+from html import unescape
+from os import path
+from io import BytesIO
+from copy import copy
+from datetime import date
+
+from email.header import make_header, decode_header
+from email.parser import BytesHeaderParser
+from email.generator import BytesGenerator
+from email.message import Message
+from email.utils import getaddresses
+
+
+# ----------
+# message sets
+# ----------
+
+
+def message_set(mail_ids: list[int | str]) -> str:
+    """turns a list of mail ids (or uids) into a compact imap message set, e.g. [1, 2, 3, 7] -> '1:3,7'"""
+    numbers = sorted({int(mail_id) for mail_id in mail_ids})
+
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+
+    return ','.join(str(start) if start == end else f'{start}:{end}' for start, end in ranges)
+
+
+def expand_message_set(message_set: str) -> list[int]:
+    """turns a message set without wildcards back into a list of mail ids (or uids), e.g. '1:3,7' -> [1, 2, 3, 7]"""
+    numbers = []
+    for part in message_set.split(','):
+        if not part:
+            continue
+
+        start, _, end = part.partition(':')
+        start, end = int(start), int(end or start)
+        numbers += range(min(start, end), max(start, end) + 1)
+
+    return numbers
+
+
+def batched(sequence: list, batch_size: int) -> Iterator[list]:
+    """generator; splits a list into consecutive batches of at most batch_size elements"""
+    for batch_start in range(0, len(sequence), batch_size):
+        yield sequence[batch_start:batch_start + batch_size]
+
+
+# ----------
+# search criteria
+# ----------
+
+
+_months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def imap_date(day: date) -> str:
+    """formats a date the way imap expects it, e.g. 1-Feb-2023, independent of the locale"""
+    return f'{day.day}-{_months[day.month - 1]}-{day.year}'
+
+
+def quote(text: str) -> str:
+    """turns a text into an imap quoted string"""
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def search_criteria(
+        subject: str = None, from_sender: str = None, to_receiver: str = None, body: str = None, text: str = None,
+        since: date = None, before: date = None, unread: bool = None, flagged: bool = None
+) -> list[tuple[str, str | None]]:
+    """builds imap search criteria, e.g. [('SUBJECT', 'Klausur'), ('SINCE', '1-Feb-2023'), ('UNSEEN', None)]
+
+    all criteria have to match; None means that a criterion is not used
+    """
+    criteria = []
+
+    for search_key, value in (
+            ('SUBJECT', subject), ('FROM', from_sender), ('TO', to_receiver), ('BODY', body), ('TEXT', text)
+    ):
+        if value:
+            criteria.append((search_key, value))
+
+    if since is not None:
+        criteria.append(('SINCE', imap_date(since)))
+    if before is not None:
+        criteria.append(('BEFORE', imap_date(before)))
+
+    if unread is not None:
+        criteria.append(('UNSEEN' if unread else 'SEEN', None))
+    if flagged is not None:
+        criteria.append(('FLAGGED' if flagged else 'UNFLAGGED', None))
+
+    return criteria
+
+
+# ----------
+# fetch responses
+# ----------
+
+
+class _Literal(bytes):
+    """marks the data of an imap literal ({size}\r\n...) inside a token stream"""
+
+
+class _Atom(str):
+    """marks an unquoted imap atom inside a token stream"""
+
+
+# parentheses are kept as unique objects, so they can not be confused with quoted strings like "("
+_OPEN, _CLOSE = object(), object()
+
+
+_token_pattern = re.compile(
+    rb'\s*(?:'
+    rb'(?P<open>\()|(?P<close>\))|'
+    rb'"(?P<quoted>(?:[^"\\]|\\.)*)"|'
+    # atoms may contain a bracketed section with spaces and parentheses, e.g. BODY[HEADER.FIELDS (SUBJECT)]<0>
+    rb'(?P<atom>[^\s()"\[\]]*(?:\[[^\]]*\][^\s()"]*)?)'
+    rb')'
+)
+
+
+def _tokenize(chunks: list[bytes]) -> list:
+    """splits raw response chunks into parentheses, strings and atoms while keeping literals intact"""
+    tokens = []
+
+    for chunk in chunks:
+        if isinstance(chunk, _Literal):
+            tokens.append(chunk)
+            continue
+
+        # the literal size marker ({123}) is not needed anymore, the literal itself follows as its own chunk
+        chunk = re.sub(rb'\{\d+\}$', b'', chunk.rstrip())
+
+        position = 0
+        while position < len(chunk):
+            match = _token_pattern.match(chunk, position)
+            if match is None or match.end() == position:
+                break
+            position = match.end()
+
+            if match.group('open'):
+                tokens.append(_OPEN)
+            elif match.group('close'):
+                tokens.append(_CLOSE)
+            elif match.group('quoted') is not None:
+                tokens.append(re.sub(rb'\\(.)', rb'\1', match.group('quoted')).decode('utf-8', 'replace'))
+            elif match.group('atom'):
+                atom = match.group('atom').decode('utf-8', 'replace')
+                tokens.append(None if atom.upper() == 'NIL' else _Atom(atom))
+
+    return tokens
+
+
+def _build(tokens: list, position: int = 0) -> tuple[list, int]:
+    """turns a flat token list into nested lists; returns the list and the position after it"""
+    result = []
+
+    while position < len(tokens):
+        token = tokens[position]
+        position += 1
+
+        if token is _OPEN:
+            nested, position = _build(tokens, position)
+            result.append(nested)
+        elif token is _CLOSE:
+            return result, position
+        elif isinstance(token, _Literal):
+            result.append(bytes(token))
+        elif isinstance(token, _Atom):
+            result.append(int(token) if token.isdigit() else str(token))
+        else:
+            result.append(token)
+
+    return result, position
+
+
+def parse_response(response: list) -> list:
+    """parses the data returned by imaplib into nested python lists (atoms, strings, literals, None for NIL)"""
+    chunks = []
+    for element in response:
+        if element is None:
+            continue
+
+        if isinstance(element, tuple):
+            chunks.append(element[0])
+            chunks.append(_Literal(element[1]))
+        else:
+            chunks.append(element)
+
+    return _build(_tokenize(chunks))[0]
+
+
+def parse_fetch_response(response: list) -> list[tuple[int, dict]]:
+    """parses the data of a fetch command into (mail id, {data item name: value}) tuples
+
+    mail ids are message sequence numbers, the uid is part of the data items if it has been requested
+    """
+    parsed = parse_response(response)
+
+    mails = []
+    for mail_id, data_items in zip(parsed[0::2], parsed[1::2]):
+        if not isinstance(mail_id, int) or not isinstance(data_items, list):
+            continue
+
+        mails.append((mail_id, {
+            str(name).upper(): value for name, value in zip(data_items[0::2], data_items[1::2])
+        }))
+
+    return mails
+
+
+def parse_status_response(response: list) -> dict[str, dict[str, int]]:
+    """turns the data of STATUS responses, e.g. [b'INBOX (MESSAGES 231 UNSEEN 3)', ...], into a dict
+
+    e.g. {'INBOX': {'messages': 231, 'unseen': 3}}
+    """
+    parsed = parse_response(response)
+
+    overview = {}
+    for mailbox_name, status_items in zip(parsed[0::2], parsed[1::2]):
+        if isinstance(mailbox_name, bytes):
+            # sent as a literal
+            mailbox_name = mailbox_name.decode()
+
+        overview[str(mailbox_name)] = {
+            str(name).lower(): value for name, value in zip(status_items[0::2], status_items[1::2])
+        }
+
+    return overview
+
+
+def get_data_item(data_items: dict, prefix: str, default=None):
+    """returns the first data item whose name starts with the given prefix, e.g. BODY[HEADER.FIELDS"""
+    for name, value in data_items.items():
+        if name.startswith(prefix):
+            return value
+
+    return default
+
+
+# ----------
+# headers
+# ----------
+
+
+@lru_cache(maxsize=4096)
+def _decode_header_value(value: str) -> str:
+    return str(make_header(decode_header(value)))
+
+
+def decode_header_value(value: str | None) -> str:
+    """decodes a (possibly rfc 2047 encoded) header value; missing headers result in an empty string
+
+    the same senders and subjects come up again and again in listings, so decoded values are remembered
+    """
+    if value is None:
+        return ''
+
+    if not isinstance(value, str):
+        # a header with raw 8-bit characters (email.header.Header), which can not be remembered
+        return str(make_header(decode_header(value)))
+
+    return _decode_header_value(value)
+
+
+# only parses the header and leaves the values as they are (compat32), so they are only decoded once, by the cache
+_header_parser = BytesHeaderParser()
+
+
+def parse_header_fields(header: bytes, fields: Iterable[str] = ('subject', 'from', 'date')) -> tuple[str, ...]:
+    """parses the header of a mail (e.g. a fetched BODY[HEADER.FIELDS (...)]) and returns the decoded fields"""
+    message = _header_parser.parsebytes(header)
+
+    return tuple(decode_header_value(message[field]) for field in fields)
+
+
+def parse_header_fields_batch(
+        headers: Iterable[bytes], fields: Iterable[str] = ('subject', 'from', 'date')
+) -> list[tuple[str, ...]]:
+    """like parse_header_fields, for the headers of many mails at once"""
+    fields = tuple(fields)
+
+    return [parse_header_fields(header, fields) for header in headers]
+
+
+# ----------
+# body structure
+# ----------
+
+
+def _parameters(parameter_list: list | None) -> dict:
+    """turns a body parameter list like ['charset', 'utf-8', 'name', 'file.pdf'] into a dict with lowercase keys"""
+    if not isinstance(parameter_list, list):
+        return {}
+
+    return {str(name).lower(): value for name, value in zip(parameter_list[0::2], parameter_list[1::2])}
+
+
+def walk_body_structure(body_structure: list, part_number: str = '') -> list[dict]:
+    """flattens a parsed BODYSTRUCTURE into a list of its leaf parts
+
+    every part is described by a dict with its part number (for BODY[n]), content type, charset, transfer encoding,
+    size in bytes, disposition (e.g. attachment) and file name
+    """
+    if body_structure and isinstance(body_structure[0], list):
+        # multipart: the sub parts are followed by the subtype and extension data
+        parts = []
+        for index, sub_part in enumerate(body_structure):
+            if not isinstance(sub_part, list):
+                # the subtype, e.g. 'mixed'
+                break
+
+            parts += walk_body_structure(sub_part, f'{part_number}.{index + 1}' if part_number else str(index + 1))
+
+        return parts
+
+    content_type = f'{body_structure[0]}/{body_structure[1]}'.lower()
+    parameters = _parameters(body_structure[2])
+
+    # the extension data starts after the basic fields (7), text parts have an additional line count,
+    # messages additionally have an envelope and a body structure of their own
+    if content_type.startswith('text/'):
+        extension_index = 8
+    elif content_type == 'message/rfc822':
+        extension_index = 10
+    else:
+        extension_index = 7
+
+    # the first extension field is the md5 hash, the second one the disposition: ['attachment', ['filename', '...']]
+    disposition, disposition_parameters = None, {}
+    if len(body_structure) > extension_index + 1 and isinstance(body_structure[extension_index + 1], list):
+        disposition, *disposition_parameters = body_structure[extension_index + 1]
+        disposition = str(disposition).lower()
+        disposition_parameters = _parameters(disposition_parameters[0] if disposition_parameters else None)
+
+    file_name = disposition_parameters.get('filename') or parameters.get('name')
+
+    return [{
+        # the body of a single part mail is its part number 1
+        'part': part_number or '1',
+        'content_type': content_type,
+        'charset': parameters.get('charset'),
+        'encoding': str(body_structure[5] or '7bit').lower(),
+        'size': body_structure[6] if isinstance(body_structure[6], int) else 0,
+        'disposition': disposition,
+        'file_name': decode_header_value(file_name) if file_name else None
+    }]
+
+
+def decode_part(data: bytes, encoding: str, charset: str | None = None) -> bytes | str:
+    """undoes the content transfer encoding of a body part; text is decoded as well if a charset is given"""
+    if encoding == 'base64':
+        data = binascii.a2b_base64(data)
+    elif encoding == 'quoted-printable':
+        data = binascii.a2b_qp(data)
+
+    if charset is None:
+        return data
+
+    try:
+        return data.decode(charset, 'replace')
+    except LookupError:
+        # unknown charset
+        return data.decode('utf-8', 'replace')
+
+
+class StreamDecoder:
+    """undoes the content transfer encoding of a body part chunk by chunk, so it never has to be in memory as a whole"""
+    def __init__(self, encoding: str) -> None:
+        self._encoding = encoding
+        # the end of the previous chunk, which could not be decoded on its own
+        self._remainder = b''
+
+    def decode(self, chunk: bytes) -> bytes:
+        data = self._remainder + chunk
+
+        if self._encoding == 'base64':
+            # base64 can only be decoded in groups of four characters
+            data = b''.join(data.split())
+            cut = len(data) - len(data) % 4
+        elif self._encoding == 'quoted-printable':
+            # soft line breaks and escape sequences never span more than one line
+            cut = data.rfind(b'\n') + 1
+        else:
+            cut = len(data)
+
+        data, self._remainder = data[:cut], data[cut:]
+
+        return decode_part(data, self._encoding)
+
+    def flush(self) -> bytes:
+        data, self._remainder = self._remainder, b''
+
+        return decode_part(data, self._encoding)
+
+
+# ----------
+# previews
+# ----------
+
+
+def preview_part(parts: list[dict]) -> dict | None:
+    """picks the part a preview of the mail is made of: the first plain text part, otherwise the first html part"""
+    text_parts = [part for part in parts if part['disposition'] != 'attachment']
+
+    for content_type in ['text/plain', 'text/html']:
+        for part in text_parts:
+            if part['content_type'] == content_type:
+                return part
+
+    return None
+
+
+def text_preview(data: bytes, part: dict, length: int = 200) -> str:
+    """turns the first bytes of a text part (a partial fetch) into a single line of text
+
+    the data may end in the middle of an encoded character or an escape sequence, which is left out
+    """
+    if part['encoding'] == 'base64':
+        data = b''.join(data.split())
+        data = data[:len(data) - len(data) % 4]
+    elif part['encoding'] == 'quoted-printable':
+        # a cut off escape sequence like =C or =
+        data = re.sub(rb'=[0-9A-Fa-f]?$', b'', data)
+
+    data = decode_part(data, part['encoding'])
+
+    try:
+        decoder = codecs.getincrementaldecoder(part['charset'] or 'utf-8')('replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    # not final: a character cut in half is kept back instead of being replaced
+    text = decoder.decode(data, final=False)
+
+    if part['content_type'] == 'text/html':
+        # style sheets and scripts are not text; a tag that has been cut off is dropped as well
+        text = re.sub(r'(?is)<(style|script)\b.*?(</\1\s*>|$)', ' ', text)
+        text = unescape(re.sub(r'(?s)<[^>]*(>|$)', ' ', text))
+
+    return ' '.join(text.split())[:length]
+
+
+# ----------
+# sending
+# ----------
+
+
+def serialize_message(message: Message) -> tuple[str, list[str], bytes]:
+    """serializes a mail once, like smtplib.SMTP.send_message, so that the same bytes can be sent and appended
+
+    returns the address of the sender, the addresses of the recipients (including Bcc) and the mail without Bcc
+    """
+    from_address = getaddresses([message['Sender'] if 'Sender' in message else message['From']])[0][1]
+    to_addresses = [
+        address for name, address in getaddresses(
+            message.get_all('To', []) + message.get_all('Bcc', []) + message.get_all('Cc', []))
+    ]
+
+    # the recipients in Bcc must not see each other
+    message_copy = copy(message)
+    del message_copy['Bcc']
+
+    with BytesIO() as message_bytes:
+        BytesGenerator(message_bytes).flatten(message_copy, linesep='\r\n')
+        return from_address, to_addresses, message_bytes.getvalue()
+
+
+# ----------
+# files
+# ----------
+
+
+_reserved_file_names = {
+    'CON', 'PRN', 'AUX', 'NUL', *(f'COM{i}' for i in range(1, 10)), *(f'LPT{i}' for i in range(1, 10))
+}
+
+
+def safe_file_name(file_name: str | None, default: str = 'attachment') -> str:
+    """turns a file name chosen by the sender of a mail into one that can not escape the target directory"""
+    # drop everything that looks like a directory, no matter which os it is from
+    file_name = (file_name or '').replace('\\', '/').split('/')[-1]
+    # characters that are not allowed on windows or are control characters
+    file_name = re.sub(r'[<>:"|?*\x00-\x1f]', '_', file_name).strip(' .')
+
+    if not file_name:
+        return default
+
+    if file_name.split('.')[0].upper() in _reserved_file_names:
+        file_name = f'_{file_name}'
+
+    return file_name
+
+
+def open_unique_file(directory: str, file_name: str) -> tuple[str, object]:
+    """creates and opens a new file for writing; adds (1), (2), ... to the name instead of overwriting existing files
+
+    returns the path and the binary file object
+    """
+    name, extension = path.splitext(file_name)
+
+    number = 0
+    while True:
+        file_path = f'{directory}/{name}{f" ({number})" if number else ""}{extension}'
+
+        try:
+            # exclusive creation: fails instead of overwriting, even if another thread creates the same file
+            return file_path, open(file_path, 'xb')
+        except FileExistsError:
+            number += 1
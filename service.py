@@ -6,8 +6,6 @@ import win32event
 import servicemanager
 import socket
 
-from time import sleep
-
 from mail import ScheduleManager
 import auth
 
@@ -32,7 +30,8 @@ class MailScheduler (win32serviceutil.ServiceFramework):
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
         win32event.SetEvent(self.hWaitStop)
 
-        self.mail_schedule_manager.shutdown()
+        # main returns and shuts the schedule manager down
+        self.mail_schedule_manager.stop()
 
     def SvcDoRun(self):
         servicemanager.LogMsg(servicemanager.EVENTLOG_INFORMATION_TYPE,
@@ -41,9 +40,9 @@ class MailScheduler (win32serviceutil.ServiceFramework):
         self.main()
 
     def main(self):
-        while True:
-            sleep(10)
-            self.mail_schedule_manager.send_and_reschedule_scheduled_mails()
+        # sleeps until the next mail is due instead of checking the schedule every few seconds
+        self.mail_schedule_manager.run()
+        self.mail_schedule_manager.shutdown()
 
 
 # ----------
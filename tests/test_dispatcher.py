@@ -0,0 +1,68 @@
+import sys
+
+import pytest
+
+import mail.Dispatcher
+
+
+# mail.Dispatcher is the class, re-exported by the package
+dispatcher_module = sys.modules['mail.Dispatcher']
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.waited = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.waited.append(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dispatcher_module, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(dispatcher_module, 'sleep', clock.sleep)
+    return clock
+
+
+def test_token_bucket_lets_a_burst_pass(clock):
+    token_bucket = dispatcher_module.TokenBucket(rate=2, burst=3)
+
+    for _ in range(3):
+        token_bucket.acquire()
+    assert clock.waited == []
+    assert not token_bucket.is_full()
+
+    # the callers queue up behind each other
+    token_bucket.acquire()
+    token_bucket.acquire()
+    assert clock.waited == [0.5, 1.0]
+
+
+def test_token_bucket_refills(clock):
+    token_bucket = dispatcher_module.TokenBucket(rate=2, burst=3)
+
+    for _ in range(3):
+        token_bucket.acquire()
+
+    clock.now += 1
+    token_bucket.acquire()
+    token_bucket.acquire()
+    assert clock.waited == []
+
+    clock.now += 10
+    assert token_bucket.is_full()
+
+
+def test_token_bucket_without_rate(clock):
+    token_bucket = dispatcher_module.TokenBucket(rate=0)
+
+    for _ in range(100):
+        token_bucket.acquire()
+
+    assert clock.waited == []
+    assert token_bucket.is_full()
@@ -0,0 +1,86 @@
+from email.message import EmailMessage
+
+import pytest
+
+from mail.Outbox import Outbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite3'))
+    outbox.retries, outbox.retry_delay = 2, 60
+    yield outbox
+    outbox.close()
+
+
+def create_message(message_id: str) -> EmailMessage:
+    message = EmailMessage()
+    message['Message-ID'] = message_id
+    message['Subject'] = 'subject'
+    message.set_content('body')
+
+    return message
+
+
+def due_message_ids(outbox: Outbox) -> list[str]:
+    return [message_id for message_id, message in outbox.due()]
+
+
+def test_enqueue_once_per_message_id(outbox):
+    assert outbox.enqueue(create_message('<1@example.org>'))
+    assert not outbox.enqueue(create_message('<1@example.org>'))
+
+    assert due_message_ids(outbox) == ['<1@example.org>']
+    assert outbox.due()[0][1]['Subject'] == 'subject'
+
+
+def test_enqueue_needs_message_id(outbox):
+    with pytest.raises(ValueError):
+        outbox.enqueue(create_message(''))
+
+
+def test_sent_and_appended(outbox):
+    outbox.enqueue(create_message('<1@example.org>'))
+
+    outbox.mark_as_sent('<1@example.org>')
+    assert due_message_ids(outbox) == []
+    assert [message_id for message_id, message in outbox.unappended()] == ['<1@example.org>']
+
+    outbox.mark_as_appended('<1@example.org>')
+    assert outbox.unappended() == []
+
+    # appended a while ago
+    assert outbox.purge(older_than=-1) == 1
+
+
+def test_appended_before_sent(outbox):
+    outbox.enqueue(create_message('<1@example.org>'))
+
+    # the sent appender may be faster than the dispatcher
+    outbox.mark_as_appended('<1@example.org>')
+    outbox.mark_as_sent('<1@example.org>')
+
+    assert outbox.unappended() == []
+
+
+def test_failed_with_backoff(outbox):
+    outbox.enqueue(create_message('<1@example.org>'))
+
+    assert outbox.mark_as_failed('<1@example.org>', 'error')
+    assert due_message_ids(outbox) == []
+    first_attempt = outbox.next_attempt()
+
+    assert outbox.mark_as_failed('<1@example.org>', 'error')
+    assert outbox.next_attempt() >= first_attempt + 60
+
+    # retried too often
+    assert not outbox.mark_as_failed('<1@example.org>', 'error')
+    assert outbox.next_attempt() is None
+
+
+def test_failed_without_retry(outbox):
+    outbox.enqueue(create_message('<1@example.org>'))
+
+    assert not outbox.mark_as_failed('<1@example.org>', 'rejected', retry=False)
+    assert not outbox.mark_as_failed('<unknown@example.org>', 'error')
+    assert outbox.next_attempt() is None
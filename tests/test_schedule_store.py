@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+
+import pytest
+from dateutil import tz
+
+from mail.ScheduleStore import ScheduleStore, InvalidScheduledMail, ScheduleChanged
+
+
+line = 'Europe/Berlin | 24-12-2023_-_18-00-00 | max.mustermann | subject | plaintext/name.txt | once'
+repeated_line = 'Europe/Berlin | 24-12-2023_-_18-00-00 | max.mustermann | daily | html/name.html | repeat 0-1-0-0-0'
+
+
+@pytest.fixture
+def schedule_store(tmp_path):
+    schedule_store = ScheduleStore(str(tmp_path / 'schedule.sqlite3'))
+    yield schedule_store
+    schedule_store.close()
+
+
+# ----------
+# parsing
+# ----------
+
+
+def test_parse_line():
+    scheduled_mail = ScheduleStore.parse_line(line + ' | ./a.pdf | ./b.pdf')
+
+    assert scheduled_mail['to_user'] == 'max.mustermann'
+    assert scheduled_mail['attachments'] == ['./a.pdf', './b.pdf']
+    assert scheduled_mail['due'] == datetime(2023, 12, 24, 18, tzinfo=tz.gettz('Europe/Berlin')).timestamp()
+    assert ScheduleStore.format_line(scheduled_mail) == line + ' | ./a.pdf | ./b.pdf'
+
+
+@pytest.mark.parametrize('invalid_line', [
+    'Europe/Berlin | 24-12-2023_-_18-00-00 | max.mustermann | subject | plaintext/name.txt',
+    'Nowhere/Nothing | 24-12-2023_-_18-00-00 | max.mustermann | subject | plaintext/name.txt | once',
+    'Europe/Berlin | 2023-12-24 18:00 | max.mustermann | subject | plaintext/name.txt | once',
+    'Europe/Berlin | 24-12-2023_-_18-00-00 | max.mustermann | subject | markdown/name.md | once',
+    'Europe/Berlin | 24-12-2023_-_18-00-00 | max.mustermann | subject | plaintext/name.txt | repeat 0-0-0-0-0',
+    'Europe/Berlin | 24-12-2023_-_18-00-00 | max.mustermann | subject | plaintext/name.txt | repeat 0-1-0-0',
+    'Europe/Berlin | 24-12-2023_-_18-00-00 | max.mustermann | subject | plaintext/name.txt | repeat 0-1-0-0--1',
+])
+def test_parse_line_refuses_invalid_lines(invalid_line):
+    with pytest.raises(InvalidScheduledMail):
+        ScheduleStore.parse_line(invalid_line)
+
+
+def test_repeat_interval():
+    assert ScheduleStore.repeat_interval('once') is None
+    assert ScheduleStore.repeat_interval('repeat 1-2-3-4-5') == timedelta(weeks=1, days=2, hours=3, minutes=4, seconds=5)
+
+    with pytest.raises(ValueError):
+        ScheduleStore.repeat_interval('repeat 0-0-0-0-0')
+
+
+def test_next_due_time():
+    scheduled_mail = ScheduleStore.parse_line(repeated_line)
+
+    assert ScheduleStore.next_due_time(ScheduleStore.parse_line(line)) is None
+    assert ScheduleStore.next_due_time(scheduled_mail) == '25-12-2023_-_18-00-00'
+
+
+def test_next_due_time_skips_missed_repetitions():
+    scheduled_mail = ScheduleStore.parse_line(repeated_line)
+    after = datetime(2024, 1, 10, 12, tzinfo=tz.gettz('Europe/Berlin')).timestamp()
+
+    assert ScheduleStore.next_due_time(scheduled_mail, after=after) == '10-01-2024_-_18-00-00'
+
+    # a repetition that is due exactly then has been sent already
+    after = datetime(2024, 1, 10, 18, tzinfo=tz.gettz('Europe/Berlin')).timestamp()
+
+    assert ScheduleStore.next_due_time(scheduled_mail, after=after) == '11-01-2024_-_18-00-00'
+
+
+# ----------
+# persistence
+# ----------
+
+
+def test_add_and_read(schedule_store):
+    later_id = schedule_store.add(line.replace('2023', '2030'))
+    earlier_id = schedule_store.add(line)
+
+    assert [scheduled_mail['id'] for scheduled_mail in schedule_store.scheduled_mails()] == [earlier_id, later_id]
+    assert [scheduled_mail['id'] for scheduled_mail in schedule_store.due_mails(
+        datetime(2024, 1, 1).timestamp())] == [earlier_id]
+    assert schedule_store.next_due() == ScheduleStore.parse_line(line)['due']
+
+
+def test_reschedule_many(schedule_store):
+    once_id, repeated_id = schedule_store.add(line), schedule_store.add(repeated_line)
+
+    schedule_store.reschedule_many({once_id: None, repeated_id: '25-12-2023_-_18-00-00', 4711: '25-12-2023_-_18-00-00'})
+
+    assert [(scheduled_mail['id'], scheduled_mail['scheduled_for']) for scheduled_mail in
+            schedule_store.scheduled_mails()] == [(repeated_id, '25-12-2023_-_18-00-00')]
+
+
+def test_save_edited_keeps_ids(schedule_store):
+    first_id, second_id = schedule_store.add(line), schedule_store.add(repeated_line)
+    loaded_mails, loaded_data_version = schedule_store.scheduled_mails(), schedule_store.data_version()
+
+    edited_line = repeated_line.replace('daily', 'every day')
+    schedule_store.save_edited([line, edited_line, ''], loaded_mails, loaded_data_version)
+
+    assert [(scheduled_mail['id'], scheduled_mail['subject']) for scheduled_mail in
+            schedule_store.scheduled_mails()] == [(first_id, 'subject'), (second_id, 'every day')]
+
+
+def test_save_edited_adds_and_deletes(schedule_store):
+    schedule_store.add(line)
+    loaded_mails, loaded_data_version = schedule_store.scheduled_mails(), schedule_store.data_version()
+
+    schedule_store.save_edited([], loaded_mails, loaded_data_version)
+    assert schedule_store.scheduled_mails() == []
+
+    schedule_store.save_edited([line, line], [], schedule_store.data_version())
+    assert len(schedule_store.scheduled_mails()) == 2
+
+
+def test_save_edited_refuses_invalid_lines(schedule_store):
+    schedule_store.add(line)
+    loaded_mails, loaded_data_version = schedule_store.scheduled_mails(), schedule_store.data_version()
+
+    with pytest.raises(InvalidScheduledMail):
+        schedule_store.save_edited([line, 'invalid'], loaded_mails, loaded_data_version)
+
+    assert schedule_store.scheduled_mails() == loaded_mails
+
+
+def test_save_edited_refuses_changed_schedule(schedule_store, tmp_path):
+    schedule_store.add(line)
+    loaded_mails, loaded_data_version = schedule_store.scheduled_mails(), schedule_store.data_version()
+
+    # e.g. the scheduler service, which has its own connection
+    other_schedule_store = ScheduleStore(str(tmp_path / 'schedule.sqlite3'))
+    other_schedule_store.reschedule(loaded_mails[0]['id'], '25-12-2023_-_18-00-00')
+    other_schedule_store.close()
+
+    with pytest.raises(ScheduleChanged):
+        schedule_store.save_edited([line, repeated_line], loaded_mails, loaded_data_version)
+
+    assert [scheduled_mail['scheduled_for'] for scheduled_mail in schedule_store.scheduled_mails()] == [
+        '25-12-2023_-_18-00-00']
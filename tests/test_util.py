@@ -0,0 +1,58 @@
+from mail import util
+
+
+# ----------
+# message sets
+# ----------
+
+
+def test_message_set_joins_consecutive_ids():
+    assert util.message_set([7, 3, 1, 2, '2']) == '1:3,7'
+    assert util.message_set([5]) == '5'
+    assert util.message_set([]) == ''
+
+
+def test_expand_message_set_reverses_message_set():
+    assert util.expand_message_set('1:3,7') == [1, 2, 3, 7]
+    assert util.expand_message_set('5:3') == [3, 4, 5]
+    assert util.expand_message_set(util.message_set([1, 2, 4, 5, 6, 9])) == [1, 2, 4, 5, 6, 9]
+
+
+# ----------
+# responses
+# ----------
+
+
+def test_parse_response_nests_lists_and_keeps_literals():
+    response = [(b'1 (UID 5 BODY[HEADER.FIELDS (SUBJECT)] {13}', b'Subject: hi\r\n'), b')']
+
+    assert util.parse_response(response) == [1, ['UID', 5, 'BODY[HEADER.FIELDS (SUBJECT)]', b'Subject: hi\r\n']]
+
+
+def test_parse_response_handles_quoted_strings_and_nil():
+    response = [b'("a \\"quoted\\" (string)" NIL ")" atom)']
+
+    assert util.parse_response(response) == [['a "quoted" (string)', None, ')', 'atom']]
+
+
+def test_parse_fetch_response():
+    response = [
+        b'1 (UID 10 FLAGS (\\Seen \\Flagged))',
+        (b'2 (UID 11 FLAGS () RFC822.SIZE 42 BODY[] {5}', b'hello'),
+        b')',
+        None,
+    ]
+
+    assert util.parse_fetch_response(response) == [
+        (1, {'UID': 10, 'FLAGS': ['\\Seen', '\\Flagged']}),
+        (2, {'UID': 11, 'FLAGS': [], 'RFC822.SIZE': 42, 'BODY[]': b'hello'}),
+    ]
+
+
+def test_parse_status_response():
+    response = [b'INBOX (MESSAGES 231 UNSEEN 3 UIDNEXT 4711)', b'"INBOX/Sent Items" (MESSAGES 0)']
+
+    assert util.parse_status_response(response) == {
+        'INBOX': {'messages': 231, 'unseen': 3, 'uidnext': 4711},
+        'INBOX/Sent Items': {'messages': 0},
+    }